@@ -3,17 +3,72 @@
 """
 This example demonstrates querying rain gauge data and printing the total
 number of measurements grouped by VSN and sensor.
+With --output the totals are written to a file instead (.csv or .parquet, see sage_parquet.py),
+--raw-output also exports the queried rows.
 """
-import sage_data_client
-
-# query and load data into pandas data frame
-df = sage_data_client.query(
-    start="-1h",
-    filter={
-        "name": "env.raingauge.*",
-    }
-)
-
-# print number of results of each name
-#print(df.groupby(["meta.vsn", "name"]).size())
-print(df.groupby(["meta.vsn", "meta.sensor"]).value.agg(["size", "min", "max", "mean"]))
+import sage_query
+import sage_parquet
+import sage_metrics
+from argparse import ArgumentParser
+
+
+# columns the totals need, the raw export keeps all of them
+STATS_COLUMNS = ["timestamp", "name", "value", "meta.vsn", "meta.sensor"]
+
+def query_sage(start_date, end_date=None, columns=None):
+    # query and load data into pandas data frame
+    return sage_query.query(
+        start=start_date,
+        end=end_date,
+        filter={
+            "name": "env.raingauge.*",
+        },
+        columns=columns
+    )
+
+
+def raingauge_totals(df):
+    if df.empty:
+        return df
+
+    return df.groupby(["meta.vsn", "meta.sensor"], observed=True).value.agg(["size", "min", "max", "mean"])
+
+
+def main():
+    parser = ArgumentParser(description="Get Rain Gauge Totals From SAGE")
+    parser.add_argument("--start", metavar="STR", type=str, default="-1h", help="Query Start Time (default: -1h)", required=False)
+    parser.add_argument("--end", metavar="STR", type=str, default=None, help="Query End Time, exclusive (default: now)", required=False)
+    parser.add_argument("--output", metavar="STR", type=str, default=None, help="Output file, .csv or .parquet (default: print)", required=False)
+    parser.add_argument("--raw-output", metavar="STR", type=str, default=None, help="Also export the queried rows to this Parquet file", required=False)
+    parser.add_argument("--metrics", metavar="STR", type=str, default=None, help="Append per-phase metrics records to this JSON lines file, see sage_metrics.py", required=False)
+
+    args = parser.parse_args()
+    sage_metrics.start("raingauge_totals", args.metrics)
+
+    with sage_metrics.phase("query") as m:
+        df = query_sage(args.start, args.end, columns=None if args.raw_output else STATS_COLUMNS)
+        m["rows_out"] = len(df)
+
+    if args.raw_output:
+        with sage_metrics.phase("raw_write", rows_in=len(df)) as m:
+            sage_parquet.write_table(df, args.raw_output)
+            m["bytes_written"] = sage_metrics.file_size(args.raw_output)
+
+    # print number of results of each name
+    #print(df.groupby(["meta.vsn", "name"]).size())
+    with sage_metrics.phase("totals", rows_in=len(df)) as m:
+        totals = raingauge_totals(df)
+        m["rows_out"] = len(totals)
+
+    if args.output:
+        with sage_metrics.phase("write", rows_in=len(totals)) as m:
+            sage_parquet.write(totals, args.output)
+            m["bytes_written"] = sage_metrics.file_size(args.output)
+    else:
+        print(totals)
+
+    sage_metrics.write()
+
+
+if __name__ == "__main__":
+    main()
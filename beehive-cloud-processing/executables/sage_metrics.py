@@ -0,0 +1 @@
+../../crocus-processing/executables/sage_metrics.py
\ No newline at end of file
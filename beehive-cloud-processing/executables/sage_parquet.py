@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""
+Columnar (Parquet) output of the Beehive executables.
+
+Files are laid out as hive partitioned datasets, <dataset>/date=YYYY-MM-DD/<window>.parquet.
+The name and meta.* columns are dictionary encoded, and rows are sorted by meta.vsn with one
+row group per node, so readers only touch the partitions, nodes and columns they ask for:
+
+    pd.read_parquet("outputs/temperature_raw",
+                    filters=[("date", "=", "2024-06-01"), ("meta.vsn", "=", "W08D")],
+                    columns=["timestamp", "value"])
+"""
+import os
+
+import pandas as pd
+
+
+def _dictionary_columns(df):
+    return [c for c in df.columns if c == "name" or c.startswith("meta.")]
+
+
+def write_table(df, path):
+    """
+    Write df (index levels become columns) to a Parquet file, one row group per meta.vsn.
+    An empty frame still produces a file, so declared workflow outputs always exist.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if any(name is not None for name in df.index.names):
+        df = df.reset_index()
+    df = df.astype({c: "category" for c in _dictionary_columns(df)})
+
+    groups = [df]
+    if "meta.vsn" in df.columns and not df.empty:
+        df = df.sort_values("meta.vsn", kind="stable")
+        groups = [group for _, group in df.groupby("meta.vsn", observed=True, sort=False)]
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for group in groups:
+            writer.write_table(pa.Table.from_pandas(group, schema=schema, preserve_index=False))
+
+
+def write(df, path):
+    """
+    Write to Parquet or CSV depending on the extension of path.
+    """
+    if path.endswith(".parquet"):
+        write_table(df, path)
+    else:
+        df.to_csv(path)
+
+
+def read(path, columns=None):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
@@ -0,0 +1 @@
+../../crocus-processing/executables/sage_query.py
\ No newline at end of file
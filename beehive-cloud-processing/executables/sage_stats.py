@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+Mergeable summary statistics of Sage measurements.
+
+Per group the state holds size (count), sum, min, max, mean, m2 (sum of squared deviations
+from the mean, as in Welford's algorithm) and a quantile sketch. States of disjoint windows
+merge exactly into the state of their union, so rollups never need the raw data again.
+
+The sketch is a sparse histogram with fixed SKETCH_WIDTH bins stored as a JSON object
+{bin: count}, quantiles read from it are accurate to half a bin.
+"""
+import json
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+SKETCH_WIDTH = 0.1
+QUANTILES = [0.05, 0.5, 0.95]
+
+STATE_COLUMNS = ["size", "min", "max", "mean", "sum", "m2", "sketch"]
+
+
+def _sketch(values):
+    bins = np.floor(values.to_numpy(dtype=float) / SKETCH_WIDTH).astype(np.int64)
+    unique, counts = np.unique(bins, return_counts=True)
+    return json.dumps(dict(zip(unique.tolist(), counts.tolist())))
+
+
+def partial_stats(df, by):
+    """
+    Summary state of df.value per group of the by columns, missing values are left out.
+    """
+    values = pd.to_numeric(df["value"], errors="coerce")
+    keep = values.notna()
+    # name and meta.* are categoricals, only groups that occur are wanted
+    grouped = values[keep].groupby([df.loc[keep, c] for c in by], observed=True)
+
+    stats = grouped.agg(["size", "min", "max", "mean", "sum", "var"])
+    stats["m2"] = (stats.pop("var") * (stats["size"] - 1)).fillna(0.0)
+    stats["sketch"] = grouped.apply(_sketch)
+    return stats[STATE_COLUMNS]
+
+
+def merge_stats(frames, by):
+    """
+    Merge summary states (as written by partial_stats) of several windows.
+    """
+    df = pd.concat(frames, ignore_index=True)
+    grouped = df.groupby(by, observed=True)
+
+    stats = grouped.agg(size=("size", "sum"), min=("min", "min"), max=("max", "max"), sum=("sum", "sum"))
+    stats["mean"] = stats["sum"] / stats["size"]
+
+    # parallel variance: each part adds its own m2 plus its offset from the global mean
+    mean = df.join(stats["mean"].rename("total_mean"), on=by)["total_mean"]
+    df["m2_part"] = df["m2"] + df["size"] * (df["mean"] - mean) ** 2
+    stats["m2"] = df.groupby(by, observed=True)["m2_part"].sum()
+
+    stats["sketch"] = grouped["sketch"].apply(
+        lambda sketches: json.dumps(sum((Counter(json.loads(s)) for s in sketches), Counter()))
+    )
+    return stats[STATE_COLUMNS]
+
+
+def sketch_quantiles(sketch, quantiles=QUANTILES):
+    hist = sorted((int(k), v) for k, v in json.loads(sketch).items())
+    cumulative = np.cumsum([v for _, v in hist])
+    ranks = np.array(quantiles) * cumulative[-1]
+    idx = np.minimum(np.searchsorted(cumulative, ranks, side="left"), len(hist) - 1)
+    return [(hist[i][0] + 0.5) * SKETCH_WIDTH for i in idx]
+
+
+def finalize(stats):
+    """
+    Add the derived std and quantile columns, the state columns stay mergeable.
+    """
+    stats = stats.copy()
+    stats["std"] = np.sqrt(stats["m2"] / stats["size"])
+    q = np.array([sketch_quantiles(s) for s in stats["sketch"]]).reshape(-1, len(QUANTILES))
+    for i, quantile in enumerate(QUANTILES):
+        stats[f"p{int(quantile * 100):02d}"] = q[:, i]
+    return stats
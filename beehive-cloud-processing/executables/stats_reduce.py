@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+"""
+This example demonstrates merging the stats files of several temperature_stats.py windows
+(or of earlier rollups) into a single rollup, without querying the raw data again.
+"""
+import pandas as pd
+import sage_stats
+import sage_parquet
+import sage_metrics
+from argparse import ArgumentParser
+
+GROUP_BY = ["meta.vsn", "meta.sensor"]
+
+
+def reduce_stats(inputs):
+    frames = []
+    for path in inputs:
+        df = sage_parquet.read(path)
+        sage_metrics.count("reduce", rows_in=len(df))
+        # windows without data are written without the stats columns
+        if not df.empty and set(sage_stats.STATE_COLUMNS).issubset(df.columns):
+            frames.append(df[GROUP_BY + sage_stats.STATE_COLUMNS])
+
+    if not frames:
+        return pd.DataFrame(columns=GROUP_BY + sage_stats.STATE_COLUMNS).set_index(GROUP_BY)
+
+    return sage_stats.finalize(sage_stats.merge_stats(frames, GROUP_BY))
+
+
+def main():
+    parser = ArgumentParser(description="Merge Temperature Stats Windows")
+    parser.add_argument("--output", metavar="STR", type=str, required=True, help="Output file, .csv or .parquet")
+    parser.add_argument("--metrics", metavar="STR", type=str, default=None, help="Append per-phase metrics records to this JSON lines file, see sage_metrics.py")
+    parser.add_argument("inputs", metavar="STR", type=str, nargs="+", help="Stats files to merge")
+
+    args = parser.parse_args()
+    sage_metrics.start("stats_reduce", args.metrics)
+
+    with sage_metrics.phase("reduce") as m:
+        df = reduce_stats(args.inputs)
+        m["rows_out"] = len(df)
+
+    with sage_metrics.phase("write", rows_in=len(df)) as m:
+        sage_parquet.write(df, args.output)
+        m["bytes_written"] = sage_metrics.file_size(args.output)
+
+    sage_metrics.write()
+
+
+if __name__ == "__main__":
+    main()
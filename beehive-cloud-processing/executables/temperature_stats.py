@@ -1,39 +1,68 @@
 #!/usr/bin/env python3
 
 """
-This example demonstrates querying all temperature data and exporting basic stats grouped by VSN and sensor in a csv file
+This example demonstrates querying all temperature data and exporting basic stats grouped by VSN and sensor in a csv file.
+Next to size/min/max/mean the file holds the mergeable state (sum, m2, sketch) that stats_reduce.py combines into rollups.
+Outputs ending in .parquet are written as Parquet (see sage_parquet.py), --raw-output also exports the queried rows.
 """
-import sage_data_client
+import sage_query
+import sage_stats
+import sage_parquet
+import sage_metrics
 from argparse import ArgumentParser
 
-def query_sage(start_date, end_date):
+# columns the stats need, the raw export keeps all of them
+STATS_COLUMNS = ["timestamp", "name", "value", "meta.vsn", "meta.sensor"]
+
+def query_sage(start_date, end_date, columns=None):
     # query and load data into pandas data frame
-    df = sage_data_client.query(
+    return sage_query.query(
         start=start_date,
         end=end_date,
         filter={
             "name": "env.temperature",
-        }
+        },
+        columns=columns
     )
 
+
+def temperature_stats(df):
     if df.empty:
         return df
 
     # return stats of the temperature data grouped by node + sensor.
-    return df.groupby(["meta.vsn", "meta.sensor"]).value.agg(["size", "min", "max", "mean"])
+    return sage_stats.finalize(sage_stats.partial_stats(df, ["meta.vsn", "meta.sensor"]))
 
 
 def main():
     parser = ArgumentParser(description="Get Temperature Data From SAGE")
     parser.add_argument("--start", metavar="INT", type=str, default="", help="Query Start Time", required=True)
-    parser.add_argument("--end", metavar="INT", type=str, default="", help="Query End Time", required=True)
-    parser.add_argument("--output", metavar="STR", type=str, default="temperature.csv", help="Output file", required=False)
+    parser.add_argument("--end", metavar="INT", type=str, default="", help="Query End Time, exclusive", required=True)
+    parser.add_argument("--output", metavar="STR", type=str, default="temperature.csv", help="Output file, .csv or .parquet (default: temperature.csv)", required=False)
+    parser.add_argument("--raw-output", metavar="STR", type=str, default=None, help="Also export the queried rows to this Parquet file", required=False)
+    parser.add_argument("--metrics", metavar="STR", type=str, default=None, help="Append per-phase metrics records to this JSON lines file, see sage_metrics.py", required=False)
 
     args = parser.parse_args()
+    sage_metrics.start("temperature_stats", args.metrics)
+
+    with sage_metrics.phase("query") as m:
+        df = query_sage(args.start, args.end, columns=None if args.raw_output else STATS_COLUMNS)
+        m["rows_out"] = len(df)
+
+    if args.raw_output:
+        with sage_metrics.phase("raw_write", rows_in=len(df)) as m:
+            sage_parquet.write_table(df, args.raw_output)
+            m["bytes_written"] = sage_metrics.file_size(args.raw_output)
+
+    with sage_metrics.phase("stats", rows_in=len(df)) as m:
+        stats = temperature_stats(df)
+        m["rows_out"] = len(stats)
 
-    df = query_sage(args.start, args.end)
+    with sage_metrics.phase("write", rows_in=len(stats)) as m:
+        sage_parquet.write(stats, args.output)
+        m["bytes_written"] = sage_metrics.file_size(args.output)
 
-    df.to_csv(args.output)
+    sage_metrics.write()
 
 
 if __name__ == "__main__":
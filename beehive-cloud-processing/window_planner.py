@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Sizes the query windows of the Beehive cloud workflow so every job pulls about the same
+number of rows.
+
+The planning range is cut into small slots, aligned to the epoch like the buckets of the
+count aggregation, whose row counts are estimated either with a cheap count query against
+Beehive (through sage_query, so its cache and SAGE_QUERY_ENDPOINT apply), or from the stats
+files of previous runs (rows per time of day). Consecutive slots are then merged until a
+window reaches the target, and slots that are larger than the target on their own are split.
+Windows never cross a full hour, so each one belongs to a single hourly rollup.
+"""
+import os
+import sys
+import glob
+from math import ceil
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+# sage_query lives with the executables
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "executables"))
+
+SLOT = timedelta(minutes=10)
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+# rough size of a query result row, used to turn a byte budget into a row target
+BYTES_PER_ROW = 250
+
+
+def planning_range(now, align="hour"):
+    """
+    [start, end) planned by a run at now, 24 hours ending at the last full hour, or at the
+    last UTC midnight with align "day". Rollups then always cover whole periods, whenever
+    the workflow runs.
+    """
+    end = pd.Timestamp(now).floor(DAY if align == "day" else HOUR).to_pydatetime()
+    return end - DAY, end
+
+
+def slots(start, end, slot=SLOT):
+    """
+    [(start, end)] of the slots covering [start, end), at multiples of slot since the epoch,
+    the first and last ones clipped to the range.
+    """
+    first = pd.Timestamp(start).floor(slot).to_pydatetime()
+    return [(max(first + i * slot, start), min(first + (i + 1) * slot, end)) for i in range(ceil((end - first) / slot))]
+
+
+def probe_counts(start, end, filter, slot=SLOT):
+    """
+    Rows per slot from a count aggregation on the Beehive side, None if the probe fails.
+    """
+    import sage_query
+
+    try:
+        df = sage_query.query(
+            start=start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            end=end.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            filter=filter,
+            columns=["timestamp", "value"],
+            experimental_func="count",
+            experimental_window=f"{int(slot.total_seconds())}s"
+        )
+    except Exception as e:
+        print(f"Count probe failed: {e}")
+        return None
+
+    if df.empty:
+        return None
+
+    # the buckets are aligned to the epoch, like the slots
+    first = pd.Timestamp(start).floor(slot)
+    index = (pd.to_datetime(df["timestamp"], utc=True) - first) // pd.Timedelta(slot)
+    return pd.to_numeric(df["value"], errors="coerce").groupby(index).sum()
+
+
+def historical_counts(start, end, stats_dir, slot=SLOT):
+    """
+    Rows per slot estimated from previous `<start>_<end>_temperature.csv` stats files
+    (or `temperature/date=*/<start>_<end>.parquet`, end exclusive), averaged by time of day.
+    None when there is no history.
+    """
+    paths = glob.glob(os.path.join(stats_dir, "*_temperature.csv")) + \
+        glob.glob(os.path.join(stats_dir, "temperature", "date=*", "*.parquet"))
+
+    rates = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            w_start, w_end = [datetime.strptime(t, "%Y-%m-%dT%H-%M-%S") for t in name.split("_")[:2]]
+            if path.endswith(".parquet"):
+                rows = pd.read_parquet(path, columns=["size"])["size"].sum()
+            else:
+                rows = pd.read_csv(path)["size"].sum()
+        except (ValueError, KeyError, OSError):
+            continue
+
+        seconds = (w_end - w_start).total_seconds()
+        minute = w_start.hour * 60 + w_start.minute
+        rates.setdefault(minute // int(slot.total_seconds() // 60), []).append(rows / seconds)
+
+    if not rates:
+        return None
+
+    fallback = sum(sum(r) for r in rates.values()) / sum(len(r) for r in rates.values())
+    counts = {}
+    for i, (t, t_end) in enumerate(slots(start, end, slot)):
+        bucket = (t.hour * 60 + t.minute) // int(slot.total_seconds() // 60)
+        r = rates.get(bucket)
+        counts[i] = (sum(r) / len(r) if r else fallback) * (t_end - t).total_seconds()
+    return pd.Series(counts)
+
+
+def plan_windows(start, end, target_rows, counts, slot=SLOT):
+    """
+    Merge or split slots into [(start, end)] windows of about target_rows each, merged
+    windows stop at full hours.
+    """
+    windows = []
+    window_start = start
+    rows = 0
+    for i, (slot_start, slot_end) in enumerate(slots(start, end, slot)):
+        slot_rows = float(counts.get(i, 0))
+        if window_start < slot_start and slot_start == pd.Timestamp(slot_start).floor(HOUR):
+            windows.append((window_start, slot_start))
+            window_start, rows = slot_start, 0
+
+        if slot_rows > target_rows:
+            if window_start < slot_start:
+                windows.append((window_start, slot_start))
+            # whole seconds, window bounds end up in second resolution file names
+            step = timedelta(seconds=ceil((slot_end - slot_start).total_seconds() * target_rows / slot_rows))
+            split_start = slot_start
+            while split_start < slot_end:
+                windows.append((split_start, min(split_start + step, slot_end)))
+                split_start += step
+            window_start, rows = slot_end, 0
+            continue
+
+        if rows + slot_rows > target_rows and window_start < slot_start:
+            windows.append((window_start, slot_start))
+            window_start, rows = slot_start, 0
+        rows += slot_rows
+
+    if window_start < end:
+        windows.append((window_start, end))
+    return windows
+
+
+def split_hours(windows):
+    """
+    Cut windows at full hours, so each one belongs to a single hourly rollup and date partition.
+    """
+    hours = []
+    for start, end in windows:
+        hours.extend(slots(start, end, HOUR))
+    return hours
+
+
+def query_windows(start, end, filter, target_rows=None, target_bytes=None, stats_dir=None, fixed=timedelta(minutes=30)):
+    """
+    Windows covering [start, end). Without a target, or without any way to estimate the
+    row counts, this falls back to fixed windows.
+    """
+    if target_rows is None and target_bytes is not None:
+        target_rows = target_bytes / BYTES_PER_ROW
+
+    counts = None
+    if target_rows is not None:
+        counts = probe_counts(start, end, filter)
+        if counts is None and stats_dir is not None:
+            counts = historical_counts(start, end, stats_dir)
+
+    if counts is None:
+        return split_hours(slots(start, end, fixed))
+
+    return split_hours(plan_windows(start, end, target_rows, counts))
@@ -4,16 +4,24 @@ import sys
 from pathlib import Path
 from datetime import datetime, timedelta
 from dateutil import tz
+from argparse import ArgumentParser
 
 # --- Import Pegasus API -----------------------------------------------------------
 from Pegasus.api import *
 
+from window_planner import query_windows, planning_range
+
 class SageWorkflow():
     wf = None
 
     # --- Init ---------------------------------------------------------------------
-    def __init__(self):
+    def __init__(self, target_rows=None, target_bytes=None, output_format="csv", raw=False, raingauge=False,
+                 cluster=None, cluster_size=8, cluster_runtime=None, window_runtime=30, metrics=True, align="hour"):
         self.wf_name = "SageCloudWorkflow" 
+        self.output_format = output_format
+        self.metrics = metrics
+        self.cluster = cluster or []
+        self.window_runtime = window_runtime
     
         self.wf = Workflow(self.wf_name, infer_dependencies=True)
         
@@ -28,13 +36,54 @@ class SageWorkflow():
                 os_type=OS.LINUX
             )
         
-        tc.add_transformations(temperature)
+        stats_reduce = Transformation(
+                "stats_reduce.py",
+                site="local",
+                pfn= "/home/ubuntu/beehive-cloud-processing/executables/stats_reduce.py",
+                is_stageable=True,
+                arch=Arch.X86_64,
+                os_type=OS.LINUX
+            )
+        
+        raingauge_totals = Transformation(
+                "raingauge_totals.py",
+                site="local",
+                pfn= "/home/ubuntu/beehive-cloud-processing/executables/raingauge_totals.py",
+                is_stageable=True,
+                arch=Arch.X86_64,
+                os_type=OS.LINUX
+            )
+        
+        # horizontal clustering: a fixed number of jobs per cluster, or as many as fit in cluster_runtime seconds
+        for transformation in (temperature, stats_reduce, raingauge_totals):
+            if cluster_runtime:
+                transformation.add_pegasus_profile(clusters_max_runtime=cluster_runtime)
+            else:
+                transformation.add_pegasus_profile(clusters_size=cluster_size)
+
+        tc.add_transformations(temperature, stats_reduce, raingauge_totals)
         self.wf.add_transformation_catalog(tc)
 
+        # query cache, stats, output and metrics helpers imported by the executables
+        rc = ReplicaCatalog()
+        rc.add_replica("local", "sage_query.py", "/home/ubuntu/beehive-cloud-processing/executables/sage_query.py")
+        rc.add_replica("local", "sage_stats.py", "/home/ubuntu/beehive-cloud-processing/executables/sage_stats.py")
+        rc.add_replica("local", "sage_parquet.py", "/home/ubuntu/beehive-cloud-processing/executables/sage_parquet.py")
+        rc.add_replica("local", "sage_metrics.py", "/home/ubuntu/beehive-cloud-processing/executables/sage_metrics.py")
+        self.wf.add_replica_catalog(rc)
+
+
+        # size the query windows to even out the job runtimes, windows never cross a full hour
+        start, end = planning_range(datetime.now(tz=tz.tzutc()), align)
+        windows = query_windows(start, end, {"name": "env.temperature"},
+                                target_rows=target_rows, target_bytes=target_bytes, stats_dir="./outputs")
 
-        start_date = datetime.now(tz=tz.tzutc()) - timedelta(hours=24)
-        for i in range(48):
-            end_date = start_date + timedelta(minutes=29, seconds=59)
+        hourly = {}
+        # windows are half-open [start, end), the end of one is the start of the next
+        for start_date, end_date in windows:
+            window = f"{start_date.strftime('%Y-%m-%dT%H-%M-%S')}_{end_date.strftime('%Y-%m-%dT%H-%M-%S')}"
+            output_file = self.output_name("temperature", start_date, window)
+            hourly.setdefault(start_date.strftime('%Y-%m-%dT%H'), []).append(output_file)
 
             # Add a preprocess job
             temperature_job = Job("temperature_stats.py")\
@@ -44,13 +93,104 @@ class SageWorkflow():
                                     "--end", 
                                     f"'{end_date.strftime('%Y-%m-%dT%H:%M:%S %z')}'",
                                     "--output", 
-                                    f"{start_date.strftime('%Y-%m-%dT%H-%M-%S')}_{end_date.strftime('%Y-%m-%dT%H-%M-%S')}_temperature.csv"
+                                    output_file
                                 )\
-                                .add_outputs(f"{start_date.strftime('%Y-%m-%dT%H-%M-%S')}_{end_date.strftime('%Y-%m-%dT%H-%M-%S')}_temperature.csv", stage_out=True, register_replica=False)
+                                .add_inputs("sage_query.py", "sage_stats.py", "sage_parquet.py", "sage_metrics.py")\
+                                .add_outputs(output_file, stage_out=True, register_replica=False)
 
+            if raw:
+                raw_file = self.partition_name("temperature_raw", start_date, window)
+                temperature_job.add_args("--raw-output", raw_file)
+                temperature_job.add_outputs(raw_file, stage_out=True, register_replica=False)
+
+            self.add_metrics(temperature_job, f"temperature_stats_{window}")
+            self.add_cluster_profiles(temperature_job, start_date)
             self.wf.add_jobs(temperature_job)
 
-            start_date += timedelta(minutes=30)
+            if raingauge:
+                self.add_raingauge_job(start_date, end_date, window, raw)
+
+        # tree reduce of the windows: hourly rollups (a window lies within the hour it starts in), then daily ones
+        # for the UTC days the range covers whole, a partial day would hold different hours on every run
+        daily = {}
+        for hour, window_files in hourly.items():
+            output_file = self.output_name("temperature_hour", datetime.strptime(hour, '%Y-%m-%dT%H'), hour)
+            daily.setdefault(hour[:10], []).append(output_file)
+            self.add_reduce_job(window_files, output_file, label=hour)
+
+        for day, hour_files in daily.items():
+            day_start = datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=tz.tzutc())
+            if day_start < start or day_start + timedelta(days=1) > end:
+                continue
+            self.add_reduce_job(hour_files, self.output_name("temperature_day", datetime.strptime(day, '%Y-%m-%d'), day))
+
+    # --- Clustering ---------------------------------------------------------------
+    def add_cluster_profiles(self, job, start_date):
+        """
+        Expected runtime for runtime sized clusters, label clustering groups the window jobs
+        of an hour together with their hourly rollup.
+        """
+        job.add_pegasus_profile(runtime=str(self.window_runtime))
+        if "label" in self.cluster:
+            job.add_pegasus_profile(label=start_date.strftime('%Y-%m-%dT%H'))
+
+    # --- Metrics ------------------------------------------------------------------
+    def add_metrics(self, job, name):
+        """
+        Per-phase metrics of the job as an output, executables/sage_metrics.py aggregates them.
+        """
+        if self.metrics:
+            metrics_file = f"metrics/{name}.metrics.jsonl"
+            job.add_args("--metrics", metrics_file)
+            job.add_outputs(metrics_file, stage_out=True, register_replica=False)
+
+    # --- Output names -------------------------------------------------------------
+    @staticmethod
+    def partition_name(dataset, date, name):
+        """
+        File of the date partition of a hive partitioned dataset, see executables/sage_parquet.py.
+        """
+        return f"{dataset}/date={date.strftime('%Y-%m-%d')}/{name}.parquet"
+
+    def output_name(self, dataset, date, name):
+        if self.output_format == "parquet":
+            return self.partition_name(dataset, date, name)
+        return f"{name}_{dataset}.csv"
+
+    def add_raingauge_job(self, start_date, end_date, window, raw):
+        output_file = self.output_name("raingauge", start_date, window)
+        raingauge_job = Job("raingauge_totals.py")\
+                            .add_args(
+                                "--start",
+                                f"'{start_date.strftime('%Y-%m-%dT%H:%M:%S %z')}'",
+                                "--end",
+                                f"'{end_date.strftime('%Y-%m-%dT%H:%M:%S %z')}'",
+                                "--output",
+                                output_file
+                            )\
+                            .add_inputs("sage_query.py", "sage_parquet.py", "sage_metrics.py")\
+                            .add_outputs(output_file, stage_out=True, register_replica=False)
+
+        if raw:
+            raw_file = self.partition_name("raingauge_raw", start_date, window)
+            raingauge_job.add_args("--raw-output", raw_file)
+            raingauge_job.add_outputs(raw_file, stage_out=True, register_replica=False)
+
+        self.add_metrics(raingauge_job, f"raingauge_totals_{window}")
+        self.add_cluster_profiles(raingauge_job, start_date)
+        self.wf.add_jobs(raingauge_job)
+
+    def add_reduce_job(self, inputs, output_file, label=None):
+        reduce_job = Job("stats_reduce.py")\
+                        .add_args("--output", output_file, *inputs)\
+                        .add_inputs("sage_stats.py", "sage_parquet.py", "sage_metrics.py", *inputs)\
+                        .add_outputs(output_file, stage_out=True, register_replica=False)
+
+        self.add_metrics(reduce_job, "stats_reduce_" + os.path.splitext(output_file)[0].replace("/", "_"))
+        if label and "label" in self.cluster:
+            reduce_job.add_pegasus_profile(label=label)
+
+        self.wf.add_jobs(reduce_job)
 
     def submit(self):
         try:
@@ -58,6 +198,7 @@ class SageWorkflow():
                 output_dir="./outputs",
                 input_dirs=["./inputs"],
                 transformations_dir="./executables",
+                cluster=self.cluster or None,
                 submit=True
             ).wait()
         except Exception as e:
@@ -66,5 +207,25 @@ class SageWorkflow():
 
 
 if __name__ == '__main__':
-    workflow = SageWorkflow()
+    parser = ArgumentParser(description="Pegasus Sage Cloud Workflow")
+    parser.add_argument("--target-rows", metavar="INT", type=int, default=None, help="Size query windows to about this many rows per job (default: fixed 30 minute windows)")
+    parser.add_argument("--target-bytes", metavar="INT", type=int, default=None, help="Size query windows to about this many response bytes per job")
+    parser.add_argument("--format", type=str, choices=["csv", "parquet"], default="csv", help="Stats output format, parquet writes date partitioned datasets (default: csv)")
+    parser.add_argument("--raw", action="store_true", help="Also export the queried rows as date partitioned parquet datasets")
+    parser.add_argument("--raingauge", action="store_true", help="Also compute rain gauge totals per query window")
+
+    parser.add_argument("--cluster", type=str, choices=["horizontal", "label"], nargs="+", default=None, help="Pegasus job clustering, horizontal per transformation and/or label by hour (default: none)")
+    parser.add_argument("--cluster-size", metavar="INT", type=int, default=8, help="Jobs per horizontal cluster (default: 8)")
+    parser.add_argument("--cluster-runtime", metavar="INT", type=int, default=None, help="Size horizontal clusters to this many seconds of expected runtime instead of --cluster-size")
+    parser.add_argument("--window-runtime", metavar="INT", type=int, default=30, help="Expected runtime in seconds of one query window job, used with --cluster-runtime (default: 30)")
+    parser.add_argument("--align", type=str, choices=["hour", "day"], default="hour", help="Plan the 24 hours up to the last full hour, or the previous UTC day. Daily rollups are only written for whole UTC days (default: hour)")
+    parser.add_argument("--no-metrics", action="store_true", help="Do not collect the per-phase metrics of the jobs in outputs/metrics")
+
+    args = parser.parse_args()
+
+    workflow = SageWorkflow(target_rows=args.target_rows, target_bytes=args.target_bytes,
+                            output_format=args.format, raw=args.raw, raingauge=args.raingauge,
+                            cluster=args.cluster, cluster_size=args.cluster_size,
+                            cluster_runtime=args.cluster_runtime, window_runtime=args.window_runtime,
+                            metrics=not args.no_metrics, align=args.align)
     workflow.submit()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Wall time of ambient-ingest.py fetching stations one by one against concurrently behind its
+rate limiter, on the local Ambient API stand-in of ambient_standin.py.
+
+The stand-in answers every request after --latency seconds and limits an API key to --rate
+requests per second like the real API, so sequential fetching pays the latency per station
+while concurrent fetching is bound by the rate limit. The "unlimited" run lets the threads go
+faster than the API allows and shows how many 429s the limiter saves, it may run out of
+retries. The script exits with an error when a rate limited run does not write every station
+and day.
+"""
+import os
+import re
+import sys
+import subprocess
+import tempfile
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import ambient_standin
+
+INGEST = Path(__file__).resolve().parent.parent / "executables" / "ambient-ingest.py"
+
+
+def run(server, args, extra):
+    env = dict(os.environ, AMBIENT_ENDPOINT=server.url)
+    limited, failed = server.limited, server.failed
+    with tempfile.TemporaryDirectory() as work:
+        start = perf_counter()
+        proc = subprocess.run([sys.executable, str(INGEST), "--date", args.date, "--days", str(args.days),
+                               "--backoff", str(args.backoff)] + extra,
+                              cwd=work, env=env, capture_output=True, text=True)
+        wall = perf_counter() - start
+        files = len(list(Path(work).glob("*.a1.*.nc")))
+
+    counts = re.search(r"(\d+) requests, (\d+) retried", proc.stdout)
+    ok = proc.returncode == 0 and files == args.stations * args.days
+    if not ok:
+        print((proc.stdout + proc.stderr)[-2000:])
+    return {"wall": wall, "files": files, "requests": int(counts.group(1)) if counts else 0,
+            "retried": int(counts.group(2)) if counts else 0, "limited": server.limited - limited,
+            "errors": server.failed - failed, "ok": ok}
+
+
+def main():
+    parser = ArgumentParser(description="Sequential against concurrent rate limited Ambient fetching")
+    parser.add_argument("--stations", metavar="INT", type=int, default=10, help="Stations of the stand-in (default: 10)")
+    parser.add_argument("--days", metavar="INT", type=int, default=1, help="Days fetched per station (default: 1)")
+    parser.add_argument("--date", metavar="STR", type=str, default="2024-06-01", help="First day fetched (default: 2024-06-01)")
+    parser.add_argument("--latency", metavar="FLOAT", type=float, default=2.0, help="Seconds every answer of the stand-in takes (default: 2.0)")
+    parser.add_argument("--rate", metavar="FLOAT", type=float, default=1.0, help="Requests per second the stand-in allows, ambient-ingest.py stays under 1 by default (default: 1.0)")
+    parser.add_argument("--errors", metavar="FLOAT", type=float, default=0.05, help="Share of requests failing with 503 (default: 0.05)")
+    parser.add_argument("--workers", metavar="INT", type=int, default=4, help="Threads of the concurrent runs (default: 4)")
+    parser.add_argument("--backoff", metavar="FLOAT", type=float, default=0.5, help="Initial retry delay of ambient-ingest.py (default: 0.5)")
+
+    args = parser.parse_args()
+
+    runs = {
+        "sequential": ["--workers", "1"],
+        "concurrent": ["--workers", str(args.workers)],
+        "unlimited": ["--workers", str(args.workers), "--rate", "1000", "--burst", str(args.workers)],
+    }
+
+    server = ambient_standin.AmbientStandIn(args.stations, args.rate, args.latency, args.errors).start()
+    print(f"{args.stations} stations x {args.days} days, {args.latency}s latency, {args.rate} requests/s allowed")
+    print(f"{'run':<12} {'wall':>8} {'files':>6} {'requests':>9} {'retried':>8} {'429':>5} {'503':>5}")
+    results = {}
+    for name, extra in runs.items():
+        r = results[name] = run(server, args, extra)
+        print(f"{name:<12} {r['wall']:>7.1f}s {r['files']:>6} {r['requests']:>9} {r['retried']:>8} {r['limited']:>5} {r['errors']:>5}"
+              f"{'' if r['ok'] else '  FAILED'}")
+    server.shutdown()
+
+    if not (results["sequential"]["ok"] and results["concurrent"]["ok"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the Ambient Weather REST API, enforcing its rate limit.
+
+GET /v1/devices lists --stations made up stations (CMS-AMB-001, CMS-AMB-002, ...), and
+GET /v1/devices/<mac>?endDate=<ms>&limit=<n> returns their 5 minute records before endDate,
+newest first, like the real API. Requests beyond --rate per second for an apiKey are
+answered with 429, every answer takes --latency seconds, and --errors of them fail with 503:
+
+    ambient_standin.py --port 8124 --stations 20 &
+    AMBIENT_ENDPOINT=http://localhost:8124/v1 ./ambient-ingest.py --date 2024-06-01
+"""
+import sys
+import json
+import time
+import threading
+from urllib.parse import urlsplit, parse_qs
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+STEP_MS = 5 * 60 * 1000
+DAY_MS = 86400 * 1000
+
+
+def devices(stations):
+    return [{"macAddress": f"00:0E:C6:30:{i // 256:02X}:{i % 256:02X}",
+             "info": {"name": f"CMS-AMB-{i:03d}",
+                      "coords": {"coords": {"lat": 41.8 + i * 0.01, "lon": -87.7 - i * 0.01}}},
+             "lastData": {}}
+            for i in range(1, stations + 1)]
+
+
+def records(mac, end_ms, limit):
+    """
+    The limit 5 minute records before end_ms, newest first, temperatures on a daily cycle.
+    """
+    end_ms = end_ms // STEP_MS * STEP_MS
+    t = end_ms - STEP_MS * np.arange(1, limit + 1)
+    seed = int(mac.replace(":", ""), 16)
+    phase = 2 * np.pi * ((t % DAY_MS) / DAY_MS - 0.625)
+    noise = np.random.default_rng([seed, int(end_ms // DAY_MS)]).normal(0, 0.3, limit)
+    tempf = 70 + 8 * np.sin(phase) + noise
+    dewpoint = tempf - 12 - 3 * np.cos(phase)
+    humidity = 100 * np.exp(17.625 * 5 / 9 * (dewpoint - tempf) / (243.04 + 5 / 9 * (tempf - 32)))
+    return [{"dateutc": int(ms), "date": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(ms / 1000)),
+             "tempf": round(float(tf), 1), "dewPoint": round(float(td), 1), "humidity": int(rh)}
+            for ms, tf, td, rh in zip(t, tempf, dewpoint, humidity)]
+
+
+class AmbientStandIn(ThreadingHTTPServer):
+    """
+    Ambient API stand-in, counts the requests it answered and the ones it limited.
+    """
+    def __init__(self, stations=2, rate=1.0, latency=0.2, errors=0.0, port=0, seed=0):
+        super().__init__(("localhost", port), AmbientHandler)
+        self.devices = devices(stations)
+        self.macs = {d["macAddress"] for d in self.devices}
+        self.rate = rate
+        self.latency = latency
+        self.errors = errors
+        self.rng = np.random.default_rng(seed)
+        self.last = {}
+        self.requests = 0
+        self.limited = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://localhost:{self.server_port}/v1"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def admit(self, key):
+        """
+        Status of a request of key: 429 if it came sooner than 1 / rate after the last one.
+        """
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            if now - self.last.get(key, -1e9) < 1 / self.rate:
+                self.limited += 1
+                return 429
+            self.last[key] = now
+            if self.rng.random() < self.errors:
+                self.failed += 1
+                return 503
+            return 200
+
+
+class AmbientHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        time.sleep(self.server.latency)
+
+        status = self.server.admit(query.get("apiKey"))
+        if status != 200:
+            return self._send(status, {"error": "above-user-rate-limit" if status == 429 else "unavailable"})
+
+        parts = url.path.strip("/").split("/")
+        if parts == ["v1", "devices"]:
+            return self._send(200, self.server.devices)
+        if len(parts) == 3 and parts[:2] == ["v1", "devices"] and parts[2] in self.server.macs:
+            end = int(query.get("endDate", time.time() * 1000))
+            limit = min(int(query.get("limit", 288)), 288)
+            return self._send(200, records(parts[2], end, limit))
+        self._send(404, {"error": "not found"})
+
+
+def main():
+    parser = ArgumentParser(description="Serve made up stations on a local Ambient Weather API stand-in")
+    parser.add_argument("--port", metavar="INT", type=int, default=8124, help="Port of the stand-in (default: 8124)")
+    parser.add_argument("--stations", metavar="INT", type=int, default=2, help="Number of stations (default: 2)")
+    parser.add_argument("--rate", metavar="FLOAT", type=float, default=1.0, help="Requests per second allowed per apiKey (default: 1.0)")
+    parser.add_argument("--latency", metavar="FLOAT", type=float, default=0.2, help="Seconds every answer takes (default: 0.2)")
+    parser.add_argument("--errors", metavar="FLOAT", type=float, default=0.0, help="Share of requests failing with 503 (default: 0.0)")
+
+    args = parser.parse_args()
+
+    server = AmbientStandIn(args.stations, args.rate, args.latency, args.errors, args.port)
+    print(f"Serving {args.stations} stations on {server.url}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
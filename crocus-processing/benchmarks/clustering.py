@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Makespan of the CROCUS workflow on the local condorpool with and without job clustering.
+
+Every configuration plans and runs the same backfill (outputs are always recomputed), and
+reports the wall time from submission to completion next to the workflow and cumulative
+job wall times from pegasus-statistics. The difference between the two is the scheduling,
+staging and container set-up overhead that clustering is meant to cut. Run it from a
+submit host of the pool, ideally with a warm --cache-dir so the jobs do not wait on Beehive.
+"""
+import re
+import sys
+import subprocess
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+from datetime import datetime
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from workflow import CrocusWorkflow
+
+# name -> CrocusWorkflow clustering options
+CONFIGS = {
+    "none": {},
+    "horizontal": {"cluster": ["horizontal"]},
+    "runtime": {"cluster": ["horizontal"], "cluster_runtime": 600},
+    "label": {"cluster": ["label"]},
+}
+
+STATISTICS = ["Workflow wall time", "Cumulative job wall time"]
+
+
+def statistics(submit_dir):
+    out = subprocess.run(["pegasus-statistics", "-s", "summary", str(submit_dir)],
+                         capture_output=True, text=True).stdout
+    found = {}
+    for name in STATISTICS:
+        match = re.search(rf"^{name}\s*:\s*(.+)$", out, re.MULTILINE)
+        found[name] = match.group(1).strip() if match else "n/a"
+    return found
+
+
+def run(name, options, args):
+    workflow = CrocusWorkflow(args.end_date, args.lag, args.end_date, args.lag, cache_dir=args.cache_dir,
+                              reuse=False, **options)
+    workflow.create_sites_catalog()
+    workflow.create_pegasus_properties()
+    workflow.create_transformation_catalog()
+    workflow.create_replica_catalog()
+    workflow.create_workflow()
+    workflow.write()
+
+    start = perf_counter()
+    workflow.wf.plan(output_sites=["local"], dir=args.submit_dir, relative_dir=f"clustering-{name}",
+                     cluster=workflow.cluster or None, submit=True).wait()
+    makespan = perf_counter() - start
+
+    return makespan, statistics(workflow.wf.braindump.submit_dir)
+
+
+def main():
+    parser = ArgumentParser(description="Makespan of clustered and unclustered CROCUS workflows")
+    parser.add_argument("--end-date", metavar="STR", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), required=True, help="End date of the backfill (example: '2024-01-01')")
+    parser.add_argument("--lag", metavar="INT", type=int, default=14, help="Days of the backfill (default: 14)")
+    parser.add_argument("--cache-dir", metavar="STR", type=str, default=None, help="Shared Sage query cache on the workers")
+    parser.add_argument("--submit-dir", metavar="STR", type=str, default="./submit", help="Pegasus submit directory (default: ./submit)")
+    parser.add_argument("--configs", type=str, choices=list(CONFIGS), nargs="+", default=list(CONFIGS), help="Configurations to run (default: all)")
+
+    args = parser.parse_args()
+
+    results = {name: run(name, CONFIGS[name], args) for name in args.configs}
+
+    print(f"{args.lag} ingest days of both datastreams")
+    for name, (makespan, stats) in results.items():
+        print(f"    {name:<10} makespan {makespan:8.1f}s  " + "  ".join(f"{k.lower()}: {v}" for k, v in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+Cold-start benchmark of the ingest executables.
+
+For every executable this loads the module the way a job does (without running main) under
+`python -X importtime`, and reports the start-up wall time and the import time per top-level
+package. The packages imported lazily by the ingest stages are measured separately, so the
+cost of each stage is visible too.
+
+Run it inside the job container to get numbers that match the workflow, for example:
+
+    singularity exec docker://papajim/crocus:latest python3 benchmarks/import_time.py
+"""
+import os
+import sys
+import subprocess
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+from collections import defaultdict
+
+EXECUTABLES_DIR = Path(__file__).parent.parent.resolve() / "executables"
+EXECUTABLES = ["crocus-ingest.py", "aqt-ingest.py", "wxt-ingest.py"]
+
+# packages imported on demand by the ingest stages
+STAGE_MODULES = {"derive": "metpy.calc", "netcdf write": "xarray", "stream write": "netCDF4"}
+
+
+def import_profile(python, code):
+    """
+    Run code in a fresh interpreter with -X importtime.
+    Returns the wall time and the cumulative import time (s) per top-level package.
+    """
+    start = perf_counter()
+    proc = subprocess.run([python, "-X", "importtime", "-c", code],
+                          capture_output=True, text=True, cwd=EXECUTABLES_DIR)
+    wall = perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    packages = defaultdict(float)
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented, only count the ones made by the code itself
+        if not name.startswith("  "):
+            packages[name.strip().split(".")[0]] += int(cumulative) / 1e6
+
+    return wall, packages
+
+
+def report(label, wall, packages, top):
+    print(f"{label}: wall {wall:.3f}s, imports {sum(packages.values()):.3f}s")
+    for name, seconds in sorted(packages.items(), key=lambda kv: -kv[1])[:top]:
+        print(f"    {name:<24} {seconds:8.3f}s")
+
+
+def main():
+    parser = ArgumentParser(description="Start-up time of the CROCUS ingest executables")
+    parser.add_argument("--python", metavar="STR", type=str, default=sys.executable, help="Python interpreter to measure (default: current)")
+    parser.add_argument("--repeat", metavar="INT", type=int, default=3, help="Runs per measurement, the fastest is reported (default: 3)")
+    parser.add_argument("--top", metavar="INT", type=int, default=8, help="Packages listed per measurement (default: 8)")
+
+    args = parser.parse_args()
+
+    def best(code):
+        return min((import_profile(args.python, code) for _ in range(args.repeat)), key=lambda r: r[0])
+
+    wall, packages = best("pass")
+    report("interpreter", wall, packages, args.top)
+
+    for exe in EXECUTABLES:
+        code = f"import sys, runpy; sys.path.insert(0, {str(EXECUTABLES_DIR)!r}); runpy.run_path({exe!r})"
+        wall, packages = best(code)
+        report(exe, wall, packages, args.top)
+
+    for stage, module in STAGE_MODULES.items():
+        wall, packages = best(f"import {module}")
+        report(f"stage {stage} ({module})", wall, packages, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+File size, write time and downstream read time of the netCDF encoding profiles
+(executables/sage_netcdf.py) of the CROCUS a1 outputs.
+
+By default a synthetic day of 10s WXT-like data is used, pass existing a1 files to
+re-encode them instead. Read time covers opening the file and loading every variable,
+which is what the downstream analysis does with a day file.
+"""
+import os
+import sys
+import tempfile
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "executables"))
+import sage_netcdf
+
+
+def synthetic_day(freq="10s"):
+    time = pd.date_range("2024-06-01", periods=int(pd.Timedelta("1D") / pd.Timedelta(freq)), freq=freq, name="time")
+    rng = np.random.default_rng(0)
+    hours = np.arange(time.size) / (pd.Timedelta("1h") / pd.Timedelta(freq))
+
+    # smooth diurnal signals plus sensor noise at the instrument resolution
+    df = pd.DataFrame(index=time)
+    df["temperature"] = np.round(20 + 5 * np.sin(2 * np.pi * hours / 24) + rng.normal(0, 0.2, time.size), 1)
+    df["humidity"] = np.round(60 - 15 * np.sin(2 * np.pi * hours / 24) + rng.normal(0, 1, time.size), 1)
+    df["pressure"] = np.round(1010 + np.cumsum(rng.normal(0, 0.01, time.size)), 1)
+    df["rainfall"] = np.round(np.cumsum(rng.random(time.size) > 0.995) * 0.01, 2)
+    df["dewpoint"] = df["temperature"] - (100 - df["humidity"]) / 5
+    df["wetbulb"] = df["temperature"] - (df["temperature"] - df["dewpoint"]) / 3
+    df["wind_dir_10s"] = rng.uniform(0, 360, time.size)
+    df["wind_mean_10s"] = np.abs(rng.normal(3, 1, time.size))
+    df["wind_max_10s"] = df["wind_mean_10s"] + np.abs(rng.normal(1, 0.5, time.size))
+    df.iloc[rng.integers(0, time.size, time.size // 100)] = np.nan
+    return xr.Dataset.from_dataframe(df)
+
+
+def run(ds, profile, path, stream):
+    start = perf_counter()
+    if stream:
+        with sage_netcdf.NetCDFAppender(path, profile=profile) as out:
+            out.append(ds.to_dataframe())
+    else:
+        sage_netcdf.write(ds, path, profile)
+    write = perf_counter() - start
+
+    start = perf_counter()
+    with xr.open_dataset(path) as read_back:
+        read_back.load()
+    read = perf_counter() - start
+
+    # largest deviation from the source values, lossy profiles trade this for size
+    error = max(float(np.nanmax(np.abs(read_back[v].values - ds[v].values), initial=0)) for v in ds.data_vars)
+    time_exact = bool((read_back["time"].values == ds["time"].values).all())
+    return os.path.getsize(path), write, read, error, time_exact
+
+
+def main():
+    parser = ArgumentParser(description="Size and speed of the netCDF encoding profiles")
+    parser.add_argument("files", metavar="STR", type=str, nargs="*", help="a1 files to re-encode (default: a synthetic WXT day)")
+    parser.add_argument("--repeat", metavar="INT", type=int, default=3, help="Runs per profile, the best one is reported (default: 3)")
+    parser.add_argument("--stream", action="store_true", help="Write through the streaming appender instead of xarray")
+
+    args = parser.parse_args()
+
+    datasets = {f: xr.load_dataset(f) for f in args.files} or {"synthetic wxt day": synthetic_day()}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, ds in datasets.items():
+            print(f"{name}: {ds.sizes['time']} times, {len(ds.data_vars)} variables")
+            baseline = None
+            for profile in sage_netcdf.ENCODING_PROFILES:
+                path = os.path.join(tmp, f"{profile}.nc")
+                runs = [run(ds, profile, path, args.stream) for _ in range(args.repeat)]
+                size, _, _, error, time_exact = runs[0]
+                write = min(r[1] for r in runs)
+                read = min(r[2] for r in runs)
+                baseline = baseline or size
+                print(f"    {profile:<8} {size / 1024:9.1f} KiB ({size / baseline:5.1%})  write {write * 1000:7.1f} ms  "
+                      f"read {read * 1000:7.1f} ms  max error {error:.1e}  time {'exact' if time_exact else 'CHANGED'}")
+
+
+if __name__ == "__main__":
+    main()
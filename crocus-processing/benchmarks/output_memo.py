@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Reuse of the outputs memoized by output_memo.py across replans of the CROCUS workflow.
+
+Each scenario is a sequence of plans over --outputs daily files in a temporary local
+storage directory. After a plan, the outputs it did not reuse are written again, like the
+ingest jobs Pegasus did not prune would. Between plans a scenario deletes, touches or
+rekeys outputs, or plans with --force. The script checks how many outputs every plan
+reuses, and exits with an error when an output that was rewritten is not reused by the
+next plan.
+"""
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+from argparse import ArgumentParser
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from output_memo import OutputMemo
+
+
+def plan(storage, lfns, keys, force=False):
+    """
+    One planning pass, returns the outputs reused and writes the others after it.
+    """
+    memo = OutputMemo(storage, force=force)
+    reused = {lfn for lfn in lfns if memo.lookup(lfn, keys[lfn])}
+    memo.save()
+
+    # the jobs run after the plan, their outputs are newer than it
+    time.sleep(0.02)
+    for lfn in set(lfns) - reused:
+        with open(os.path.join(storage, lfn), "w") as f:
+            f.write(f"{lfn} {keys[lfn]} {time.time()}\n")
+    return reused
+
+
+def delete(storage, lfns, keys):
+    os.remove(os.path.join(storage, lfns[0]))
+
+
+def touch(storage, lfns, keys):
+    os.utime(os.path.join(storage, lfns[0]))
+
+
+def rekey(storage, lfns, keys):
+    keys[lfns[0]] = "changed"
+
+
+SCENARIOS = {
+    "deleted": delete,
+    "touched": touch,
+    "rekeyed": rekey,
+    "forced": None,
+}
+
+
+def run(name, change, n):
+    lfns = [f"crocus-neiu-wxt-a1-202406{day + 1:02d}-000000.nc" for day in range(n)]
+    keys = dict.fromkeys(lfns, "key")
+    with tempfile.TemporaryDirectory() as storage:
+        first = plan(storage, lfns, keys)
+        confirmed = plan(storage, lfns, keys)
+        if change:
+            change(storage, lfns, keys)
+        changed = plan(storage, lfns, keys, force=change is None)
+        after = plan(storage, lfns, keys)
+        again = plan(storage, lfns, keys)
+
+    expected = [0, n, 0 if change is None else n - 1, n, n]
+    got = [len(first), len(confirmed), len(changed), len(after), len(again)]
+    ok = got == expected
+    print(f"{name:<8} reused per plan {' '.join(f'{g:>3}' for g in got)}{'' if ok else f'  expected {expected}'}")
+    return ok
+
+
+def main():
+    parser = ArgumentParser(description="Reuse of memoized outputs across replans")
+    parser.add_argument("--outputs", metavar="INT", type=int, default=10, help="Outputs planned (default: 10)")
+
+    args = parser.parse_args()
+
+    print("plans: first, confirming, after the change, after the rerun, again")
+    ok = all([run(name, change, args.outputs) for name, change in SCENARIOS.items()])
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
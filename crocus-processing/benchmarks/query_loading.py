@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""
+Parse time and memory of Sage query results loaded by sage_query.load (typed, categorical
+name/meta.*, optional column projection) against the frames sage_data_client.load builds.
+
+The responses are synthetic (sage_synthetic.py) fleet hours of --nodes nodes, parsed from
+memory so only the loading is measured. Frame size is the deep memory usage of the result,
+peak is the largest allocation while parsing (tracemalloc, in a separate run). The script
+exits with an error when the typed frames do not hold the same data, or when a response in
+the format of the query API (API_RESPONSE) does not load like sage_data_client loads it.
+"""
+import io
+import sys
+import tracemalloc
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+
+import numpy as np
+import sage_data_client
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "executables"))
+import sage_query
+import sage_synthetic
+
+PROJECTION = ["timestamp", "name", "value", "meta.vsn", "meta.sensor"]
+
+# records as data.sagecontinuum.org/api/v1/query returns them: RFC3339 timestamps with up to
+# nanosecond fractions, numbers and strings as values, meta fields varying between records
+API_RESPONSE = b"""\
+{"timestamp":"2024-06-01T00:00:00.123456789Z","name":"wxt.env.temp","value":18.4,"meta":{"host":"0000dca632d7c1e5.ws-rpi","node":"000048b02d15bc7c","plugin":"registry.sagecontinuum.org/jrobrien/waggle-wxt536:0.23.5.04","sensor":"vaisala-wxt536","vsn":"W08D"}}
+{"timestamp":"2024-06-01T00:00:01Z","name":"wxt.env.temp","value":18.5,"meta":{"host":"0000dca632d7c1e5.ws-rpi","node":"000048b02d15bc7c","plugin":"registry.sagecontinuum.org/jrobrien/waggle-wxt536:0.23.5.04","sensor":"vaisala-wxt536","vsn":"W08D"}}
+{"timestamp":"2024-06-01T00:00:02.5Z","name":"sys.uptime","value":86402,"meta":{"host":"0000dca632d7c1e5.ws-nxcore","node":"000048b02d15bc7c","vsn":"W08D"}}
+"""
+
+LOADERS = {
+    "sage_data_client": lambda body: sage_data_client.load(io.BytesIO(body)),
+    "typed": lambda body: sage_query.load(io.BytesIO(body)),
+    "typed projected": lambda body: sage_query.load(io.BytesIO(body), PROJECTION),
+}
+
+
+def response(nodes, hours, scale):
+    data = sage_synthetic.SyntheticSage(scale=scale, nodes=nodes)
+    return b"".join(data.query("2024-06-01T00:00:00Z", f"2024-06-01T{hours:02d}:00:00Z"))
+
+
+def check(typed, reference):
+    if list(typed.columns) != list(reference.columns) or len(typed) != len(reference):
+        print(f"    columns/rows differ: {list(typed.columns)} {len(typed)} != {list(reference.columns)} {len(reference)}")
+        return False
+    ok = (typed["timestamp"] == reference["timestamp"]).all()
+    ok &= np.allclose(typed["value"].to_numpy(dtype=float), reference["value"].to_numpy(dtype=float))
+    for c in typed.columns:
+        if c not in ("timestamp", "value"):
+            # meta fields missing from a record are NaN in both frames
+            ok &= (typed[c].astype(object).fillna("") == reference[c].astype(object).fillna("")).all()
+    if not ok:
+        print("    typed frame holds different data")
+    return bool(ok)
+
+
+def check_api_format():
+    typed, reference = sage_query.load(io.BytesIO(API_RESPONSE)), sage_data_client.load(io.BytesIO(API_RESPONSE))
+    print(f"API format: {len(typed)} records, timestamps {typed['timestamp'].dtype}")
+    return check(typed, reference)
+
+
+def measure(load, body):
+    start = perf_counter()
+    df = load(body)
+    parse = perf_counter() - start
+
+    tracemalloc.start()
+    load(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return df, parse, df.memory_usage(deep=True).sum(), peak
+
+
+def main():
+    parser = ArgumentParser(description="Typed query result loading against sage_data_client")
+    parser.add_argument("--nodes", metavar="INT", type=int, nargs="+", default=[1, 10, 50], help="Node counts of the responses (default: 1 10 50)")
+    parser.add_argument("--hours", metavar="INT", type=int, default=1, help="Hours per response (default: 1)")
+    parser.add_argument("--scale", metavar="FLOAT", type=float, default=1.0, help="Sampling rate multiplier (default: 1.0)")
+
+    args = parser.parse_args()
+
+    ok = check_api_format()
+    for nodes in args.nodes:
+        body = response(nodes, args.hours, args.scale)
+        records = body.count(b"\n")
+        print(f"{nodes} nodes, {records} records, {len(body) / 1024**2:.1f} MiB of JSON")
+
+        results = {name: measure(load, body) for name, load in LOADERS.items()}
+        reference = results["sage_data_client"][0]
+        ok &= check(results["typed"][0], reference)
+        ok &= check(results["typed projected"][0], reference[PROJECTION])
+
+        base = results["sage_data_client"]
+        for name, (df, parse, size, peak) in results.items():
+            print(f"    {name:<17} parse {parse:6.2f}s ({base[1] / parse:4.1f}x)  frame {size / 1024**2:7.1f} MiB "
+                  f"({base[2] / size:4.1f}x smaller)  peak {peak / 1024**2:7.1f} MiB")
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
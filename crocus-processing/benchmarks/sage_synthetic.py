@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic Sage records and a local HTTP stand-in for the Beehive query API.
+
+Records look like what sage_data_client.query returns for the CROCUS node (WXT536 and AQT580
+channels on W08D, or on the first --crocus-nodes nodes) and for a fleet of nodes (BME280/BME680 temperatures and RG-15 rain gauges):
+timestamp, name, value and the meta.* fields (vsn, node, plugin, sensor, ...). Values follow
+a diurnal cycle plus sensor noise, channels of one instrument share timestamps with a small
+jitter, and records go missing at random (--drop) and in node outages (--outages per day).
+--scale multiplies the sampling rate of every instrument.
+
+Records are generated per UTC day, seeded by the day and channel, and cut to the window of the
+query, so any window returns the same values for the same instants. Timestamps are RFC3339
+strings with nanoseconds, like the query API sends. The stand-in answers POSTs the way the
+query API does (JSON query with start, end, a filter of regular expressions and optionally
+the count aggregation, gzip compressed newline delimited JSON back):
+
+    sage_synthetic.py --port 8123 --scale 10 --nodes 20 &
+    SAGE_QUERY_ENDPOINT=http://localhost:8123/api/v1/query SAGE_CACHE_DIR= ./wxt-ingest.py --date 2024-06-01
+"""
+import re
+import sys
+import gzip
+import json
+import threading
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+CROCUS_VSN = "W08D"
+
+WXT_PLUGIN = "registry.sagecontinuum.org/jrobrien/waggle-wxt536:0.23.5.04"
+AQT_PLUGIN = "registry.sagecontinuum.org/jrobrien/waggle-aqt:0.23.5.04"
+IIO_PLUGIN = "waggle/plugin-iio:0.4.5"
+RAINGAUGE_PLUGIN = "waggle/plugin-raingauge:0.4.1"
+
+# channel models: (kind, base, amplitude, noise)
+#   diurnal:      base + amplitude * daily sine (peak mid afternoon) + noise
+#   positive:     diurnal, clipped at 0
+#   accumulation: base + amplitude * fraction of the day elapsed, never decreasing
+#   direction:    base + amplitude * daily sine + noise, wrapped to 0-360
+INSTRUMENTS = [
+    {"plugin": WXT_PLUGIN, "sensor": "vaisala-wxt536", "task": "wxt536", "period": 30, "crocus": True, "channels": {
+        "wxt.env.temp": ("diurnal", 20.0, 5.0, 0.2),
+        "wxt.env.humidity": ("diurnal", 60.0, -15.0, 1.0),
+        "wxt.env.pressure": ("diurnal", 1010.0, 1.5, 0.1),
+        "wxt.rain.accumulation": ("accumulation", 0.0, 2.5, 0.0),
+    }},
+    {"plugin": WXT_PLUGIN, "sensor": "vaisala-wxt536", "task": "wxt536", "period": 30, "crocus": True, "channels": {
+        "wxt.wind.speed": ("positive", 3.0, 1.5, 0.8),
+        "wxt.wind.direction": ("direction", 180.0, 90.0, 30.0),
+    }},
+    {"plugin": AQT_PLUGIN, "sensor": "aqt580", "task": "aqt", "period": 60, "crocus": True, "channels": {
+        "aqt.particle.pm2.5": ("positive", 9.0, 3.0, 1.0),
+        "aqt.particle.pm1": ("positive", 6.0, 2.0, 0.7),
+        "aqt.particle.pm10": ("positive", 14.0, 4.0, 1.5),
+        "aqt.gas.no": ("positive", 0.01, -0.005, 0.002),
+        "aqt.gas.ozone": ("positive", 0.03, 0.015, 0.003),
+        "aqt.gas.no2": ("positive", 0.02, -0.008, 0.003),
+        "aqt.gas.co": ("positive", 0.3, -0.1, 0.03),
+        "aqt.env.temp": ("diurnal", 21.0, 5.0, 0.3),
+        "aqt.env.humidity": ("diurnal", 58.0, -14.0, 1.2),
+        "aqt.env.pressure": ("diurnal", 1010.0, 1.5, 0.1),
+    }},
+    {"plugin": IIO_PLUGIN, "sensor": "bme280", "task": "iio-enclosure", "period": 30, "crocus": False, "channels": {
+        "env.temperature": ("diurnal", 28.0, 6.0, 0.1),
+        "env.relative_humidity": ("diurnal", 35.0, -10.0, 0.5),
+        "env.pressure": ("diurnal", 101000.0, 150.0, 10.0),
+    }},
+    {"plugin": IIO_PLUGIN, "sensor": "bme680", "task": "iio-nx", "period": 30, "crocus": False, "channels": {
+        "env.temperature": ("diurnal", 20.0, 5.0, 0.1),
+        "env.relative_humidity": ("diurnal", 60.0, -15.0, 0.5),
+        "env.pressure": ("diurnal", 101000.0, 150.0, 10.0),
+    }},
+    {"plugin": RAINGAUGE_PLUGIN, "sensor": "rg-15", "task": "raingauge", "period": 30, "crocus": False, "channels": {
+        "env.raingauge.acc": ("accumulation", 0.0, 0.5, 0.0),
+        "env.raingauge.event_acc": ("accumulation", 0.0, 1.0, 0.0),
+        "env.raingauge.total_acc": ("accumulation", 120.0, 2.0, 0.0),
+        "env.raingauge.rint": ("positive", 0.2, 0.2, 0.05),
+    }},
+]
+
+DAY_NS = 86400 * 10**9
+
+
+def vsns(nodes):
+    """
+    The CROCUS node first, then made up VSNs for the rest of the fleet.
+    """
+    return [CROCUS_VSN] + [f"W{0x100 + i:03X}" for i in range(1, nodes)]
+
+
+def _time_ns(t):
+    ts = pd.Timestamp(t)
+    ts = ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+    return ts.value
+
+
+class SyntheticSage():
+    def __init__(self, scale=1.0, nodes=1, drop=0.01, outages=1, outage_minutes=20, jitter=0.2, seed=0, crocus_nodes=1):
+        self.scale = scale
+        self.nodes = vsns(nodes)
+        self.crocus_nodes = self.nodes[:crocus_nodes]
+        self.drop = drop
+        self.outages = outages
+        self.outage_ns = int(outage_minutes * 60e9)
+        self.jitter_ns = int(jitter * 1e9)
+        self.seed = seed
+
+        self.streams = []
+        for n, vsn in enumerate(self.nodes):
+            for i, instrument in enumerate(INSTRUMENTS):
+                if instrument["crocus"] and vsn not in self.crocus_nodes:
+                    continue
+                meta = {"host": f"000048b02d{0x15 + n:06x}.ws-nxcore", "job": "sage", "node": f"000048b02d{0x15 + n:06x}",
+                        "plugin": instrument["plugin"], "sensor": instrument["sensor"], "task": instrument["task"],
+                        "vsn": vsn, "zone": "core"}
+                self.streams.append((n, i, instrument, meta))
+
+    def _outage_mask(self, n, t):
+        keep = np.ones(t.size, dtype=bool)
+        if not self.outages or t.size == 0:
+            return keep
+        for day in range(t[0] // DAY_NS, t[-1] // DAY_NS + 1):
+            rng = np.random.default_rng([self.seed, n, day])
+            for start in day * DAY_NS + rng.integers(0, DAY_NS, self.outages):
+                keep &= (t < start) | (t >= start + self.outage_ns)
+        return keep
+
+    def _timestamps(self, n, i, period_ns, day):
+        """
+        Timestamps of stream (n, i) on a UTC day, the same whatever window is queried.
+        """
+        day_start = day * DAY_NS
+        first = -(-day_start // period_ns) * period_ns
+        t = np.arange(first, day_start + DAY_NS, period_ns, dtype=np.int64)
+        rng = np.random.default_rng([self.seed, n, i, day])
+        keep = (rng.random(t.size) >= self.drop) & self._outage_mask(n, t)
+        t = t[keep]
+        if self.jitter_ns:
+            t = np.clip(t + rng.integers(0, self.jitter_ns, t.size), day_start, day_start + DAY_NS - 1)
+        return t
+
+    def _values(self, model, t, rng):
+        kind, base, amplitude, noise = model
+        day_fraction = (t % DAY_NS) / DAY_NS
+        if kind == "accumulation":
+            return np.round(base + amplitude * day_fraction, 2)
+
+        values = base + amplitude * np.sin(2 * np.pi * (day_fraction - 0.375)) + rng.normal(0, noise, t.size)
+        if kind == "direction":
+            return np.round(values % 360, 1)
+        if kind == "positive":
+            values = np.maximum(values, 0)
+        return np.round(values, 4)
+
+    def query(self, start, end, filter=None, count=None):
+        """
+        Yield the records of a query as lines of newline delimited JSON (bytes). With count
+        (seconds), the records of every channel are counted in buckets of that length since
+        the epoch instead, like the count aggregation of the query API.
+        """
+        start, end = _time_ns(start), _time_ns(end)
+        patterns = {k: re.compile(v) for k, v in (filter or {}).items()}
+
+        for n, i, instrument, meta in self.streams:
+            if any(k != "name" and not p.fullmatch(str(meta.get(k, ""))) for k, p in patterns.items()):
+                continue
+            names = [name for name in instrument["channels"] if "name" not in patterns or patterns["name"].fullmatch(name)]
+            if not names:
+                continue
+
+            # whole UTC days are generated, seeded by the day and channel, then cut to the window
+            period_ns = int(instrument["period"] / self.scale * 1e9)
+            suffix = ',"meta":' + json.dumps(meta) + "}\n"
+            for day in range(start // DAY_NS, -(-end // DAY_NS)):
+                t = self._timestamps(n, i, period_ns, day)
+                window = (t >= start) & (t < end)
+                if not window.any():
+                    continue
+                if count:
+                    buckets, counts = np.unique(t[window] // int(count * 1e9) * int(count * 1e9), return_counts=True)
+                    stamps = np.datetime_as_string(buckets.astype("datetime64[ns]"), unit="ns").tolist()
+                    for name in names:
+                        prefix = '","name":"' + name + '","value":'
+                        yield "".join([f'{{"timestamp":"{ts}Z{prefix}{v}{suffix}' for ts, v in zip(stamps, counts.tolist())]).encode()
+                    continue
+                # RFC3339 with nanoseconds, like the query API
+                stamps = np.datetime_as_string(t[window].astype("datetime64[ns]"), unit="ns").tolist()
+                for name in names:
+                    c = list(instrument["channels"]).index(name)
+                    rng = np.random.default_rng([self.seed, n, i, day, c])
+                    values = self._values(instrument["channels"][name], t, rng)[window]
+                    prefix = '","name":"' + name + '","value":'
+                    yield "".join([f'{{"timestamp":"{ts}Z{prefix}{v}{suffix}' for ts, v in zip(stamps, values.tolist())]).encode()
+
+
+class StandIn(ThreadingHTTPServer):
+    """
+    Beehive query API stand-in serving a SyntheticSage, counts requests, records and bytes.
+    """
+    def __init__(self, data, port=0):
+        super().__init__(("localhost", port), StandInHandler)
+        self.data = data
+        self.requests = 0
+        self.records = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://localhost:{self.server_port}/api/v1/query"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        q = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        end = q.get("end") or pd.Timestamp.now(tz="UTC")
+        count = pd.Timedelta(q.get("experimental_window", "1m")).total_seconds() if q.get("experimental_func") == "count" else None
+        body = b"".join(self.server.data.query(q["start"], end, q.get("filter"), count))
+        records = body.count(b"\n")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.records += records
+            self.server.bytes += len(body)
+
+
+def main():
+    parser = ArgumentParser(description="Serve synthetic Sage records on a local query API stand-in, or write them to a file")
+    parser.add_argument("--port", metavar="INT", type=int, default=8123, help="Port of the stand-in (default: 8123)")
+    parser.add_argument("--scale", metavar="FLOAT", type=float, default=1.0, help="Sampling rate multiplier of every instrument (default: 1.0)")
+    parser.add_argument("--nodes", metavar="INT", type=int, default=1, help="Number of nodes, the first is the CROCUS node W08D (default: 1)")
+    parser.add_argument("--crocus-nodes", metavar="INT", type=int, default=1, help="Number of nodes, from the first, that carry the WXT536 and AQT580 (default: 1)")
+    parser.add_argument("--drop", metavar="FLOAT", type=float, default=0.01, help="Share of records missing at random (default: 0.01)")
+    parser.add_argument("--outages", metavar="INT", type=int, default=1, help="Node outages per day (default: 1)")
+    parser.add_argument("--outage-minutes", metavar="FLOAT", type=float, default=20, help="Length of an outage in minutes (default: 20)")
+    parser.add_argument("--seed", metavar="INT", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--output", metavar="STR", type=str, default=None, help="Write the records of --start to --end to this ndjson file instead of serving")
+    parser.add_argument("--start", metavar="STR", type=str, default=None, help="Start of the written records (example: '2024-06-01T00:00:00Z')")
+    parser.add_argument("--end", metavar="STR", type=str, default=None, help="End of the written records")
+
+    args = parser.parse_args()
+
+    data = SyntheticSage(scale=args.scale, nodes=args.nodes, drop=args.drop, outages=args.outages,
+                         outage_minutes=args.outage_minutes, seed=args.seed, crocus_nodes=args.crocus_nodes)
+
+    if args.output:
+        if not args.start or not args.end:
+            parser.error("--output needs --start and --end")
+        with open(args.output, "wb") as f:
+            for chunk in data.query(args.start, args.end):
+                f.write(chunk)
+        return
+
+    server = StandIn(data, args.port)
+    print(f"Serving {len(data.nodes)} nodes at {args.scale}x on {server.url}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
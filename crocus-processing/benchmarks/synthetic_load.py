@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+Wall time, peak RSS and output size of the executables that query Beehive, run against the
+synthetic query API stand-in of sage_synthetic.py at increasing data volume.
+
+Every executable runs as a job would, in its own process and working directory, with
+SAGE_QUERY_ENDPOINT pointing at the stand-in and the query cache disabled. crocus-ingest.py,
+aqt-ingest.py and wxt-ingest.py process one day of the --crocus-nodes CROCUS nodes (crocus-ingest.py
+all datastreams, the WXT summaries included, from one query), temperature_stats.py and raingauge_totals.py
+a --window-hours window across --nodes nodes. --scale multiplies the sampling rate.
+
+Every executable writes its per-phase metrics to metrics/<executable>.metrics.jsonl, the
+nested layout of the Beehive workflow, and a run without them fails.
+
+--save writes the results as JSON, --baseline compares against such a file and the script
+exits with an error when an executable fails, or its wall time or peak RSS grew past
+--tolerance, so regressions show up before they reach production.
+"""
+import os
+import sys
+import json
+import subprocess
+import tempfile
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import sage_synthetic
+
+CROCUS_DIR = Path(__file__).resolve().parent.parent / "executables"
+BEEHIVE_DIR = Path(__file__).resolve().parent.parent.parent / "beehive-cloud-processing" / "executables"
+
+# changes smaller than this many seconds are noise, whatever the tolerance
+WALL_SLACK = 0.5
+
+
+def commands(date, window_hours, crocus_vsns=("W08D",)):
+    day = pd.Timestamp(date, tz="UTC")
+    start = day.strftime("%Y-%m-%dT%H:%M:%SZ")
+    end = (day + pd.Timedelta(hours=window_hours)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    cmds = {
+        "crocus-ingest": [CROCUS_DIR / "crocus-ingest.py", "--date", date, "--vsn", *crocus_vsns],
+        "aqt-ingest": [CROCUS_DIR / "aqt-ingest.py", "--date", date, "--vsn", *crocus_vsns],
+        "wxt-ingest": [CROCUS_DIR / "wxt-ingest.py", "--date", date, "--vsn", *crocus_vsns],
+        "temperature_stats": [BEEHIVE_DIR / "temperature_stats.py", "--start", start, "--end", end, "--output", "temperature.csv"],
+        "raingauge_totals": [BEEHIVE_DIR / "raingauge_totals.py", "--start", start, "--end", end, "--output", "raingauge.csv"],
+    }
+    return {name: cmd + ["--metrics", metrics_file(name)] for name, cmd in cmds.items()}
+
+
+def metrics_file(name):
+    return f"metrics/{name}.metrics.jsonl"
+
+
+def run(cmd, server, python):
+    """
+    Run cmd in a fresh directory, returns wall time, peak RSS (MiB), output bytes, records and
+    requests served and the exit status. The run fails when it wrote no metrics.
+    """
+    env = dict(os.environ, SAGE_QUERY_ENDPOINT=server.url, SAGE_CACHE_DIR="")
+    served, requests = server.records, server.requests
+    with tempfile.TemporaryDirectory() as work:
+        start = perf_counter()
+        proc = subprocess.Popen([python] + [str(c) for c in cmd], cwd=work, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.stdout.read()
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        size = sum(p.stat().st_size for p in Path(work).iterdir() if p.is_file())
+        metrics = Path(work, cmd[cmd.index("--metrics") + 1])
+        metrics = metrics.is_file() and metrics.stat().st_size > 0
+
+    ok = proc.returncode == 0 and size > 0 and metrics
+    if not ok:
+        print(output.decode(errors="replace")[-2000:])
+    return {"wall": wall, "rss": usage.ru_maxrss / 1024, "bytes": size, "records": server.records - served,
+            "requests": server.requests - requests, "ok": ok}
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for key, r in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if r["wall"] > base["wall"] * (1 + tolerance) + WALL_SLACK:
+            found.append(f"{key}: wall {base['wall']:.2f}s -> {r['wall']:.2f}s")
+        if r["rss"] > base["rss"] * (1 + tolerance):
+            found.append(f"{key}: peak RSS {base['rss']:.0f} -> {r['rss']:.0f} MiB")
+    return found
+
+
+def main():
+    parser = ArgumentParser(description="Executables against a synthetic Beehive at increasing data volume")
+    parser.add_argument("--scales", metavar="FLOAT", type=float, nargs="+", default=[1, 10, 100], help="Sampling rate multipliers (default: 1 10 100)")
+    parser.add_argument("--nodes", metavar="INT", type=int, default=10, help="Nodes in the fleet queries (default: 10)")
+    parser.add_argument("--crocus-nodes", metavar="INT", type=int, default=1, help="Nodes, from the first, with the CROCUS instruments the ingest executables process (default: 1)")
+    parser.add_argument("--window-hours", metavar="FLOAT", type=float, default=1.0, help="Window of the fleet queries in hours (default: 1.0)")
+    parser.add_argument("--date", metavar="STR", type=str, default="2024-06-01", help="Day the ingest executables process (default: 2024-06-01)")
+    parser.add_argument("--executables", type=str, nargs="+", default=None, help="Subset of crocus-ingest, aqt-ingest, wxt-ingest, temperature_stats, raingauge_totals (default: all)")
+    parser.add_argument("--python", metavar="STR", type=str, default=sys.executable, help="Python interpreter the executables run with (default: current)")
+    parser.add_argument("--save", metavar="STR", type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", metavar="STR", type=str, default=None, help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", metavar="FLOAT", type=float, default=0.25, help="Allowed relative growth of wall time and peak RSS over the baseline (default: 0.25)")
+
+    args = parser.parse_args()
+
+    crocus_vsns = sage_synthetic.vsns(args.crocus_nodes)
+    cmds = commands(args.date, args.window_hours, crocus_vsns)
+    names = args.executables or list(cmds)
+    unknown = set(names) - set(cmds)
+    if unknown:
+        parser.error(f"unknown executables: {', '.join(sorted(unknown))}")
+
+    server = sage_synthetic.StandIn(None).start()
+    results = {}
+    print(f"{'executable':<18} {'scale':>6} {'requests':>8} {'records':>10} {'wall':>9} {'peak RSS':>10} {'output':>10}")
+    for scale in args.scales:
+        server.data = sage_synthetic.SyntheticSage(scale=scale, nodes=max(args.nodes, args.crocus_nodes), crocus_nodes=args.crocus_nodes)
+        for name in names:
+            r = run(cmds[name], server, args.python)
+            results[f"{name}@{scale:g}x"] = r
+            print(f"{name:<18} {scale:>5g}x {r['requests']:>8} {r['records']:>10} {r['wall']:>8.2f}s {r['rss']:>6.0f} MiB {r['bytes'] / 1024:>6.0f} KiB"
+                  f"{'' if r['ok'] else '  FAILED'}")
+    server.shutdown()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    failed = [key for key, r in results.items() if not r["ok"]]
+    found = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"regression {line}")
+
+    if failed or found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
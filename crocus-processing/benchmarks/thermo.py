@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Accuracy regression and throughput of the vectorized dewpoint / wet-bulb kernels
+(executables/sage_thermo.py) against MetPy, the reference used by wxt-ingest --thermo metpy.
+
+Accuracy is checked on a grid of surface conditions covering what the CROCUS WXT/AQT
+instruments report. The script exits with an error when a kernel drifts past its tolerance.
+"""
+import sys
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+
+import numpy as np
+from metpy.units import units
+import metpy.calc as mpcalc
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "executables"))
+import sage_thermo
+
+# max abs difference to MetPy in degC, None only reports the error
+TOLERANCES = {"dewpoint": 1e-6, "normand": 1e-3, "stull": None}
+
+
+def condition_grid(n):
+    pressure, temperature, humidity = np.meshgrid(np.linspace(950, 1050, n),
+                                                  np.linspace(-30, 45, n),
+                                                  np.linspace(5, 100, n))
+    return pressure.ravel(), temperature.ravel(), humidity.ravel()
+
+
+def accuracy(n):
+    p, t, rh = condition_grid(n)
+    td_ref = mpcalc.dewpoint_from_relative_humidity(t * units.degC, rh * units.percent).m_as(units.degC)
+    wb_ref = mpcalc.wet_bulb_temperature(p * units.hPa, t * units.degC, td_ref * units.degC).m_as(units.degC)
+
+    errors = {"dewpoint": np.abs(sage_thermo.dewpoint_from_relative_humidity(t, rh) - td_ref)}
+    for method in sage_thermo.WETBULB_METHODS:
+        errors[method] = np.abs(sage_thermo.wet_bulb_temperature(p, t, td_ref, method=method) - wb_ref)
+
+    failed = False
+    print(f"accuracy over {p.size} points (p 950-1050 hPa, T -30-45 degC, RH 5-100%)")
+    for name, err in errors.items():
+        tolerance = TOLERANCES[name]
+        status = "" if tolerance is None else ("ok" if err.max() <= tolerance else "FAIL")
+        failed |= status == "FAIL"
+        print(f"    {name:<10} max {err.max():.2e}  mean {err.mean():.2e}  {status}")
+    return not failed
+
+
+def throughput(sizes, metpy_max):
+    rng = np.random.default_rng(0)
+    print("throughput (points/s)")
+    for size in sizes:
+        p = rng.uniform(980, 1030, size)
+        t = rng.uniform(-20, 35, size)
+        rh = rng.uniform(20, 100, size)
+        td = sage_thermo.dewpoint_from_relative_humidity(t, rh)
+
+        rates = {}
+        for method in sage_thermo.WETBULB_METHODS:
+            start = perf_counter()
+            sage_thermo.wet_bulb_temperature(p, t, td, method=method)
+            rates[method] = size / (perf_counter() - start)
+
+        if size <= metpy_max:
+            start = perf_counter()
+            mpcalc.wet_bulb_temperature(p * units.hPa, t * units.degC, td * units.degC)
+            rates["metpy"] = size / (perf_counter() - start)
+
+        print(f"    {size:>9}  " + "  ".join(f"{k} {v:12.0f}" for k, v in rates.items()))
+
+
+def main():
+    parser = ArgumentParser(description="Vectorized thermo kernels against MetPy")
+    parser.add_argument("--grid", metavar="INT", type=int, default=12, help="Points per axis of the accuracy grid (default: 12)")
+    parser.add_argument("--sizes", metavar="INT", type=int, nargs="+", default=[1000, 8640, 100000, 1000000], help="Array sizes for the throughput runs (8640 is a day of 10s data)")
+    parser.add_argument("--metpy-max", metavar="INT", type=int, default=8640, help="Largest size also run through MetPy (default: 8640)")
+
+    args = parser.parse_args()
+
+    ok = accuracy(args.grid)
+    throughput(args.sizes, args.metpy_max)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+Month-range read latency of the CROCUS Zarr stores (executables/sage_zarr.py) against the
+per-day netCDF files, on a month ingested from the synthetic Beehive stand-in.
+
+crocus-ingest.py writes --days days of the --datastreams of W08D with --zarr, so both
+layouts hold the same data. Every read then loads the whole range: the netCDF side opens and
+concatenates the daily files like a multi-month analysis does, the Zarr side reads the days
+of the range from the store. Reads run --repeat times, the median is reported (warm page
+cache). The script exits with an error when the two reads differ.
+"""
+import os
+import sys
+import subprocess
+import tempfile
+from time import perf_counter
+from pathlib import Path
+from statistics import median
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import sage_synthetic
+
+CROCUS_DIR = Path(__file__).resolve().parent.parent / "executables"
+sys.path.insert(0, str(CROCUS_DIR))
+import sage_zarr
+import sage_nodes
+from crocus_datastreams import DATASTREAMS
+
+
+def read_netcdf(files):
+    datasets = []
+    for f in files:
+        with xr.open_dataset(f) as ds:
+            datasets.append(ds.load())
+    return xr.concat(datasets, "time")
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        result = fn()
+        times.append(perf_counter() - start)
+    return median(times), result
+
+
+def size(path):
+    path = Path(path)
+    return path.stat().st_size if path.is_file() else sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def compare(args, work, start, end):
+    """
+    Ingest into work and compare the reads of both layouts, returns the datastreams that differ.
+    """
+    server = sage_synthetic.StandIn(sage_synthetic.SyntheticSage(scale=args.scale)).start()
+    env = dict(os.environ, SAGE_QUERY_ENDPOINT=server.url, SAGE_CACHE_DIR="")
+
+    print(f"Ingesting {args.days} days of {' '.join(args.datastreams)} into {work}")
+    ingest_start = perf_counter()
+    proc = subprocess.run([sys.executable, str(CROCUS_DIR / "crocus-ingest.py"), "--date", args.date, "--days", str(args.days),
+                           "--datastreams", *args.datastreams, "--zarr", "stores"],
+                          cwd=work, env=env, capture_output=True, text=True)
+    server.shutdown()
+    if proc.returncode != 0:
+        print(proc.stdout[-2000:] + proc.stderr[-2000:])
+        sys.exit(1)
+    print(f"Ingest took {perf_counter() - ingest_start:.1f}s")
+
+    print(f"{'datastream':<12} {'rows':>8} {'netcdf':>9} {'zarr':>9} {'speedup':>8} {'files MB':>9} {'store MB':>9}")
+    failed = []
+    for name in args.datastreams:
+        spec = DATASTREAMS[name]
+        days = pd.date_range(start, end, inclusive="left")
+        files = [os.path.join(work, sage_nodes.output_name("W08D", spec["instrument"], day, spec.get("product"), spec.get("datalevel", "a1")))
+                 for day in days]
+        files = [f for f in files if os.path.exists(f)]
+        store = os.path.join(work, "stores", sage_zarr.store_name(os.path.basename(files[0])))
+
+        nc_time, nc = timed(lambda: read_netcdf(files), args.repeat)
+        zarr_time, z = timed(lambda: sage_zarr.read(store, start, end), args.repeat)
+
+        same = (nc.sizes["time"] == z.sizes["time"] and (nc.time.values == z.time.values).all()
+                and all(np.array_equal(nc[v].values, z[v].values, equal_nan=True) for v in nc.data_vars))
+        if not same:
+            failed.append(name)
+        print(f"{name:<12} {z.sizes['time']:>8} {nc_time:>8.3f}s {zarr_time:>8.3f}s {nc_time / zarr_time:>7.1f}x "
+              f"{sum(size(f) for f in files) / 2**20:>9.1f} {size(store) / 2**20:>9.1f}{'' if same else '  DIFFERENT'}")
+
+    return failed
+
+
+def main():
+    parser = ArgumentParser(description="Month-range reads of the Zarr stores against the daily netCDF files")
+    parser.add_argument("--date", metavar="STR", type=str, default="2024-06-01", help="First day ingested (default: 2024-06-01)")
+    parser.add_argument("--days", metavar="INT", type=int, default=30, help="Days ingested and read (default: 30)")
+    parser.add_argument("--datastreams", type=str, nargs="+", choices=list(DATASTREAMS), default=["wxt", "wxt-1h"], help="Datastreams compared (default: wxt wxt-1h)")
+    parser.add_argument("--scale", metavar="FLOAT", type=float, default=1.0, help="Sampling rate multiplier of the stand-in (default: 1.0)")
+    parser.add_argument("--repeat", metavar="INT", type=int, default=5, help="Reads per layout, the median is reported (default: 5)")
+    parser.add_argument("--keep", metavar="STR", type=str, default=None, help="Ingest into this directory and keep it (default: a temporary directory)")
+
+    args = parser.parse_args()
+    start = pd.Timestamp(args.date)
+    end = start + pd.Timedelta(days=args.days)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work = args.keep or tmp
+        os.makedirs(work, exist_ok=True)
+        failed = compare(args, work, start, end)
+
+    if failed:
+        print(f"Zarr reads differ from the netCDF files: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
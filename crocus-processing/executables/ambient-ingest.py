@@ -1,19 +1,26 @@
 #!/usr/bin/env python3
 
 from ambient_api.ambientapi import AmbientAPI
-import numpy as np
-from datetime import datetime, timedelta
+import os
+import sys
 import time
+import random
+import threading
+import requests
+import sage_metrics
 import pandas as pd
-import xarray as xr
-import os
-from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from argparse import ArgumentParser
+
+# xarray is imported by the dataset stage, so start-up only pays for what the job actually runs.
 
-print(os.getenv('AMBIENT_ENDPOINT'))
+# ambient_api uses its own endpoint whenever the keys are set, AMBIENT_ENDPOINT (a local
+# stand-in for example) is applied after creating the client
+DEFAULT_ENDPOINT = "https://rt.ambientweather.net/v1"
 
-# Access the Ambient weather API and get the devices available
-api = AmbientAPI()
-devices = api.get_devices()
+# 5 minute records, one day per request
+RECORDS_PER_DAY = 288
 
 attrs_dict = {'tempf':{'standard_name': 'Temperature',
                        'units': 'degF'},
@@ -27,18 +34,136 @@ variable_mapping = {'tempf':'outdoor_temperature',
 station_remapping = {'CMS-AMB-001':'atmos-g1',
                      'CMS-AMB-004':'atmos-g2'}
 
-def process_station(device, attrs=attrs_dict, variable_mapping=variable_mapping):
-    
-    current_date = datetime.utcnow() - timedelta(days=1)
-    # Read in the station data
-    data = device.get_data(end_date = current_date)
-    
-    meta = device.info
-    
+
+def read_creds(path):
+    """
+    {name: value} of the KEY=value lines of a credentials file, blank and # lines skipped.
+    """
+    creds = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                name, _, value = line.partition("=")
+                creds[name.strip()] = value.strip()
+    return creds
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class TokenBucket():
+    """
+    Lets rate requests per second through on average, and bursts of up to burst requests.
+    Shared by the fetching threads, so together they stay under the API limit.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        No requests for seconds, after the API said we are going too fast.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class RateLimitedClient():
+    """
+    Takes the place of requests as the http_client of AmbientAPI. Every request waits for the
+    token bucket, 429 and 5xx answers and connection errors are retried with exponential
+    backoff (or Retry-After), and raise RateLimitError once the retries are used up instead
+    of ending up as empty results.
+    """
+    def __init__(self, bucket, retries=5, backoff=2.0, timeout=60):
+        self.bucket = bucket
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+
+    def _session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _delay(self, attempt, res):
+        retry_after = res.headers.get("Retry-After") if res is not None else None
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            # full jitter, so threads that were limited together do not retry together
+            return self.backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+
+    def get(self, url, params=None, **kwargs):
+        status = None
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            with self.lock:
+                self.requests += 1
+            try:
+                res = self._session().get(url, params=params, timeout=self.timeout, **kwargs)
+                status = res.status_code
+                if status != 429 and status < 500:
+                    return res
+            except (requests.ConnectionError, requests.Timeout) as e:
+                res, status = None, type(e).__name__
+
+            if attempt == self.retries:
+                break
+            delay = self._delay(attempt, res)
+            if status == 429:
+                self.bucket.pause(delay)
+            with self.lock:
+                self.retried += 1
+            time.sleep(delay)
+
+        raise RateLimitError(f"{url.rsplit('/', 1)[-1]}: {status} after {self.retries} retries")
+
+
+def station_name(meta):
+    return station_remapping.get(meta['name'], meta['name'].lower())
+
+
+def fetch_station(device, day):
+    """
+    The records of day (UTC midnight to midnight) of one device.
+    """
+    data = device.get_data(end_date=day + timedelta(days=1), limit=RECORDS_PER_DAY)
+    if not data:
+        raise RuntimeError(f"{device.info.get('name')}: no data returned")
+    return data
+
+
+def process_station(data, meta, day, attrs=attrs_dict, variable_mapping=variable_mapping):
+
     # Read into a pandas dataframe
     df = pd.DataFrame(data)
-    print(df)
-    
+
     # Format the times properly
     df['date'] = pd.DatetimeIndex(pd.to_datetime(df.date)).tz_convert('UTC').tz_localize(None).astype('datetime64[ns]')
 
@@ -51,35 +176,92 @@ def process_station(device, attrs=attrs_dict, variable_mapping=variable_mapping)
     # Add associated metadata
     for variable in attrs.keys():
         ds[variable].attrs = attrs[variable]
-    
+
     # Rename the variables
     ds = ds.rename(variable_mapping)
-        
+
     # Reshape the data
     ds = ds.expand_dims('station')
-    ds['station'] = [station_remapping[meta['name']]]
+    ds['station'] = [station_name(meta)]
     ds['latitude'] = meta['coords']['coords']['lat']
     ds['longitude'] = meta['coords']['coords']['lon']
-    
-    ds = ds.sel(time=f"{current_date.year}-{current_date.month}-{current_date.day}")
-    print(ds) 
+
+    ds = ds.sel(time=day.strftime('%Y-%m-%d'))
     return ds
 
-# Loop through for each device and retrieve the data, waiting for the API to clean up first
-dsets = []
-for device in devices:
-    try:
-        print(device)
-        ds = process_station(device)
-        site = f'{ds.station.values[0]}'
-        time_label = pd.to_datetime(ds.time.values[0]).strftime(f'{site}.a1.%Y%m%d.000000.nc')
-        #time_label = pd.to_datetime(ds.time.values[0]).strftime(f'{site}/{site}.a1.%Y%m%d.000000.nc')
-        #full_path = Path(f'/home/mgrover/data/ambients/{time_label}')
-        #if not os.path.exists(full_path.parent):
-        #    os.makedirs(full_path.parent)
-        print(time_label)
-        ds.to_netcdf(time_label, mode='w')
-    except Exception as e:
-        print(e)
-        pass
-    #time.sleep(20)
+
+def main():
+    parser = ArgumentParser(description="Ambient Weather Ingest")
+    parser.add_argument("--date", metavar="STR", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), default=None, help="Date to pull data for (example: '2021-08-10', default: yesterday)")
+    parser.add_argument("--days", metavar="INT", type=int, default=1, help="Number of consecutive days to process starting at --date (default: 1)")
+    parser.add_argument("--stations", metavar="STR", type=str, nargs="+", default=None, help="Stations to ingest, by output name like atmos-g1 (default: all devices of the account)")
+    parser.add_argument("--workers", metavar="INT", type=int, default=4, help="Threads fetching stations concurrently (default: 4)")
+    parser.add_argument("--rate", metavar="FLOAT", type=float, default=0.9, help="Requests per second across all threads, a little under the 1 per API key the API allows (default: 0.9)")
+    parser.add_argument("--burst", metavar="INT", type=int, default=1, help="Requests allowed at once before the rate applies (default: 1)")
+    parser.add_argument("--retries", metavar="INT", type=int, default=5, help="Retries of a request answered with 429 or 5xx (default: 5)")
+    parser.add_argument("--backoff", metavar="FLOAT", type=float, default=2.0, help="Initial retry delay in seconds, doubled on every retry (default: 2.0)")
+    parser.add_argument("--metrics", metavar="STR", type=str, default=None, help="Append per-phase metrics records to this JSON lines file, see sage_metrics.py")
+    parser.add_argument("--creds", metavar="STR", type=str, default=None, help="File with AMBIENT_API_KEY=... and AMBIENT_APPLICATION_KEY=... lines (default: from the environment)")
+
+    args = parser.parse_args()
+    creds = read_creds(args.creds) if args.creds else os.environ
+    first_day = args.date or (datetime.utcnow() - timedelta(days=1))
+    first_day = datetime(first_day.year, first_day.month, first_day.day, tzinfo=timezone.utc)
+    days = [first_day + timedelta(days=d) for d in range(args.days)]
+    sage_metrics.start("ambient-ingest", args.metrics)
+
+    # Access the Ambient weather API through the rate limited client and get the devices available
+    client = RateLimitedClient(TokenBucket(args.rate, args.burst), retries=args.retries, backoff=args.backoff)
+    api = AmbientAPI(http_client=client, AMBIENT_API_KEY=creds.get('AMBIENT_API_KEY'),
+                     AMBIENT_APPLICATION_KEY=creds.get('AMBIENT_APPLICATION_KEY'))
+    api.endpoint = os.getenv('AMBIENT_ENDPOINT', DEFAULT_ENDPOINT)
+    print(api.endpoint)
+
+    start_time = time.time()
+    with sage_metrics.phase("devices") as m:
+        devices = api.get_devices()
+        if args.stations:
+            devices = [device for device in devices if station_name(device.info) in args.stations]
+        m["rows_out"] = len(devices)
+
+    missing = set(args.stations or []) - {station_name(device.info) for device in devices}
+    failed = [f"{station}: not a device of the account" for station in sorted(missing)]
+
+    # fetch every station and day concurrently, the datasets are built and written afterwards,
+    # netCDF writes are not thread safe
+    results = []
+    with ThreadPoolExecutor(args.workers) as pool, sage_metrics.phase("fetch") as m:
+        futures = {pool.submit(fetch_station, device, day): (device, day) for device in devices for day in days}
+        for future in as_completed(futures):
+            device, day = futures[future]
+            try:
+                results.append((device, day, future.result()))
+            except Exception as e:
+                failed.append(f"{station_name(device.info)} {day.strftime('%Y-%m-%d')}: {e}")
+        m["rows_out"] = sum(len(data) for _, _, data in results)
+
+    for device, day, data in results:
+        station = station_name(device.info)
+        try:
+            with sage_metrics.phase("dataset", rows_in=len(data)) as m:
+                ds = process_station(data, device.info, day)
+                m["rows_out"] = ds.sizes['time']
+
+            time_label = day.strftime(f'{station}.a1.%Y%m%d.000000.nc')
+            with sage_metrics.phase("write", rows_in=ds.sizes['time']) as m:
+                ds.to_netcdf(time_label, mode='w')
+                m["bytes_written"] = sage_metrics.file_size(time_label)
+            print(time_label)
+        except Exception as e:
+            failed.append(f"{station} {day.strftime('%Y-%m-%d')}: {e}")
+
+    print(f"{client.requests} requests, {client.retried} retried, {time.time() - start_time:.1f}s")
+    sage_metrics.write()
+
+    if failed:
+        print("Failed:\n    " + "\n    ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,117 +1,86 @@
 #!/usr/bin/env python3
 
 import os
-import sage_data_client
-import matplotlib.pyplot as plt
+import sage_query
+import sage_pivot
+import sage_thermo
+import sage_netcdf
+import sage_metrics
+import sage_nodes
 import pandas as pd
-import numpy as np
-import datetime
-import xarray as xr
+from contextlib import ExitStack
 from datetime import datetime, timedelta
-from PIL import Image
 from time import time
 from argparse import ArgumentParser
-from matplotlib.dates import DateFormatter
-from metpy.units import units
-from metpy.calc import dewpoint_from_relative_humidity, wet_bulb_temperature
-
-
-aqt_global_NEIU = {'conventions': "CF 1.10",
-                   'site_ID' : "NEIU",
-                  'CAMS_tag' : "CMS-AQT-001",
-                  'datastream' : "CMS_aqt580_NEIU_a1",
-                  'datalevel' : "a1",
-                  'latitude' : 41.9804526,
-                  'longitude' : -87.7196038}
-
-var_attrs_aqt = {'pm2.5' : {'standard_name' : 'mole_concentration_of_pm2p5_ambient_aerosol_particles_in_air',
-                       'units' : 'ug/m^3'},
-            'pm10.0' : {'standard_name' : 'mole_concentration_of_pm10p0_ambient_aerosol_particles_in_air',
-                       'units' : 'ug/m^3'},
-            'pm1.0' : {'standard_name' : 'mole_concentration_of_pm1p0_ambient_aerosol_particles_in_air',
-                       'units' : 'ug/m^3'},
-                'no' : {'standard_name' : 'mole_fraction_of_nitrogen_monoxide_in_air',
-                       'units' : 'Parts Per Million'},
-                'o3' : {'standard_name' : 'mole_fraction_of_ozone_in_air',
-                       'units' : 'Parts Per Million'},
-                'co' : {'standard_name' : 'mole_fraction_of_carbon_monoxide_in_air',
-                       'units' : 'Parts Per Million'},
-                'no2' : {'standard_name' : 'mole_fraction_of_nitrogen_dioxide_in_air',
-                       'units' : 'Parts Per Million'},
-                'temperature': {'standard_name' : 'air_temperature',
-                       'units' : 'celsius'},
-                'humidity': {'standard_name' : 'relative_humidity',
-                       'units' : 'percent'},
-                'dewpoint': {'standard_name' : 'dew_point_temperature',
-                       'units' : 'celsius'},
-                'pressure': {'standard_name' : 'air_pressure',
-                       'units' : 'hPa'}}
-
-
-def ingest_aqt(st, global_attrs, var_attrs):
-    hours = 24
-    start = st.strftime('%Y-%m-%dT%H:%M:%SZ')
-    end = (st + timedelta(hours=hours)).strftime('%Y-%m-%dT%H:%M:%SZ')
-    
-    print(f"Data start date {start}")
-    print(f"Data end date {end}")
-
-    df_aq = sage_data_client.query(
-        start=start,
-        end=end, 
-        filter={
-            "plugin": "registry.sagecontinuum.org/jrobrien/waggle-aqt:0.23.5.04.*",
-            "vsn": "W08D"
-        }
-    )
-
-    pm25 = df_aq[df_aq['name']=='aqt.particle.pm2.5']
-    pm10 = df_aq[df_aq['name']=='aqt.particle.pm1']
-    pm100 = df_aq[df_aq['name']=='aqt.particle.pm10']
-
-    no = df_aq[df_aq['name']=='aqt.gas.no']
-    o3 = df_aq[df_aq['name']=='aqt.gas.ozone']
-    no2 = df_aq[df_aq['name']=='aqt.gas.no2']
-    co = df_aq[df_aq['name']=='aqt.gas.co']
-    aqtemp = df_aq[df_aq['name']=='aqt.env.temp']
-    aqhum = df_aq[df_aq['name']=='aqt.env.humidity']
-    aqpres = df_aq[df_aq['name']=='aqt.env.pressure']
-
-
-    pm25['time'] = pd.DatetimeIndex(pm25['timestamp'])
-
-    aqvals = pm25.set_index('time')
-    aqvals['pm2.5'] = aqvals.value.to_numpy().astype(float)
-    aqvals['pm1.0'] = pm10.value.to_numpy().astype(float)
-    aqvals['pm10.0'] = pm100.value.to_numpy().astype(float)
-
-    aqvals['no'] = no.value.to_numpy().astype(float)
-    aqvals['o3'] = o3.value.to_numpy().astype(float)
-    aqvals['no2'] = no2.value.to_numpy().astype(float)
-    aqvals['co'] = co.value.to_numpy().astype(float)
-    aqvals['temperature'] =  aqtemp.value.to_numpy().astype(float)
-    aqvals['humidity'] =  aqhum.value.to_numpy().astype(float)
-    aqvals['pressure'] =  aqpres.value.to_numpy().astype(float)
-    
 
-    dp = dewpoint_from_relative_humidity( aqvals.temperature.to_numpy() * units.degC, 
-                                         aqvals.humidity.to_numpy() * units.percent)
+from crocus_datastreams import DATASTREAMS
 
-    aqvals['dewpoint'] = dp
+# metpy (--thermo metpy), xarray and netCDF4 are imported by the stages that use them,
+# so start-up only pays for what the job actually runs.
 
-    _ = aqvals.pop('value')
-    _ = aqvals.pop('timestamp')
-    
-    
-    fname = st.strftime('crocus-neiu-aqt-a1-%Y%m%d-%H%M%S.nc')
-    valsxr = xr.Dataset.from_dataframe(aqvals)
-    valsxr = valsxr.sortby('time')
-    
-    
-    valsxr = valsxr.assign_attrs(global_attrs)
+# site metadata of the outputs is in crocus_sites.csv, see sage_nodes.py
+
+# variable attributes and names are declared once, in the datastream spec crocus-ingest.py builds
+var_attrs_aqt = DATASTREAMS["aqt"]["variables"]
+
+# the pivot only needs these and the node to split by, the other meta.* columns are not loaded
+QUERY_COLUMNS = ["timestamp", "name", "value", "meta.vsn"]
+
+# sage measurement name -> output variable
+aqt_names = DATASTREAMS["aqt"]["groups"][0]
+
+
+def query_aqt(start, end, vsn="W08D"):
+    with sage_metrics.phase("query") as m:
+        df = sage_query.query(
+            start=start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            end=end.strftime('%Y-%m-%dT%H:%M:%SZ'), 
+            filter={
+                "plugin": "registry.sagecontinuum.org/jrobrien/waggle-aqt:0.23.5.04.*",
+                "vsn": sage_nodes.vsn_filter(vsn)
+            },
+            columns=QUERY_COLUMNS
+        )
+        m["rows_out"] = len(df)
+    return df
+
+
+def derive_aqt(df_aq, tolerance=timedelta(seconds=1), thermo="numpy"):
+    with sage_metrics.phase("pivot", rows_in=len(df_aq)) as m:
+        aqvals = sage_pivot.pivot(df_aq, aqt_names, tolerance=tolerance)
+        m["rows_out"] = len(aqvals)
+
+    with sage_metrics.phase("thermo", rows_in=len(aqvals)):
+        if thermo == "metpy":
+            from metpy.units import units
+            from metpy.calc import dewpoint_from_relative_humidity
+
+            dp = dewpoint_from_relative_humidity( aqvals.temperature.to_numpy() * units.degC, 
+                                                 aqvals.humidity.to_numpy() * units.percent)
+            aqvals['dewpoint'] = dp.m_as(units.degC)
+        else:
+            aqvals['dewpoint'] = sage_thermo.dewpoint_from_relative_humidity(aqvals.temperature.to_numpy(),
+                                                                             aqvals.humidity.to_numpy())
+    return aqvals
+
+
+def write_aqt(vsn, df_aq, st, var_attrs, tolerance=timedelta(seconds=1), thermo="numpy", encoding="zlib"):
+    """
+    Derive and write the a1 file of one node, returns its name or None without data.
+    """
+    import xarray as xr
+
+    aqvals = derive_aqt(df_aq, tolerance, thermo)
     
-    for varname in var_attrs.keys():
-        valsxr[varname] = valsxr[varname].assign_attrs(var_attrs[varname])
+    fname = sage_nodes.output_name(vsn, "aqt", st)
+    with sage_metrics.phase("dataset", rows_in=len(aqvals)) as m:
+        valsxr = xr.Dataset.from_dataframe(aqvals)
+        valsxr = valsxr.sortby('time')
+        valsxr = valsxr.assign_attrs(sage_nodes.global_attrs(vsn, "aqt"))
+
+        for varname in var_attrs.keys():
+            valsxr[varname] = valsxr[varname].assign_attrs(var_attrs[varname])
+        m["rows_out"] = valsxr.sizes['time']
     
     try:
         os.remove(fname)
@@ -122,27 +91,103 @@ def ingest_aqt(st, global_attrs, var_attrs):
     valsxr["time"] = pd.to_datetime(valsxr.time)
 
     if valsxr['pm2.5'].shape[0] > 0:
-        valsxr.to_netcdf(fname, format='NETCDF4')
-    else:
+        with sage_metrics.phase("write", rows_in=valsxr.sizes['time']) as m:
+            sage_netcdf.write(valsxr, fname, encoding, sage_netcdf.RAW_TIME_UNITS)
+            m["bytes_written"] = sage_metrics.file_size(fname)
+        return fname
+
+    print(f'{vsn}: not saving... no data')
+    return None
+
+
+def ingest_aqt(st, var_attrs, vsn="W08D", tolerance=timedelta(seconds=1), thermo="numpy", encoding="zlib", workers=0):
+    """
+    Query the nodes matching vsn for the day in one request, then derive and write one
+    file per node in a pool of workers processes (0 for all cores).
+    """
+    hours = 24
+    end = st + timedelta(hours=hours)
+    
+    print(f"Data start date {st.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+    print(f"Data end date {end.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+
+    nodes = sage_nodes.split(query_aqt(st, end, vsn))
+    if not nodes:
         print('not saving... no data')
+        return
+    
+    written = sage_nodes.map_nodes(write_aqt, {node: (df_aq, st, var_attrs, tolerance, thermo, encoding) for node, df_aq in nodes.items()}, workers)
+    print(f"Wrote {', '.join(f for f in written.values() if f)}")
     
     #return valsxr
 
 
+def ingest_aqt_stream(st, var_attrs, vsn="W08D", tolerance=timedelta(seconds=1), thermo="numpy", chunk=timedelta(hours=1), encoding="zlib"):
+    """
+    Same output as ingest_aqt, but the day is pulled and written one chunk at a time.
+    Nodes are derived in this process, one appender per node.
+    """
+    hours = 24
+    end = st + timedelta(hours=hours)
+    
+    print(f"Data start date {st.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+    print(f"Data end date {end.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+
+    outputs = {}
+    with ExitStack() as stack:
+        chunk_start = st
+        while chunk_start < end:
+            chunk_end = min(chunk_start + chunk, end)
+            for node, df_aq in sage_nodes.split(query_aqt(chunk_start, chunk_end, vsn)).items():
+                if node not in outputs:
+                    out = sage_netcdf.NetCDFAppender(sage_nodes.output_name(node, "aqt", st), sage_nodes.global_attrs(node, "aqt"), var_attrs, profile=encoding, time_units=sage_netcdf.RAW_TIME_UNITS)
+                    outputs[node] = stack.enter_context(out)
+                aqvals = derive_aqt(df_aq, tolerance, thermo)
+                with sage_metrics.phase("write", rows_in=len(aqvals)):
+                    outputs[node].append(aqvals)
+            chunk_start = chunk_end
+
+    if not any(out.rows for out in outputs.values()):
+        print('not saving... no data')
+
+    for out in outputs.values():
+        sage_metrics.count("write", bytes_written=sage_metrics.file_size(out.fname))
+
+
 def main():
     parser = ArgumentParser(description="AQT Ingest")
     parser.add_argument("--date", metavar="STR", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), required=True, help="Date to pull data for (example: '2021-08-10')")
+    parser.add_argument("--days", metavar="INT", type=int, default=1, help="Number of consecutive days to process starting at --date (default: 1)")
+    parser.add_argument("--vsn", metavar="STR", type=str, nargs="+", default=["W08D"], help="Nodes queried together, VSNs or a regular expression, one output per node (default: W08D)")
+    parser.add_argument("--workers", metavar="INT", type=int, default=0, help="Processes deriving the nodes in parallel, 0 for all available cores (default: 0)")
+    parser.add_argument("--align-tolerance", metavar="FLOAT", type=float, default=1.0, help="Max time difference in seconds when aligning channels, 0 for exact timestamps (default: 1.0)")
+    parser.add_argument("--thermo", type=str, choices=["numpy", "metpy"], default="numpy", help="Dewpoint implementation, metpy is the slower reference (default: numpy)")
+    parser.add_argument("--stream", action="store_true", help="Pull and write the day in chunks to bound memory use")
+    parser.add_argument("--chunk-minutes", metavar="INT", type=int, default=60, help="Chunk length in minutes for --stream (default: 60)")
+    parser.add_argument("--encoding", type=str, choices=list(sage_netcdf.ENCODING_PROFILES), default="zlib", help="netCDF encoding profile of the output, see sage_netcdf.py (default: zlib)")
+    parser.add_argument("--metrics", metavar="STR", type=str, default=None, help="Append per-phase metrics records to this JSON lines file, see sage_metrics.py")
 
     args = parser.parse_args()
+    tolerance = timedelta(seconds=args.align_tolerance) if args.align_tolerance > 0 else None
+    sage_metrics.start("aqt-ingest", args.metrics)
     
-    try:
-        start_time = time()
-        ingest_aqt(args.date, aqt_global_NEIU, var_attrs_aqt)
-        print("Success...")
-        end_time = time()
-        print(f"Time taken: {end_time - start_time}")
-    except Exception as e:
-        print(e)
+    # several days in one process share the imports and the query cache
+    for d in range(args.days):
+        day = args.date + timedelta(days=d)
+        sage_metrics.set_context(date=day.strftime('%Y-%m-%d'))
+        try:
+            start_time = time()
+            if args.stream:
+                ingest_aqt_stream(day, var_attrs_aqt, vsn=args.vsn, tolerance=tolerance, thermo=args.thermo, chunk=timedelta(minutes=args.chunk_minutes), encoding=args.encoding)
+            else:
+                ingest_aqt(day, var_attrs_aqt, vsn=args.vsn, tolerance=tolerance, thermo=args.thermo, encoding=args.encoding, workers=args.workers)
+            print("Success...")
+            end_time = time()
+            print(f"Time taken: {end_time - start_time}")
+        except Exception as e:
+            print(e)
+
+    sage_metrics.write()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import sage_thermo
+import sage_netcdf
+import sage_metrics
+import sage_nodes
+import sage_datastreams
+import sage_zarr
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from time import time
+from argparse import ArgumentParser
+
+from crocus_datastreams import DATASTREAMS
+
+# All datastreams of crocus_datastreams.py (AQT and WXT) from one query per window, instead
+# of the separate queries of aqt-ingest.py and wxt-ingest.py. metpy (--thermo metpy), xarray
+# and netCDF4 are imported by the stages that use them.
+
+
+def output_name(vsn, spec, st):
+    return sage_nodes.output_name(vsn, spec["instrument"], st, spec.get("product"), spec.get("datalevel", "a1"))
+
+
+def global_attrs(vsn, spec):
+    return sage_nodes.global_attrs(vsn, spec["instrument"], spec.get("datalevel", "a1"))
+
+
+def derive_sources(df, datastreams, tolerance=timedelta(seconds=1), thermo="normand"):
+    """
+    Yields (name, frame) of the datastreams, the ones sharing a source are derived together.
+    """
+    state = sage_metrics.state()
+    sources = {}
+    for name in datastreams:
+        sources.setdefault(sage_datastreams.source(name, DATASTREAMS[name]), []).append(name)
+
+    for src, names in sources.items():
+        specs = {name: DATASTREAMS[name] for name in names}
+        if state is not None:
+            sage_metrics.set_context(**state[1], datastream=src)
+        outs = sage_datastreams.derive_many(sage_datastreams.select(df, specs[names[0]]), specs, tolerance, thermo)
+        for name in names:
+            if state is not None:
+                sage_metrics.set_context(**state[1], datastream=name)
+            yield name, outs[name]
+
+    if state is not None:
+        sage_metrics.set_context(**state[1])
+
+
+def zarr_store(zarr_dir, fname, vsn, spec, encoding="zlib", origin=sage_zarr.ORIGIN):
+    return sage_zarr.ZarrStore(os.path.join(zarr_dir, sage_zarr.store_name(fname)), sage_datastreams.day_rows(spec),
+                               dict(global_attrs(vsn, spec), **spec.get("attrs", {})), spec["variables"], encoding, origin,
+                               sage_datastreams.time_units(spec))
+
+
+def write_node(vsn, df, st, datastreams, tolerance=timedelta(seconds=1), thermo="normand", encoding="zlib", zarr_dir=None, zarr_origin=sage_zarr.ORIGIN):
+    """
+    Derive and write the a1 files of one node, returns their names. With zarr_dir, the day
+    is also written into the Zarr store of every datastream there.
+    """
+    written = []
+    for name, out in derive_sources(df, datastreams, tolerance, thermo):
+        spec = DATASTREAMS[name]
+        fname = output_name(vsn, spec, st)
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+        if out.empty:
+            print(f'{vsn} {name}: not saving... no data')
+            continue
+
+        ds = sage_datastreams.dataset(out, spec, global_attrs(vsn, spec))
+        with sage_metrics.phase("write", rows_in=ds.sizes['time']) as m:
+            sage_netcdf.write(ds, fname, encoding, sage_datastreams.time_units(spec))
+            m["bytes_written"] = sage_metrics.file_size(fname)
+        written.append(fname)
+
+        if zarr_dir:
+            with sage_metrics.phase("zarr", rows_in=len(out)), zarr_store(zarr_dir, fname, vsn, spec, encoding, zarr_origin) as store:
+                store.write(st, out)
+
+    return written
+
+
+def ingest(st, datastreams, vsn="W08D", tolerance=timedelta(seconds=1), thermo="normand", encoding="zlib", workers=0, zarr_dir=None, zarr_origin=sage_zarr.ORIGIN):
+    """
+    Query the datastreams of the nodes matching vsn for the day in one request, then derive
+    and write the files of every node in a pool of workers processes (0 for all cores).
+    """
+    hours = 24
+    end = st + timedelta(hours=hours)
+    print(f"Data start date {st.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+    print(f"Data end date {end.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+
+    specs = [DATASTREAMS[name] for name in datastreams]
+    nodes = sage_nodes.split(sage_datastreams.query(st, end, specs, sage_nodes.vsn_filter(vsn)))
+    if not nodes:
+        print('not saving... no data')
+        return
+
+    written = sage_nodes.map_nodes(write_node, {node: (df, st, datastreams, tolerance, thermo, encoding, zarr_dir, zarr_origin) for node, df in nodes.items()}, workers)
+    print(f"Wrote {', '.join(f for files in written.values() for f in files)}")
+
+
+def ingest_stream(st, datastreams, vsn="W08D", tolerance=timedelta(seconds=1), thermo="normand", chunk=timedelta(hours=1), encoding="zlib", zarr_dir=None, zarr_origin=sage_zarr.ORIGIN):
+    """
+    Same output as ingest, but the day is pulled and written one chunk at a time. Chunks
+    have to be a multiple of the resampling periods (1h for the wxt summaries). Nodes are
+    derived in this process.
+    """
+    sage_datastreams.check_chunk(chunk, [DATASTREAMS[name] for name in datastreams])
+    hours = 24
+    end = st + timedelta(hours=hours)
+    print(f"Data start date {st.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+    print(f"Data end date {end.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+
+    specs = [DATASTREAMS[name] for name in datastreams]
+    state = sage_metrics.state()
+    outputs = {}
+    stores = {}
+    joiners = {}
+    with ExitStack() as stack:
+        chunk_start = st
+        while chunk_start < end:
+            chunk_end = min(chunk_start + chunk, end)
+            nodes = sage_nodes.split(sage_datastreams.query(chunk_start, chunk_end, specs, sage_nodes.vsn_filter(vsn)))
+            chunk_start = chunk_end
+
+            for node, df in nodes.items():
+                if state is not None:
+                    sage_metrics.set_context(**state[1], vsn=node)
+                for name, out in derive_sources(df, datastreams, tolerance, thermo):
+                    spec = DATASTREAMS[name]
+                    if state is not None:
+                        sage_metrics.set_context(**state[1], vsn=node, datastream=name)
+                    if out.empty:
+                        continue
+
+                    key = (node, name)
+                    if key not in outputs:
+                        appender = sage_netcdf.NetCDFAppender(output_name(node, spec, st), dict(global_attrs(node, spec), **spec.get("attrs", {})),
+                                                              spec["variables"], profile=encoding, time_units=sage_datastreams.time_units(spec))
+                        outputs[key] = stack.enter_context(appender)
+                        if zarr_dir:
+                            stores[key] = stack.enter_context(zarr_store(zarr_dir, appender.fname, node, spec, encoding, zarr_origin))
+                        joiners[key] = sage_datastreams.ChunkJoiner(spec.get("resample"))
+
+                    # empty periods between the chunks and the forward fill carry over the boundary
+                    out = joiners[key].join(out)
+                    if zarr_dir:
+                        # the rows written so far are the offset into the day slot
+                        with sage_metrics.phase("zarr", rows_in=len(out)):
+                            stores[key].write(st, out, offset=outputs[key].rows)
+                    with sage_metrics.phase("write", rows_in=len(out)):
+                        outputs[key].append(out)
+
+    for (node, name), out in outputs.items():
+        if state is not None:
+            sage_metrics.set_context(**state[1], vsn=node, datastream=name)
+        sage_metrics.count("write", bytes_written=sage_metrics.file_size(out.fname))
+
+    if state is not None:
+        sage_metrics.set_context(**state[1])
+    if not outputs:
+        print('not saving... no data')
+
+
+def main():
+    parser = ArgumentParser(description="CROCUS Ingest")
+    parser.add_argument("--date", metavar="STR", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), required=True, help="Date to pull data for (example: '2021-08-10')")
+    parser.add_argument("--days", metavar="INT", type=int, default=1, help="Number of consecutive days to process starting at --date (default: 1)")
+    parser.add_argument("--datastreams", type=str, nargs="+", choices=list(DATASTREAMS), default=list(DATASTREAMS), help="Datastreams of crocus_datastreams.py to build (default: all)")
+    parser.add_argument("--vsn", metavar="STR", type=str, nargs="+", default=["W08D"], help="Nodes queried together, VSNs or a regular expression, one output per node (default: W08D)")
+    parser.add_argument("--workers", metavar="INT", type=int, default=0, help="Processes deriving the nodes in parallel, 0 for all available cores (default: 0)")
+    parser.add_argument("--align-tolerance", metavar="FLOAT", type=float, default=1.0, help="Max time difference in seconds when aligning channels, 0 for exact timestamps (default: 1.0)")
+    parser.add_argument("--thermo", type=str, choices=sage_thermo.WETBULB_METHODS + ["metpy"], default="normand", help="Wet-bulb method of the vectorized dewpoint/wet-bulb, or metpy as the slower reference (default: normand)")
+    parser.add_argument("--stream", action="store_true", help="Pull and write the day in chunks to bound memory use")
+    parser.add_argument("--chunk-minutes", metavar="INT", type=int, default=60, help="Chunk length in minutes for --stream, a multiple of the resampling periods of the datastreams (default: 60)")
+    parser.add_argument("--encoding", type=str, choices=list(sage_netcdf.ENCODING_PROFILES), default="zlib", help="netCDF encoding profile of the output, see sage_netcdf.py (default: zlib)")
+    parser.add_argument("--zarr", metavar="STR", type=str, default=None, help="Also write every day into time-chunked Zarr stores in this directory, one per datastream and node, see sage_zarr.py")
+    parser.add_argument("--zarr-origin", metavar="STR", type=str, default=sage_zarr.ORIGIN, help=f"First day of the Zarr stores created, earlier days are rejected (default: {sage_zarr.ORIGIN})")
+    parser.add_argument("--metrics", metavar="STR", type=str, default=None, help="Append per-phase metrics records to this JSON lines file, see sage_metrics.py")
+
+    args = parser.parse_args()
+    if args.stream:
+        try:
+            sage_datastreams.check_chunk(timedelta(minutes=args.chunk_minutes), [DATASTREAMS[name] for name in args.datastreams])
+        except ValueError as e:
+            parser.error(f"--chunk-minutes {args.chunk_minutes}: {e}")
+    tolerance = timedelta(seconds=args.align_tolerance) if args.align_tolerance > 0 else None
+    sage_metrics.start("crocus-ingest", args.metrics)
+
+    # several days in one process share the imports and the query cache, a failed day does
+    # not stop the others but fails the job
+    failed = []
+    for d in range(args.days):
+        day = args.date + timedelta(days=d)
+        sage_metrics.set_context(date=day.strftime('%Y-%m-%d'))
+        try:
+            start_time = time()
+            if args.stream:
+                ingest_stream(day, args.datastreams, vsn=args.vsn, tolerance=tolerance, thermo=args.thermo, chunk=timedelta(minutes=args.chunk_minutes), encoding=args.encoding, zarr_dir=args.zarr, zarr_origin=args.zarr_origin)
+            else:
+                ingest(day, args.datastreams, vsn=args.vsn, tolerance=tolerance, thermo=args.thermo, encoding=args.encoding, workers=args.workers, zarr_dir=args.zarr, zarr_origin=args.zarr_origin)
+            print("Success...")
+            end_time = time()
+            print(f"Time taken: {end_time - start_time}")
+        except Exception as e:
+            failed.append(f"{day.strftime('%Y-%m-%d')}: {e!r}")
+
+    sage_metrics.write()
+
+    if failed:
+        print("Failed:\n    " + "\n    ".join(failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+Datastreams of the CROCUS nodes, built by crocus-ingest.py (see sage_datastreams.py).
+
+Every datastream is declared by
+    instrument: name in crocus_sites.csv and in the output names
+    filter:     regular expressions on the meta.* fields selecting the records of the instrument
+    groups:     {sage name: variable} of channels aligned together, on the first one of the group
+    derive:     variables computed from others (function of sage_datastreams.FUNCTIONS)
+    resample:   optional fixed period: aggregate {variable: (source, statistic)}, fill of empty
+                periods and variables derived after resampling; statistics are mean, max, min,
+                count and vector_mean (of directions in degrees)
+    variables:  the output variables, in order, with their CF attributes
+
+and optionally
+    source:     datastream whose records, groups and derived variables are shared, products
+                of the same source are resampled together in one pass
+    product:    name in the output names instead of the instrument
+    datalevel:  level in the output names and attributes (default: a1)
+    attrs:      global attributes added to the output
+    sample_period: shortest period between records without resampling, the Zarr stores have
+                room for twice the records a day this gives (sage_datastreams.day_rows)
+"""
+
+DATASTREAMS = {
+    "aqt": {
+        "instrument": "aqt",
+        "filter": {"plugin": "registry.sagecontinuum.org/jrobrien/waggle-aqt:0.23.5.04.*"},
+        "groups": [
+            {'aqt.particle.pm2.5' : 'pm2.5',
+             'aqt.particle.pm1' : 'pm1.0',
+             'aqt.particle.pm10' : 'pm10.0',
+             'aqt.gas.no' : 'no',
+             'aqt.gas.ozone' : 'o3',
+             'aqt.gas.no2' : 'no2',
+             'aqt.gas.co' : 'co',
+             'aqt.env.temp' : 'temperature',
+             'aqt.env.humidity' : 'humidity',
+             'aqt.env.pressure' : 'pressure'},
+        ],
+        "derive": [
+            {"variable": "dewpoint", "function": "dewpoint", "inputs": ["temperature", "humidity"]},
+        ],
+        "resample": None,
+        # one record every 5s at most
+        "sample_period": "5s",
+        "variables": {
+            'pm2.5' : {'standard_name' : 'mole_concentration_of_pm2p5_ambient_aerosol_particles_in_air',
+                       'units' : 'ug/m^3'},
+            'pm1.0' : {'standard_name' : 'mole_concentration_of_pm1p0_ambient_aerosol_particles_in_air',
+                       'units' : 'ug/m^3'},
+            'pm10.0' : {'standard_name' : 'mole_concentration_of_pm10p0_ambient_aerosol_particles_in_air',
+                        'units' : 'ug/m^3'},
+            'no' : {'standard_name' : 'mole_fraction_of_nitrogen_monoxide_in_air',
+                    'units' : 'Parts Per Million'},
+            'o3' : {'standard_name' : 'mole_fraction_of_ozone_in_air',
+                    'units' : 'Parts Per Million'},
+            'no2' : {'standard_name' : 'mole_fraction_of_nitrogen_dioxide_in_air',
+                     'units' : 'Parts Per Million'},
+            'co' : {'standard_name' : 'mole_fraction_of_carbon_monoxide_in_air',
+                    'units' : 'Parts Per Million'},
+            'temperature': {'standard_name' : 'air_temperature',
+                            'units' : 'celsius'},
+            'humidity': {'standard_name' : 'relative_humidity',
+                         'units' : 'percent'},
+            'pressure': {'standard_name' : 'air_pressure',
+                         'units' : 'hPa'},
+            'dewpoint': {'standard_name' : 'dew_point_temperature',
+                         'units' : 'celsius'},
+        },
+    },
+
+    "wxt": {
+        "instrument": "wxt",
+        "filter": {"plugin": "registry.sagecontinuum.org/jrobrien/waggle-wxt536:0.23.5.*",
+                   "sensor": "vaisala-wxt536"},
+        "groups": [
+            {'wxt.env.temp' : 'temperature',
+             'wxt.env.humidity' : 'humidity',
+             'wxt.env.pressure' : 'pressure',
+             'wxt.rain.accumulation' : 'rainfall'},
+            {'wxt.wind.speed' : 'speed',
+             'wxt.wind.direction' : 'direction'},
+        ],
+        "derive": [
+            {"variable": "dewpoint", "function": "dewpoint", "inputs": ["temperature", "humidity"]},
+        ],
+        "resample": {
+            "period": "10s",
+            # ffill gets rid of nans due to empty resample periods
+            "fill": "ffill",
+            "aggregate": {
+                'temperature': ('temperature', 'mean'),
+                'humidity': ('humidity', 'mean'),
+                'pressure': ('pressure', 'mean'),
+                'rainfall': ('rainfall', 'mean'),
+                'dewpoint': ('dewpoint', 'mean'),
+                'wind_dir_10s': ('direction', 'mean'),
+                'wind_mean_10s': ('speed', 'mean'),
+                'wind_max_10s': ('speed', 'max'),
+            },
+            "derive": [
+                {"variable": "wetbulb", "function": "wet_bulb_temperature", "inputs": ["pressure", "temperature", "dewpoint"]},
+            ],
+        },
+        "variables": {
+            'temperature': {'standard_name' : 'air_temperature',
+                            'units' : 'celsius'},
+            'humidity': {'standard_name' : 'relative_humidity',
+                         'units' : 'percent'},
+            'pressure': {'standard_name' : 'air_pressure',
+                         'units' : 'hPa'},
+            'rainfall': {'standard_name' : 'thickness_of_rainfall_amount',
+                         'units' : 'mm'},
+            'dewpoint': {'standard_name' : 'dew_point_temperature',
+                         'units' : 'celsius'},
+            'wetbulb': {'standard_name' : 'wet_bulb_temperature',
+                        'units' : 'celsius'},
+            'wind_dir_10s': {'standard_name' : 'wind_from_direction',
+                             'units' : 'degree'},
+            'wind_mean_10s': {'standard_name' : 'wind_speed',
+                              'units' : 'm/s'},
+            'wind_max_10s': {'standard_name' : 'wind_speed_of_gust',
+                             'units' : 'm/s'},
+        },
+    },
+}
+
+
+# Summaries of the WXT records at coarser resolutions, built in the same pass as the 10s a1
+# datastream. Unlike wxt they leave empty periods empty, the sample counts tell them apart.
+def wxt_summary(period):
+    cell = {"mean": "time: mean", "max": "time: maximum", "min": "time: minimum"}
+
+    def attrs(variable, statistic="mean"):
+        return dict(DATASTREAMS["wxt"]["variables"][variable], cell_methods=cell[statistic])
+
+    return dict(
+        DATASTREAMS["wxt"],
+        source="wxt",
+        product=f"wxt{period}",
+        datalevel="b1",
+        attrs={"time_resolution": period},
+        resample={
+            "period": period,
+            "aggregate": {
+                'temperature': ('temperature', 'mean'),
+                'temperature_max': ('temperature', 'max'),
+                'temperature_min': ('temperature', 'min'),
+                'humidity': ('humidity', 'mean'),
+                'pressure': ('pressure', 'mean'),
+                'rainfall': ('rainfall', 'max'),
+                'dewpoint': ('dewpoint', 'mean'),
+                f'wind_dir_{period}': ('direction', 'vector_mean'),
+                f'wind_mean_{period}': ('speed', 'mean'),
+                f'wind_max_{period}': ('speed', 'max'),
+                f'wind_min_{period}': ('speed', 'min'),
+                'samples': ('temperature', 'count'),
+                'wind_samples': ('speed', 'count'),
+            },
+            "derive": [
+                {"variable": "wetbulb", "function": "wet_bulb_temperature", "inputs": ["pressure", "temperature", "dewpoint"]},
+            ],
+        },
+        variables={
+            'temperature': attrs('temperature'),
+            'temperature_max': attrs('temperature', 'max'),
+            'temperature_min': attrs('temperature', 'min'),
+            'humidity': attrs('humidity'),
+            'pressure': attrs('pressure'),
+            # accumulation at the end of the period
+            'rainfall': attrs('rainfall', 'max'),
+            'dewpoint': attrs('dewpoint'),
+            'wetbulb': attrs('wetbulb'),
+            f'wind_dir_{period}': {'standard_name' : 'wind_from_direction',
+                                   'units' : 'degree',
+                                   'cell_methods' : 'time: mean (unit vector)'},
+            f'wind_mean_{period}': {'standard_name' : 'wind_speed',
+                                    'units' : 'm/s',
+                                    'cell_methods' : 'time: mean'},
+            f'wind_max_{period}': {'standard_name' : 'wind_speed_of_gust',
+                                   'units' : 'm/s',
+                                   'cell_methods' : 'time: maximum'},
+            f'wind_min_{period}': {'standard_name' : 'wind_speed',
+                                   'units' : 'm/s',
+                                   'cell_methods' : 'time: minimum'},
+            'samples': {'long_name' : 'number of temperature samples',
+                        'units' : '1'},
+            'wind_samples': {'long_name' : 'number of wind samples',
+                             'units' : '1'},
+        },
+    )
+
+
+for _period in ("1min", "5min", "1h"):
+    DATASTREAMS[f"wxt-{_period}"] = wxt_summary(_period)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+"""
+Engine building datastreams declared as specs (see crocus_datastreams.py) from one query.
+
+All configured datastreams of a node and window are pulled in a single request, whose filter
+is the union of the datastream filters. select() then picks the records of every datastream
+by its own filter, and derive() turns them into the output frame:
+
+    pivot     every group of channels aligned on its first channel (sage_pivot.py)
+    derive    derived variables, on the group frame holding their inputs
+    resample  aggregates of the group frames on a fixed period, empty periods filled,
+              then the variables derived after resampling
+
+The output frame has the declared variables in order, dataset() adds the CF attributes.
+
+Datastreams naming the same source (products of one instrument at several resolutions) are
+built together by derive_many(): their records are selected, pivoted and derived once, and
+all their periods are aggregated in a single pass over the group frames.
+"""
+import numpy as np
+import pandas as pd
+
+import sage_query
+import sage_pivot
+import sage_thermo
+import sage_metrics
+import sage_netcdf
+
+# the meta.* fields are categorical, loading the ones filters use is cheap
+QUERY_COLUMNS = ["timestamp", "name", "value", "meta.vsn", "meta.plugin", "meta.sensor"]
+
+
+# --- Derived variables: function(*inputs, thermo) ------------------------------------
+def _dewpoint(temperature, humidity, thermo="normand"):
+    if thermo == "metpy":
+        from metpy.units import units
+        from metpy.calc import dewpoint_from_relative_humidity
+
+        return dewpoint_from_relative_humidity(temperature * units.degC, humidity * units.percent).m_as(units.degC)
+    return sage_thermo.dewpoint_from_relative_humidity(temperature, humidity)
+
+
+def _wet_bulb_temperature(pressure, temperature, dewpoint, thermo="normand"):
+    if thermo == "metpy":
+        from metpy.units import units
+        from metpy.calc import wet_bulb_temperature
+
+        return wet_bulb_temperature(pressure * units.hPa, temperature * units.degC, dewpoint * units.degC).m_as(units.degC)
+    return sage_thermo.wet_bulb_temperature(pressure, temperature, dewpoint, method=thermo)
+
+
+FUNCTIONS = {
+    "dewpoint": _dewpoint,
+    "wet_bulb_temperature": _wet_bulb_temperature,
+}
+
+
+# --- Query -----------------------------------------------------------------------------
+def names(spec):
+    return {name: variable for group in spec["groups"] for name, variable in group.items()}
+
+
+def query_filter(specs, vsn):
+    """
+    One filter covering the records of all specs on the nodes matching vsn.
+    """
+    plugins = list(dict.fromkeys(spec["filter"]["plugin"] for spec in specs))
+    channels = list(dict.fromkeys(name for spec in specs for name in names(spec)))
+    return {"plugin": "|".join(plugins), "name": "|".join(channels), "vsn": vsn}
+
+
+def query(start, end, specs, vsn):
+    with sage_metrics.phase("query") as m:
+        df = sage_query.query(
+            start=start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            end=end.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            filter=query_filter(specs, vsn),
+            columns=QUERY_COLUMNS
+        )
+        m["rows_out"] = len(df)
+    return df
+
+
+def _matches(column, pattern):
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        categories = column.cat.categories
+        return column.isin(categories[categories.astype(str).str.fullmatch(pattern)])
+    return column.astype(str).str.fullmatch(pattern)
+
+
+def select(df, spec):
+    """
+    Records of the datastream in a query result covering several.
+    """
+    mask = df["name"].isin(names(spec).keys())
+    for field, pattern in spec["filter"].items():
+        mask &= _matches(df[f"meta.{field}"], pattern)
+    return df[mask]
+
+
+# room for this many times the records a day the sample period gives, for bursts and clock jumps
+DAY_ROWS_HEADROOM = 2
+
+
+def day_rows(spec):
+    """
+    Most rows a day of the datastream has: one per period if resampled, otherwise the records
+    a day the sample period gives, with headroom.
+    """
+    rule = spec.get("resample")
+    if rule:
+        return int(pd.Timedelta(days=1) / pd.Timedelta(rule["period"]))
+    return DAY_ROWS_HEADROOM * int(pd.Timedelta(days=1) / pd.Timedelta(spec["sample_period"]))
+
+
+def time_units(spec):
+    """
+    Unit of the output times: the nanoseconds of the records without resampling, the one of
+    the encoding profile (None) otherwise.
+    """
+    return None if spec.get("resample") else sage_netcdf.RAW_TIME_UNITS
+
+
+def check_chunk(chunk, specs):
+    """
+    Raises ValueError unless chunk is a positive multiple of every resampling period of the
+    specs: a chunk ending inside a period would write that period once per chunk.
+    """
+    chunk = pd.Timedelta(chunk)
+    if chunk <= pd.Timedelta(0):
+        raise ValueError("chunks have to be longer than 0")
+    for spec in specs:
+        rule = spec.get("resample")
+        if rule and chunk % pd.Timedelta(rule["period"]):
+            raise ValueError(f"chunks of {chunk.total_seconds() / 60:g} minutes are not a multiple of the {rule['period']} resampling period")
+
+
+def source(name, spec):
+    """
+    Datastream whose records, groups and derived variables the spec shares, itself by default.
+    """
+    return spec.get("source", name)
+
+
+# --- Resample --------------------------------------------------------------------------
+STATISTICS = ("mean", "max", "min", "count", "vector_mean")
+
+
+def _accumulate(frame, period, angles=()):
+    """
+    Sums, counts, maxima and minima of the columns of a frame per period, in one pass over
+    its sorted times, plus the sums of sines and cosines of the angles columns (degrees).
+    The periods run from the first to the last record, empty ones included.
+    """
+    period = pd.Timedelta(period).value
+    t = frame.index.as_unit("ns").asi8
+    order = None if frame.index.is_monotonic_increasing else np.argsort(t, kind="stable")
+    if order is not None:
+        t = t[order]
+
+    columns = list(frame.columns)
+    angles = [c for c in columns if c in angles]
+    acc = {"period": period, "columns": columns, "angles": angles}
+    if len(t) == 0:
+        acc["codes"] = np.empty(0, dtype=np.int64)
+        for k in ("sum", "count", "max", "min"):
+            acc[k] = np.empty((0, len(columns)))
+        acc["sin"] = acc["cos"] = np.empty((0, len(angles)))
+        return acc
+
+    codes = t // period
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    values = frame.to_numpy(dtype=float)
+    if order is not None:
+        values = values[order]
+    valid = ~np.isnan(values)
+
+    stats = {
+        "sum": np.add.reduceat(np.where(valid, values, 0.0), starts, axis=0),
+        "count": np.add.reduceat(valid.astype(float), starts, axis=0),
+        "max": np.maximum.reduceat(np.where(valid, values, -np.inf), starts, axis=0),
+        "min": np.minimum.reduceat(np.where(valid, values, np.inf), starts, axis=0),
+    }
+    radians = np.deg2rad(values[:, [columns.index(c) for c in angles]])
+    angle_valid = valid[:, [columns.index(c) for c in angles]]
+    stats["sin"] = np.add.reduceat(np.where(angle_valid, np.sin(radians), 0.0), starts, axis=0)
+    stats["cos"] = np.add.reduceat(np.where(angle_valid, np.cos(radians), 0.0), starts, axis=0)
+
+    # spread the periods holding records over the full range
+    present = codes[starts]
+    acc["codes"] = np.arange(present[0], present[-1] + 1)
+    empty = {"sum": 0.0, "count": 0.0, "max": -np.inf, "min": np.inf, "sin": 0.0, "cos": 0.0}
+    for k, v in stats.items():
+        acc[k] = np.full((len(acc["codes"]), v.shape[1]), empty[k])
+        acc[k][present - present[0]] = v
+    return acc
+
+
+def _roll_up(acc, period):
+    """
+    Accumulators of a coarser period, a multiple of the one of acc.
+    """
+    period = pd.Timedelta(period).value
+    if period % acc["period"]:
+        raise ValueError(f"{pd.Timedelta(period)} is not a multiple of {pd.Timedelta(acc['period'])}")
+    if period == acc["period"] or len(acc["codes"]) == 0:
+        return dict(acc, period=period, codes=acc["codes"] * acc["period"] // period)
+
+    codes = acc["codes"] // (period // acc["period"])
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    rolled = dict(acc, period=period, codes=codes[starts])
+    for k in ("sum", "count", "sin", "cos"):
+        rolled[k] = np.add.reduceat(acc[k], starts, axis=0)
+    rolled["max"] = np.maximum.reduceat(acc["max"], starts, axis=0)
+    rolled["min"] = np.minimum.reduceat(acc["min"], starts, axis=0)
+    return rolled
+
+
+def _statistic(acc, column, statistic, index):
+    i = acc["columns"].index(column)
+    count = acc["count"][:, i]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if statistic == "mean":
+            values = acc["sum"][:, i] / count
+        elif statistic in ("max", "min"):
+            values = np.where(count > 0, acc[statistic][:, i], np.nan)
+        elif statistic == "count":
+            values = count.astype(np.int64)
+        elif statistic == "vector_mean":
+            j = acc["angles"].index(column)
+            values = np.where(count > 0, np.rad2deg(np.arctan2(acc["sin"][:, j], acc["cos"][:, j])) % 360, np.nan)
+        else:
+            raise ValueError(f"unknown statistic {statistic}, one of {', '.join(STATISTICS)}")
+    return pd.Series(values, index=index, name=column)
+
+
+def _resample(frames, rules):
+    """
+    Output frame of every resample rule. The group frames are accumulated once at the finest
+    period, the other periods are rolled up from it and have to be multiples of it, periods
+    start at midnight when they divide a day.
+    """
+    if not rules:
+        return []
+    periods = [pd.Timedelta(rule["period"]) for rule in rules]
+    finest = min(periods)
+    accumulated = []
+    for i, frame in enumerate(frames):
+        angles = {src for rule in rules for src, statistic in rule["aggregate"].values()
+                  if statistic == "vector_mean" and src in frame}
+        accumulated.append(_accumulate(frame, finest, angles))
+
+    outs = []
+    for rule, period in zip(rules, periods):
+        rolled = [_roll_up(acc, period) for acc in accumulated]
+        indexes = [pd.DatetimeIndex((acc["codes"] * acc["period"]).astype("datetime64[ns]"), name=frames[i].index.name)
+                   .as_unit(frames[i].index.unit) for i, acc in enumerate(rolled)]
+
+        # the periods of the first group are the index of the output
+        out = pd.DataFrame(index=indexes[0])
+        for variable, (src, statistic) in rule["aggregate"].items():
+            i = next(i for i, f in enumerate(frames) if src in f)
+            out[variable] = _statistic(rolled[i], src, statistic, indexes[i])
+        # filled on the output periods, so the groups ending before the first one are filled too
+        outs.append(out.ffill() if rule.get("fill") == "ffill" else out)
+    return outs
+
+
+class ChunkJoiner():
+    """
+    Joins the frames a resample rule gives chunk by chunk into the frame the whole range
+    gives: the empty periods between the last row of a chunk and the first one of the next
+    are filled in (NaN, 0 counts) and the fill of the rule carries over, so the result
+    still runs from the first to the last record.
+    """
+    def __init__(self, rule):
+        self.period = pd.Timedelta(rule["period"]) if rule else None
+        self.fill = (rule or {}).get("fill")
+        self.counts = [variable for variable, (src, statistic) in (rule or {}).get("aggregate", {}).items()
+                       if statistic == "count"]
+        self.last = None
+
+    def join(self, out):
+        """
+        Rows to append for the next chunk, out as derived from its records alone.
+        """
+        if self.period is None or out.empty:
+            return out
+        if self.last is not None:
+            gap = pd.date_range(self.last.index[0] + self.period, out.index[0] - self.period, freq=self.period,
+                                name=out.index.name, unit=out.index.unit)
+            empty = pd.DataFrame(np.nan, index=gap, columns=out.columns)
+            empty[[c for c in self.counts if c in empty]] = 0
+            out = pd.concat([self.last, empty.astype(out.dtypes.to_dict()), out])
+            if self.fill == "ffill":
+                out = out.ffill()
+            out = out.iloc[1:]
+        self.last = out.iloc[-1:]
+        return out
+
+
+# --- Derive ----------------------------------------------------------------------------
+def _derive(frames, rules, thermo):
+    for rule in rules:
+        frame = next((f for f in frames if all(c in f for c in rule["inputs"])), None)
+        if frame is None:
+            raise ValueError(f"no frame holds the inputs {rule['inputs']} of {rule['variable']}")
+        inputs = [frame[c].to_numpy(dtype=float) for c in rule["inputs"]]
+        frame[rule["variable"]] = FUNCTIONS[rule["function"]](*inputs, thermo=thermo)
+
+
+def derive(df, spec, tolerance=None, thermo="normand"):
+    """
+    Output frame of the datastream from its records, indexed by time.
+    """
+    return derive_many(df, {None: spec}, tolerance, thermo)[None]
+
+
+def derive_many(df, specs, tolerance=None, thermo="normand"):
+    """
+    Output frames {name: frame} of datastreams sharing one source, from the records of the
+    source (select() of any of them).
+    """
+    first = next(iter(specs.values()))
+    with sage_metrics.phase("pivot", rows_in=len(df)) as m:
+        frames = [sage_pivot.pivot(df, group, tolerance=tolerance) for group in first["groups"]]
+        m["rows_out"] = sum(len(f) for f in frames)
+
+    with sage_metrics.phase("thermo", rows_in=len(frames[0])) as m:
+        _derive(frames, first.get("derive", []), thermo)
+        resampled = [name for name, spec in specs.items() if spec.get("resample")]
+        outs = dict(zip(resampled, _resample(frames, [specs[name]["resample"] for name in resampled])))
+        for name, spec in specs.items():
+            if name in outs:
+                _derive([outs[name]], spec["resample"].get("derive", []), thermo)
+            else:
+                outs[name] = frames[0].join(frames[1:]) if len(frames) > 1 else frames[0]
+        m["rows_out"] = sum(len(out) for out in outs.values())
+
+    return {name: outs[name].reindex(columns=list(spec["variables"])) for name, spec in specs.items()}
+
+
+def dataset(df, spec, global_attrs):
+    import xarray as xr
+
+    with sage_metrics.phase("dataset", rows_in=len(df)) as m:
+        ds = xr.Dataset.from_dataframe(df)
+        ds = ds.sortby('time')
+        ds = ds.assign_attrs(global_attrs, **spec.get("attrs", {}))
+        for variable, attrs in spec["variables"].items():
+            ds[variable] = ds[variable].assign_attrs(attrs)
+        # Ensure time is saved properly
+        ds["time"] = pd.to_datetime(ds.time)
+        m["rows_out"] = ds.sizes['time']
+    return ds
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""
+Per-phase metrics of the executables, and a collector that aggregates them across a run.
+
+An executable calls start() once, then wraps each phase (query, pivot, thermo, dataset,
+write, ...) in `with sage_metrics.phase("query") as m:` and sets m["rows_out"] and friends.
+Repeated phases (one per chunk or per day) are summed into one record per phase and
+context. Records are appended as JSON lines to the --metrics file of the job:
+
+    {"executable": "wxt-ingest", "date": "2024-06-01", "phase": "query", "calls": 1,
+     "wall_s": 2.1, "cpu_s": 1.7, "rows_in": null, "rows_out": 16848, "peak_rss_mb": 162.4,
+     "bytes_written": null, "ok": true, "host": "...", "pid": 1234}
+
+peak_rss_mb is the peak RSS of the process at the end of the phase, so the phase where it
+jumps is the one that allocated. Without start() the phases are not recorded. Phases that
+run in pool workers are recorded there and merged into the records of the parent.
+
+As a command, the metrics files found under the given paths are aggregated per executable
+and phase (--by) and printed, or written to --output (.csv or .parquet):
+
+    sage_metrics.py output/ --by executable,phase
+"""
+import os
+import sys
+import json
+import time
+import socket
+import resource
+from pathlib import Path
+from contextlib import contextmanager
+from argparse import ArgumentParser
+
+COUNTS = ["rows_in", "rows_out", "bytes_written"]
+FIELDS = ["executable", "phase", "calls", "wall_s", "cpu_s", "peak_rss_mb", "ok"] + COUNTS
+
+_current = None
+
+
+class Metrics():
+    def __init__(self, executable, path=None):
+        self.executable = executable
+        self.path = path
+        self.context = {}
+        self.records = {}
+
+    def _record(self, name):
+        key = (json.dumps(self.context, sort_keys=True, default=str), name)
+        if key not in self.records:
+            self.records[key] = dict({"executable": self.executable}, **self.context, phase=name, calls=0, wall_s=0.0,
+                                     cpu_s=0.0, rows_in=None, rows_out=None, peak_rss_mb=None, bytes_written=None, ok=True)
+        return self.records[key]
+
+    def count(self, name, **counts):
+        """
+        Add rows or bytes to a phase without timing anything.
+        """
+        record = self._record(name)
+        for k, v in counts.items():
+            if v is not None:
+                record[k] = (record[k] or 0) + int(v)
+
+    @contextmanager
+    def phase(self, name, rows_in=None):
+        counts = {"rows_in": rows_in}
+        wall, cpu = time.perf_counter(), time.process_time()
+        ok = False
+        try:
+            yield counts
+            ok = True
+        finally:
+            record = self._record(name)
+            record["calls"] += 1
+            record["wall_s"] += time.perf_counter() - wall
+            record["cpu_s"] += time.process_time() - cpu
+            record["peak_rss_mb"] = peak_rss_mb()
+            record["ok"] &= ok
+            self.count(name, **{k: v for k, v in counts.items() if k in COUNTS})
+
+    def merge(self, records):
+        """
+        Add the records of another process, like a pool worker, to the ones of this process.
+        """
+        for record in records:
+            context = {k: v for k, v in record.items() if k not in FIELDS}
+            key = (json.dumps(context, sort_keys=True, default=str), record["phase"])
+            if key not in self.records:
+                self.records[key] = dict(record, executable=self.executable)
+                continue
+            own = self.records[key]
+            own["calls"] += record["calls"]
+            own["wall_s"] += record["wall_s"]
+            own["cpu_s"] += record["cpu_s"]
+            own["peak_rss_mb"] = max(filter(None, [own["peak_rss_mb"], record["peak_rss_mb"]]), default=None)
+            own["ok"] &= record["ok"]
+            for k in COUNTS:
+                if record[k] is not None:
+                    own[k] = (own[k] or 0) + record[k]
+
+    def write(self):
+        if not self.path or not self.records:
+            return
+        # workflows declare the metrics files in a subdirectory of the job, like metrics/<job>.metrics.jsonl
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as f:
+            for record in self.records.values():
+                f.write(json.dumps(dict(record, host=socket.gethostname(), pid=os.getpid())) + "\n")
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024**2 if sys.platform == "darwin" else 1024), 1)
+
+
+def start(executable, path=None):
+    """
+    Start recording the phases of this process, written to path by write().
+    """
+    global _current
+    _current = Metrics(executable, path)
+    return _current
+
+
+def phase(name, rows_in=None):
+    if _current is None:
+        return _noop()
+    return _current.phase(name, rows_in)
+
+
+@contextmanager
+def _noop():
+    yield {}
+
+
+def count(name, **counts):
+    if _current is not None:
+        _current.count(name, **counts)
+
+
+def set_context(**context):
+    """
+    Fields added to the following records, like the date a multi-day job works on.
+    """
+    if _current is not None:
+        _current.context = context
+
+
+def state():
+    """
+    Executable and context of the recording in this process, None without start(). Pool
+    workers start a recording from it and hand their records() back to merge().
+    """
+    if _current is None:
+        return None
+    return _current.executable, dict(_current.context)
+
+
+def records():
+    return [] if _current is None else list(_current.records.values())
+
+
+def merge(records):
+    if _current is not None:
+        _current.merge(records)
+
+
+def write():
+    if _current is not None:
+        _current.write()
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+# --- Collector ----------------------------------------------------------------------
+def load(paths):
+    import pandas as pd
+
+    files = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.rglob("*.metrics.jsonl")) if path.is_dir() else [path])
+
+    records = []
+    for f in files:
+        with open(f) as lines:
+            records.extend(dict(json.loads(line), file=f.name) for line in lines if line.strip())
+    return pd.DataFrame(records)
+
+
+def _total(values):
+    # phases that never counted rows or bytes stay empty instead of 0
+    return values.sum(min_count=1)
+
+
+def aggregate(df, by=("executable", "phase")):
+    """
+    Totals, means and maxima of the phase records grouped by the given fields.
+    """
+    by = list(by)
+    grouped = df.groupby(by, sort=True, dropna=False)
+    out = grouped.agg(
+        jobs=("file", "nunique"),
+        calls=("calls", "sum"),
+        wall_s=("wall_s", "sum"),
+        wall_mean_s=("wall_s", "mean"),
+        wall_max_s=("wall_s", "max"),
+        cpu_s=("cpu_s", "sum"),
+        rows_in=("rows_in", _total),
+        rows_out=("rows_out", _total),
+        peak_rss_mb=("peak_rss_mb", "max"),
+        bytes_written=("bytes_written", _total),
+        failed=("ok", lambda ok: int((~ok.astype(bool)).sum())),
+    )
+    out["cpu_share"] = (out["cpu_s"] / out["wall_s"]).round(2)
+    out["wall_share"] = (out["wall_s"] / out["wall_s"].sum()).round(3)
+    return out
+
+
+def main():
+    parser = ArgumentParser(description="Aggregate the per-phase metrics of a workflow run")
+    parser.add_argument("paths", metavar="STR", type=str, nargs="+", help="Metrics files, or directories searched for *.metrics.jsonl")
+    parser.add_argument("--by", metavar="STR", type=str, default="executable,phase", help="Comma separated fields to group by (default: executable,phase)")
+    parser.add_argument("--output", metavar="STR", type=str, default=None, help="Write the aggregate to this .csv or .parquet file (default: print)")
+
+    args = parser.parse_args()
+
+    df = load(args.paths)
+    if df.empty:
+        print("No metrics records found")
+        sys.exit(1)
+
+    out = aggregate(df, args.by.split(","))
+    if args.output and args.output.endswith(".parquet"):
+        out.reset_index().to_parquet(args.output, index=False)
+    elif args.output:
+        out.to_csv(args.output)
+    else:
+        import pandas as pd
+        with pd.option_context("display.width", 200, "display.max_columns", None):
+            print(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+netCDF encoding profiles and the incremental writer of the streaming ingest mode.
+
+The appender adds rows along an unlimited time dimension, so an ingest only needs to keep
+the chunk it is currently processing in memory.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+TIME_UNITS = "microseconds since 1970-01-01 00:00:00"
+TICKS_PER_NS = {"seconds": 10**9, "milliseconds": 10**6, "microseconds": 10**3, "nanoseconds": 1}
+TIME_FREQ = {"seconds": "s", "milliseconds": "ms", "microseconds": "us", "nanoseconds": "ns"}
+
+# raw records keep the nanoseconds of their timestamps whatever the profile
+RAW_TIME_UNITS = "nanoseconds"
+
+# encoding profiles of the a1 outputs
+#   complevel/shuffle: zlib compression, dtype: storage type of the data variables,
+#   significant_digits: decimals kept before compression (lossy), chunk: time steps per chunk,
+#   time_units: integer time encoding of the resampled outputs (raw ones use RAW_TIME_UNITS)
+ENCODING_PROFILES = {
+    # what xarray writes by default, float64 without compression or chunking
+    "none": {},
+    # lossless compression
+    "zlib": {"complevel": 4, "shuffle": True, "chunk": 8640, "time_units": "milliseconds"},
+    # float32 storage, well within the precision of the CROCUS instruments
+    "compact": {"complevel": 4, "shuffle": True, "dtype": "f4", "chunk": 8640, "time_units": "milliseconds"},
+    # smallest files, values rounded to 3 decimals before compression
+    "archive": {"complevel": 9, "shuffle": True, "dtype": "f4", "significant_digits": 3, "chunk": 8640, "time_units": "milliseconds"},
+}
+
+
+def time_unit(profile="none", time_units=None):
+    """
+    Unit of the time encoding: time_units if given, the one of the profile otherwise.
+    """
+    return time_units or ENCODING_PROFILES[profile].get("time_units", "microseconds")
+
+
+def _time_units(profile, time_units=None):
+    return f"{time_unit(profile, time_units)} since 1970-01-01 00:00:00"
+
+
+def round_time(index, profile="none", time_units=None):
+    """
+    Times rounded to the unit of the time encoding, what all the writers store.
+    """
+    return pd.DatetimeIndex(index).round(TIME_FREQ[time_unit(profile, time_units)])
+
+
+def time_ticks(index, profile="none", time_units=None):
+    """
+    Integer times in the unit of the time encoding since the epoch.
+    """
+    return round_time(index, profile, time_units).as_unit("ns").asi8 // TICKS_PER_NS[time_unit(profile, time_units)]
+
+
+def write(ds, fname, profile="none", time_units=None):
+    """
+    Write a dataset with the encoding profile, times rounded like the appender does.
+    """
+    ds = ds.assign_coords(time=round_time(ds.time.values, profile, time_units))
+    ds.to_netcdf(fname, format='NETCDF4', encoding=encoding(ds.data_vars, ds.sizes['time'], profile, time_units))
+
+
+def encoding(variables, nrows, profile="none", time_units=None):
+    """
+    xarray to_netcdf encoding of the data variables and time for an encoding profile.
+    """
+    name = profile
+    profile = ENCODING_PROFILES[profile]
+    if not profile:
+        return {}
+
+    var_encoding = {"zlib": True, "complevel": profile["complevel"], "shuffle": profile["shuffle"],
+                    "dtype": profile.get("dtype", "f8"), "_FillValue": np.nan}
+    if "significant_digits" in profile:
+        var_encoding["least_significant_digit"] = profile["significant_digits"]
+    if nrows > 0:
+        var_encoding["chunksizes"] = (min(profile["chunk"], nrows),)
+
+    enc = {name: dict(var_encoding) for name in variables}
+    enc["time"] = {"units": _time_units(name, time_units), "calendar": "proleptic_gregorian", "dtype": "i8"}
+    if nrows > 0:
+        enc["time"]["chunksizes"] = (min(profile["chunk"], nrows),)
+    return enc
+
+
+class NetCDFAppender():
+    def __init__(self, fname, global_attrs=None, var_attrs=None, profile="none", time_units=None):
+        self.fname = fname
+        self.global_attrs = global_attrs or {}
+        self.var_attrs = var_attrs or {}
+        self.profile_name = profile
+        self.profile = ENCODING_PROFILES[profile]
+        self.time_units = time_units
+        self.nc = None
+        self.rows = 0
+
+    def _create(self, columns):
+        import netCDF4
+
+        try:
+            os.remove(self.fname)
+        except OSError:
+            pass
+
+        self.nc = netCDF4.Dataset(self.fname, mode="w", format="NETCDF4")
+        self.nc.setncatts(self.global_attrs)
+        self.nc.createDimension("time", None)
+
+        # the time dimension is unlimited, so chunking always applies
+        chunk = self.profile.get("chunk", 1024)
+        compression = {}
+        if self.profile:
+            compression = {"zlib": True, "complevel": self.profile["complevel"], "shuffle": self.profile["shuffle"]}
+
+        time = self.nc.createVariable("time", "i8", ("time",), chunksizes=(chunk,), **compression)
+        time.setncatts({"units": _time_units(self.profile_name, self.time_units), "calendar": "proleptic_gregorian"})
+
+        for column in columns:
+            var = self.nc.createVariable(column, self.profile.get("dtype", "f8"), ("time",), fill_value=np.nan,
+                                         chunksizes=(chunk,), least_significant_digit=self.profile.get("significant_digits"),
+                                         **compression)
+            var.setncatts(self.var_attrs.get(column, {}))
+
+    def append(self, df):
+        """
+        Append a frame indexed by (tz naive, UTC) time. Columns are fixed by the first call.
+        """
+        if df.empty:
+            return
+        if self.nc is None:
+            self._create(df.columns)
+
+        df = df.sort_index()
+        n = len(df)
+        self.nc["time"][self.rows:self.rows + n] = time_ticks(df.index, self.profile_name, self.time_units)
+        for column in df.columns:
+            self.nc[column][self.rows:self.rows + n] = df[column].to_numpy(dtype=float)
+
+        self.rows += n
+        self.nc.sync()
+
+    def close(self):
+        if self.nc is not None:
+            self.nc.close()
+            self.nc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""
+Per-node processing of queries that cover several nodes.
+
+The ingest scripts query a set of VSNs in one request (a regular expression like
+"W08D|W0A1"), split the result by meta.vsn and derive every node in a process pool, writing
+one file per node. The site metadata of the outputs (site_ID, CAMS_tag, datastream,
+coordinates) comes from crocus_sites.csv, one row per node and instrument, staged next to
+this module:
+
+    vsn,instrument,site_ID,CAMS_tag,datastream,latitude,longitude
+    W08D,aqt,NEIU,CMS-AQT-001,CMS_aqt580_NEIU_a1,41.9804526,-87.7196038
+
+Nodes missing from the table are named by their VSN and get no coordinates.
+"""
+import os
+import csv
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import sage_metrics
+
+SITES_FILE = Path(__file__).resolve().parent / "crocus_sites.csv"
+
+# attributes of every output file, the table adds the per site ones
+GLOBAL_ATTRS = {"conventions": "CF 1.10", "datalevel": "a1"}
+
+_sites = None
+
+
+def load_sites(path=SITES_FILE):
+    """
+    {(vsn, instrument): row} of a site table, coordinates parsed.
+    """
+    table = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            vsn, instrument = row.pop("vsn"), row.pop("instrument")
+            for k in ("latitude", "longitude"):
+                row[k] = float(row[k]) if row.get(k) else None
+            table[(vsn, instrument)] = {k: v for k, v in row.items() if v is not None}
+    return table
+
+
+def sites():
+    global _sites
+    if _sites is None:
+        _sites = load_sites()
+    return _sites
+
+
+def site_id(vsn, instrument=None):
+    """
+    site_ID of the node, the VSN if the table does not know it.
+    """
+    for (v, i), row in sites().items():
+        if v == vsn and instrument in (None, i):
+            return row["site_ID"]
+    return vsn
+
+
+def global_attrs(vsn, instrument, datalevel="a1"):
+    """
+    Global attributes of an output, the datastream of the table names its a1 level.
+    """
+    row = sites().get((vsn, instrument))
+    if row is None:
+        print(f"{vsn} is not in {SITES_FILE.name}, writing it without site metadata")
+        row = {"site_ID": vsn}
+    attrs = dict(GLOBAL_ATTRS, **row)
+    if datalevel != "a1":
+        attrs["datalevel"] = datalevel
+        if attrs.get("datastream", "").endswith("_a1"):
+            attrs["datastream"] = attrs["datastream"][:-3] + f"_{datalevel}"
+    return attrs
+
+
+def output_name(vsn, instrument, st, product=None, datalevel="a1"):
+    """
+    crocus-<site>-<product>-<datalevel>-%Y%m%d-%H%M%S.nc, crocus-neiu-aqt-a1-... for W08D.
+    The product is the instrument by default.
+    """
+    return st.strftime(f"crocus-{site_id(vsn, instrument).lower()}-{product or instrument}-{datalevel}-%Y%m%d-%H%M%S.nc")
+
+
+def vsn_filter(vsns):
+    """
+    Query filter value for a list of VSNs, or a regular expression passed through.
+    """
+    return vsns if isinstance(vsns, str) else "|".join(vsns)
+
+
+def split(df, column="meta.vsn"):
+    """
+    {vsn: rows of that node} in VSN order, without the column.
+    """
+    if df.empty:
+        return {}
+    return {vsn: part.drop(columns=column) for vsn, part in df.groupby(column, sort=True, observed=True)}
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _run_node(fn, state, vsn, args):
+    if state is not None:
+        sage_metrics.start(state[0])
+        sage_metrics.set_context(**state[1], vsn=vsn)
+    return fn(vsn, *args), sage_metrics.records()
+
+
+def map_nodes(fn, nodes, workers=0):
+    """
+    Call fn(vsn, *args) for every vsn: args of nodes, in a pool of workers processes (0 for
+    all available cores). Returns {vsn: result}. The phases fn records are tagged with the vsn.
+    """
+    workers = min(workers or available_cores(), len(nodes))
+    state = sage_metrics.state()
+
+    results = {}
+    if workers <= 1:
+        for vsn, args in nodes.items():
+            if state is not None:
+                sage_metrics.set_context(**state[1], vsn=vsn)
+            results[vsn] = fn(vsn, *args)
+        if state is not None:
+            sage_metrics.set_context(**state[1])
+        return results
+
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {vsn: pool.submit(_run_node, fn, state, vsn, args) for vsn, args in nodes.items()}
+        for vsn, future in futures.items():
+            results[vsn], records = future.result()
+            sage_metrics.merge(records)
+    return results
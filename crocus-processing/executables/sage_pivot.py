@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+"""
+Long to wide conversion of Sage query results.
+
+sage_data_client returns one row per (timestamp, name, value). The ingest scripts need one
+column per measurement name aligned on time, which pivot builds in a single pass over the frame.
+"""
+import pandas as pd
+
+
+def pivot(df, names, tolerance=None, anchor=None):
+    """
+    Turn a long frame into a wide frame indexed by time, with one float column per entry of
+    names ({sage name: column name}, columns keep that order).
+
+    Without tolerance, samples are matched on identical timestamps. With a tolerance
+    (pandas Timedelta or anything it accepts), every channel is as-of joined onto the
+    timestamps of the anchor channel (first entry of names by default), taking the nearest
+    sample within the tolerance. A channel that drops samples then gets NaN at those times
+    instead of shifting its remaining values.
+    """
+    columns = list(names.values())
+
+    df = df[df["name"].isin(names.keys())]
+    if df.empty:
+        return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name="time"), dtype=float)
+
+    long = pd.DataFrame({
+        "time": pd.DatetimeIndex(df["timestamp"]).tz_convert(None),
+        "column": df["name"].map(names),
+        "value": pd.to_numeric(df["value"], errors="coerce"),
+    })
+
+    if tolerance is None:
+        wide = long.groupby(["time", "column"], sort=True, observed=True).value.first().unstack("column")
+        return wide.reindex(columns=columns)
+
+    tolerance = pd.Timedelta(tolerance)
+    anchor = names[anchor] if anchor is not None else columns[0]
+    long = long.sort_values("time", kind="stable")
+
+    channels = dict(tuple(long.groupby("column", sort=False, observed=True)))
+    if anchor not in channels:
+        return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name="time"), dtype=float)
+
+    wide = channels[anchor][["time", "value"]].drop_duplicates("time").rename(columns={"value": anchor})
+    for column in columns:
+        if column == anchor:
+            continue
+        if column not in channels:
+            wide[column] = float("nan")
+            continue
+        other = channels[column][["time", "value"]].drop_duplicates("time").rename(columns={"value": column})
+        wide = pd.merge_asof(wide, other, on="time", tolerance=tolerance, direction="nearest")
+
+    return wide.set_index("time")[columns]
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+"""
+Local on-disk cache in front of sage_data_client.query.
+
+Query results are stored as parquet files, grouped in a directory per query filter and
+named after the time window they cover. A query is answered from the cache when a cached
+window of the same filter covers it, otherwise the data are pulled from Beehive and stored.
+Relative windows ("-1h") and windows that end too close to now are never cached.
+
+Responses are parsed into typed frames while they are read (see load): datetime64 timestamps,
+float values and categorical name/meta.* columns, optionally only the requested columns.
+typed=False returns the frames of sage_data_client unchanged.
+
+The cache location is taken from SAGE_CACHE_DIR, setting it to an empty string disables it.
+SAGE_QUERY_ENDPOINT points the queries at another query API, like the local stand-in of
+benchmarks/sage_synthetic.py.
+"""
+import os
+import json
+import gzip
+import hashlib
+import tempfile
+from array import array
+from pathlib import Path
+from datetime import timedelta
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pandas as pd
+import sage_data_client
+from sage_data_client.query import resolve_time, timestr
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+CACHE_DIR = os.environ.get("SAGE_CACHE_DIR", os.path.join(Path.home(), ".cache", "sage-query"))
+CACHE_MAX_BYTES = int(os.environ.get("SAGE_CACHE_MAX_BYTES", 10 * 1024**3))
+CACHE_MAX_AGE = timedelta(days=int(os.environ.get("SAGE_CACHE_MAX_AGE_DAYS", 30)))
+ENDPOINT = os.environ.get("SAGE_QUERY_ENDPOINT")
+DEFAULT_ENDPOINT = "https://data.sagecontinuum.org/api/v1/query"
+
+# windows ending closer than this to now may still receive data
+SETTLE_TIME = timedelta(hours=1)
+
+# aggregations cached like the records, their buckets only answer the exact same window
+CACHED_AGGREGATIONS = ("experimental_func", "experimental_window")
+
+
+def _to_utc(t):
+    ts = pd.Timestamp(t)
+    if ts.tzinfo is None:
+        return ts.tz_localize("UTC")
+    return ts.tz_convert("UTC")
+
+
+def _cacheable_window(start, end):
+    if end is None:
+        return None
+
+    for t in (start, end):
+        if isinstance(t, str) and t.startswith(("+", "-")):
+            return None
+
+    try:
+        start, end = _to_utc(start), _to_utc(end)
+    except (TypeError, ValueError):
+        return None
+
+    if end <= start or end > pd.Timestamp.now(tz="UTC") - SETTLE_TIME:
+        return None
+
+    return start, end
+
+
+def _key_dir(cache_dir, filter, aggregation=None):
+    key = [filter or {}, ENDPOINT] if ENDPOINT else filter or {}
+    key = json.dumps([key, aggregation] if aggregation else key, sort_keys=True)
+    key_dir = Path(cache_dir) / hashlib.sha1(key.encode()).hexdigest()[:16]
+    if not key_dir.exists():
+        key_dir.mkdir(parents=True, exist_ok=True)
+        (key_dir / "filter.json").write_text(key)
+    return key_dir
+
+
+def _entries(key_dir):
+    for path in key_dir.glob("*.parquet"):
+        try:
+            s, e = map(int, path.stem.split("_"))
+        except ValueError:
+            continue
+        yield path, s, e
+
+
+def _lookup(key_dir, start, end, exact=False):
+    best = None
+    for path, s, e in _entries(key_dir):
+        covers = (s, e) == (start.value, end.value) if exact else s <= start.value and e >= end.value
+        if covers:
+            if best is None or (e - s) < (best[2] - best[1]):
+                best = (path, s, e)
+    return best
+
+
+def _store(key_dir, start, end, df, prune=True):
+    fd, tmp = tempfile.mkstemp(dir=key_dir, suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp, index=False)
+    except (ImportError, ValueError, TypeError) as e:
+        # mixed-type values can't be written as a column, just skip caching them
+        print(f"Not caching query result: {e}")
+        os.remove(tmp)
+        return
+
+    os.replace(tmp, key_dir / f"{start.value}_{end.value}.parquet")
+    if not prune:
+        return
+
+    # cached windows inside the new one are now redundant
+    for path, s, e in _entries(key_dir):
+        if s >= start.value and e <= end.value and (s, e) != (start.value, end.value):
+            path.unlink(missing_ok=True)
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, max_age=CACHE_MAX_AGE):
+    """
+    Drop cache entries not used within max_age, then least recently used entries
+    until the cache fits in max_bytes.
+    """
+    now = pd.Timestamp.now().timestamp()
+    entries = []
+    for path in Path(cache_dir).glob("*/*.parquet"):
+        st = path.stat()
+        if now - st.st_mtime > max_age.total_seconds():
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+def _timestamps(timestamps):
+    """
+    datetime64[ns, UTC] of the record timestamps: RFC3339 strings like the query API sends,
+    or integer nanoseconds since the epoch.
+    """
+    if isinstance(timestamps[0], int):
+        try:
+            return pd.to_datetime(np.array(timestamps, dtype=np.int64), unit="ns", utc=True)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True, format="ISO8601")).as_unit("ns")
+
+
+def load(fileobj, columns=None):
+    """
+    Parse a query response (newline delimited JSON records) into a frame with a datetime64[ns, UTC]
+    timestamp, a float value (object when some values are not numbers) and categorical name
+    and meta.* columns, built from integer codes so repeated strings are stored once.
+    columns keeps only the given columns, the others are skipped while parsing.
+    """
+    keep = set(columns) if columns is not None else None
+    want_time = keep is None or "timestamp" in keep
+    want_value = keep is None or "value" in keep
+
+    timestamps = []
+    values = []
+    categories = {}
+    rows = 0
+    for line in fileobj:
+        if not line.strip():
+            continue
+        r = _loads(line)
+        if want_time:
+            timestamps.append(r["timestamp"])
+        if want_value:
+            values.append(r["value"])
+
+        fields = [("name", r["name"])] + [("meta." + k, v) for k, v in r["meta"].items()]
+        for column, v in fields:
+            if keep is not None and column not in keep:
+                continue
+            if column not in categories:
+                # column first seen in this row, earlier rows did not have it
+                categories[column] = ({}, array("i", [-1]) * rows)
+            index, codes = categories[column]
+            codes.append(index.setdefault(v, len(index)))
+        rows += 1
+        for index, codes in categories.values():
+            if len(codes) < rows:
+                codes.append(-1)
+
+    if rows == 0:
+        # same columns as an empty sage_data_client frame
+        df = pd.DataFrame({"timestamp": pd.to_datetime(np.array([], dtype=np.int64), unit="ns", utc=True), "name": pd.Categorical([]), "value": np.array([], dtype=float)})
+        return df[[c for c in columns if c in df.columns]] if columns is not None else df
+
+    data = {}
+    if want_time:
+        data["timestamp"] = _timestamps(timestamps)
+    if want_value:
+        try:
+            data["value"] = np.array(values, dtype=float)
+        except (TypeError, ValueError):
+            data["value"] = pd.Series(values, dtype=object)
+    for column, (index, codes) in categories.items():
+        data[column] = pd.Categorical.from_codes(np.frombuffer(codes, dtype=np.int32), list(index))
+
+    # column order of sage_data_client: timestamp, name, value, meta.*
+    order = ["timestamp", "name", "value"] + [c for c in data if c.startswith("meta.")]
+    df = pd.DataFrame(data)[[c for c in order if c in data]]
+    return df[[c for c in columns if c in df.columns]] if columns is not None else df
+
+
+def _fetch(start, end=None, filter=None, columns=None, **kwargs):
+    """
+    sage_data_client.query, with the response parsed by load.
+    """
+    q = {"start": timestr(resolve_time(start))}
+    if end is not None:
+        q["end"] = timestr(resolve_time(end))
+    if filter is not None:
+        q["filter"] = filter
+    q.update(kwargs)
+
+    request = Request(ENDPOINT or DEFAULT_ENDPOINT, json.dumps(q).encode(), headers={"Accept-Encoding": "gzip"})
+    with urlopen(request) as f:
+        if "gzip" in f.headers.get("Content-Encoding", ""):
+            f = gzip.GzipFile(fileobj=f, mode="rb")
+        return load(f, columns)
+
+
+def _client_query(typed=True, columns=None, **kwargs):
+    if typed:
+        return _fetch(columns=columns, **kwargs)
+
+    if ENDPOINT:
+        kwargs.setdefault("endpoint", ENDPOINT)
+    df = sage_data_client.query(**kwargs)
+    return df[[c for c in columns if c in df.columns]] if columns is not None else df
+
+
+def query(start, end=None, filter=None, cache_dir=CACHE_DIR, columns=None, typed=True, **kwargs):
+    """
+    Drop-in replacement of sage_data_client.query that goes through the local cache.
+    columns selects the returned columns (for example ["timestamp", "name", "value"]).
+    Aggregations (experimental_func, experimental_window) are cached per exact window, other
+    extra keyword arguments (head, tail, bucket, ...) and typed=False bypass the cache.
+    """
+    window = _cacheable_window(start, end)
+    if not cache_dir or window is None or set(kwargs) - set(CACHED_AGGREGATIONS) or not typed:
+        return _client_query(typed=typed, columns=columns, start=start, end=end, filter=filter, **kwargs)
+
+    start, end = window
+    key_dir = _key_dir(cache_dir, filter, kwargs)
+
+    hit = _lookup(key_dir, start, end, exact=bool(kwargs))
+    if hit is not None:
+        path, s, e = hit
+        print(f"Cache hit {path}")
+        os.utime(path)
+        df = pd.read_parquet(path, columns=None if columns is None else list(set(columns) | {"timestamp"}))
+        if (s, e) != (start.value, end.value):
+            df = df[(df["timestamp"] >= start) & (df["timestamp"] < end)].reset_index(drop=True)
+        return df[[c for c in columns if c in df.columns]] if columns is not None else df
+
+    # the cache keeps every column, later queries may ask for others
+    df = _client_query(
+        start=start.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        end=end.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        filter=filter,
+        **kwargs
+    )
+    _store(key_dir, start, end, df, prune=not kwargs)
+    evict(cache_dir)
+    return df[[c for c in columns if c in df.columns]] if columns is not None else df
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Vectorized dewpoint and wet-bulb temperature on plain NumPy arrays.
+
+These follow the formulations used by MetPy (Ambaum 2020 saturation vapor pressure, the
+Bolton style dewpoint inversion and Normand's rule for wet-bulb), but operate on whole
+arrays at once instead of integrating a moist adiabat point by point. Inputs and outputs
+are in hPa, degrees Celsius and percent.
+"""
+import numpy as np
+
+# constants as defined by metpy.constants
+T0 = 273.16
+ZERO_DEGC = 273.15
+SAT_PRESSURE_0C = 6.112
+LV = 2500840.0
+RV = 461.52311572606084
+RD = 287.04749097718457
+CP_D = 1004.6662184201462
+CP_L = 4219.4
+CP_V = 1860.078011865639
+EPSILON = 0.6219569100577033
+
+WETBULB_METHODS = ["normand", "stull"]
+
+
+def saturation_vapor_pressure(temperature):
+    """
+    Saturation vapor pressure over liquid water (hPa) for temperature in degC.
+    """
+    t = np.asarray(temperature, dtype=float) + ZERO_DEGC
+    latent_heat = LV - (CP_L - CP_V) * (t - T0)
+    heat_power = (CP_L - CP_V) / RV
+    return SAT_PRESSURE_0C * (T0 / t) ** heat_power * np.exp((LV / T0 - latent_heat / t) / RV)
+
+
+def dewpoint(vapor_pressure):
+    """
+    Dewpoint (degC) for water vapor pressure in hPa.
+    """
+    val = np.log(np.asarray(vapor_pressure, dtype=float) / SAT_PRESSURE_0C)
+    return 243.5 * val / (17.67 - val)
+
+
+def dewpoint_from_relative_humidity(temperature, relative_humidity):
+    """
+    Dewpoint (degC) for temperature in degC and relative humidity in percent.
+    """
+    rh = np.asarray(relative_humidity, dtype=float) / 100.0
+    return dewpoint(rh * saturation_vapor_pressure(temperature))
+
+
+def _lambertw_minus1(x, iterations=8):
+    # lower branch W_{-1} of the Lambert W function for -1/e <= x < 0, Halley iterations
+    x = np.asarray(x, dtype=float)
+    near_branch = x < -0.25
+    p = -np.sqrt(np.maximum(2 * (1 + np.e * x), 0))
+    log_x = np.log(-np.where(near_branch, -0.5, x))
+    w = np.where(near_branch, -1 + p - p * p / 3 + 11 / 72 * p ** 3, log_x - np.log(-log_x))
+    for _ in range(iterations):
+        ew = np.exp(w)
+        f = w * ew - x
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = f / (ew * (w + 1) - (w + 2) * f / (2 * w + 2))
+        w = np.where(f == 0, w, w - step)
+    return w
+
+
+def lcl(pressure, temperature, dewpoint_c):
+    """
+    Pressure (hPa) and temperature (degC) of the lifted condensation level, using the
+    analytic solution of Romps (2017) like metpy.calc.lcl.
+    """
+    p = np.asarray(pressure, dtype=float)
+    t = np.asarray(temperature, dtype=float) + ZERO_DEGC
+    e = saturation_vapor_pressure(dewpoint_c)
+    rh = e / saturation_vapor_pressure(temperature)
+
+    w = EPSILON * e / (p - e)
+    q = w / (1 + w)
+    moist_heat_ratio = ((1 - q) * CP_D + q * CP_V) / ((1 - q) * RD + q * RV)
+    spec_heat_diff = CP_L - CP_V
+
+    a = moist_heat_ratio + spec_heat_diff / RV
+    b = -(LV + spec_heat_diff * T0) / (RV * t)
+    c = b / a
+
+    t_lcl = c / _lambertw_minus1(rh ** (1 / a) * c * np.exp(c)) * t
+    p_lcl = p * (t_lcl / t) ** moist_heat_ratio
+    return p_lcl, t_lcl - ZERO_DEGC
+
+
+def _moist_lapse_rate(p, t):
+    # dT/dp along a pseudo-adiabat, same expression as metpy.calc.moist_lapse
+    es = saturation_vapor_pressure(t - ZERO_DEGC)
+    rs = EPSILON * es / (p - es)
+    frac = (RD * t + LV * rs) / (CP_D + (LV * LV * rs * EPSILON / (RD * t ** 2)))
+    return frac / p
+
+
+def moist_lapse(pressure, temperature, reference_pressure, steps=16):
+    """
+    Temperature (degC) at pressure of parcels starting saturated at reference_pressure
+    with temperature, integrated with fixed-step RK4 for all parcels at once.
+    """
+    p0 = np.asarray(reference_pressure, dtype=float)
+    dp = (np.asarray(pressure, dtype=float) - p0) / steps
+    t = np.asarray(temperature, dtype=float) + ZERO_DEGC
+    p = p0
+    for _ in range(steps):
+        k1 = _moist_lapse_rate(p, t)
+        k2 = _moist_lapse_rate(p + dp / 2, t + dp * k1 / 2)
+        k3 = _moist_lapse_rate(p + dp / 2, t + dp * k2 / 2)
+        k4 = _moist_lapse_rate(p + dp, t + dp * k3)
+        t = t + dp * (k1 + 2 * k2 + 2 * k3 + k4) / 6
+        p = p + dp
+    return t - ZERO_DEGC
+
+
+def wet_bulb_temperature(pressure, temperature, dewpoint_c, method="normand"):
+    """
+    Wet-bulb temperature (degC).
+
+    normand: lift the parcel to its LCL and bring it back down along a moist adiabat,
+    as metpy.calc.wet_bulb_temperature does.
+    stull: Stull (2011) empirical fit from temperature and relative humidity, valid near
+    sea level for RH 5-99% and -20 to 50 degC, within about 1 degC.
+    """
+    if method == "normand":
+        p_lcl, t_lcl = lcl(pressure, temperature, dewpoint_c)
+        return moist_lapse(pressure, t_lcl, p_lcl)
+
+    if method == "stull":
+        t = np.asarray(temperature, dtype=float)
+        rh = 100.0 * saturation_vapor_pressure(dewpoint_c) / saturation_vapor_pressure(t)
+        return (t * np.arctan(0.151977 * np.sqrt(rh + 8.313659))
+                + np.arctan(t + rh) - np.arctan(rh - 1.676331)
+                + 0.00391838 * rh ** 1.5 * np.arctan(0.023101 * rh)
+                - 4.686035)
+
+    raise ValueError(f"Unknown wet-bulb method {method}, expected one of {WETBULB_METHODS}")
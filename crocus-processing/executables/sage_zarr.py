@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Time-chunked Zarr stores holding a whole datastream of a node, one day per chunk.
+
+Every day has a fixed slot of day_rows rows in the time dimension, at (day - origin) *
+day_rows, and the slot is one chunk of every array. Writing a day replaces its slot, rows
+past the end of the day are padding (NaT time, NaN values), so reruns overwrite instead of
+duplicating, and jobs writing different days of the same store never touch the same chunk.
+Creating and growing the store, and consolidating its metadata, happen under a lock file
+next to it (<store>.lock), the data is written outside the lock.
+
+The stores use the Zarr v2 format with consolidated metadata, so they open in one read:
+
+    ds = xr.open_zarr("crocus-neiu-wxt-a1.zarr")           # all days, padding included
+    ds = sage_zarr.read("crocus-neiu-wxt-a1.zarr", start, end)   # only the days asked for
+"""
+import os
+import fcntl
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import sage_netcdf
+
+# first day of the stores created without an explicit origin, days before it are rejected
+ORIGIN = "2024-01-01"
+
+# store attributes that are not global attributes of the datastream
+LAYOUT_ATTRS = ("origin", "day_rows", "variables")
+
+NAT = np.iinfo(np.int64).min
+
+
+def store_name(output_name):
+    """
+    Store of the daily output crocus-neiu-wxt-a1-20240601-000000.nc: crocus-neiu-wxt-a1.zarr.
+    """
+    return output_name.rsplit("-", 2)[0] + ".zarr"
+
+
+@contextmanager
+def _locked(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _compressors(profile):
+    from numcodecs import Blosc
+
+    if not profile.get("complevel"):
+        return None
+    shuffle = Blosc.SHUFFLE if profile.get("shuffle") else Blosc.NOSHUFFLE
+    return Blosc(cname="zstd", clevel=profile["complevel"], shuffle=shuffle)
+
+
+class ZarrStore():
+    def __init__(self, path, day_rows, global_attrs=None, var_attrs=None, profile="none", origin=ORIGIN, time_units=None):
+        self.path = path
+        self.day_rows = day_rows
+        self.global_attrs = global_attrs or {}
+        self.var_attrs = var_attrs or {}
+        self.profile_name = profile
+        self.profile = sage_netcdf.ENCODING_PROFILES[profile]
+        self.origin = pd.Timestamp(origin)
+        # times are rounded like the netCDF outputs, stored in microseconds unless finer
+        self.time_units = time_units
+        self.store_units = time_units or "microseconds"
+        self.group = None
+
+    def _create(self, columns, days):
+        import zarr
+
+        group = zarr.open_group(self.path, mode="w", zarr_format=2)
+        group.attrs.update(dict(self.global_attrs, origin=self.origin.strftime("%Y-%m-%d"), day_rows=self.day_rows, variables=columns))
+
+        shape, chunks = (days * self.day_rows,), (self.day_rows,)
+        compressors = _compressors(self.profile)
+        group.create_array("time", shape=shape, chunks=chunks, dtype="i8", fill_value=NAT, compressors=compressors,
+                           attributes={"_ARRAY_DIMENSIONS": ["time"], "units": f"{self.store_units} since 1970-01-01 00:00:00",
+                                       "calendar": "proleptic_gregorian"})
+        for column in columns:
+            group.create_array(column, shape=shape, chunks=chunks, dtype=self.profile.get("dtype", "f8"), fill_value=np.nan,
+                               compressors=compressors, attributes=dict(self.var_attrs.get(column, {}), _ARRAY_DIMENSIONS=["time"]))
+        return group
+
+    def _open(self, columns, days):
+        """
+        The store, created or grown to hold days days under the lock.
+        """
+        import zarr
+
+        with _locked(self.path):
+            if not os.path.exists(os.path.join(self.path, ".zmetadata")):
+                group = self._create(columns, days)
+            else:
+                group = zarr.open_group(self.path, mode="r+", zarr_format=2)
+                if group.attrs["day_rows"] != self.day_rows or group.attrs["origin"] != self.origin.strftime("%Y-%m-%d"):
+                    raise ValueError(f"{self.path} has {group.attrs['day_rows']} rows per day from {group.attrs['origin']}, "
+                                     f"not {self.day_rows} from {self.origin.strftime('%Y-%m-%d')}")
+                if group["time"].attrs["units"].split()[0] != self.store_units:
+                    raise ValueError(f"{self.path} stores times in {group['time'].attrs['units'].split()[0]}, not {self.store_units}")
+                missing = set(columns) - set(group.array_keys())
+                if missing:
+                    raise ValueError(f"{self.path} has no variables {', '.join(sorted(missing))}")
+                if group["time"].shape[0] >= days * self.day_rows:
+                    return group
+                for name in group.array_keys():
+                    group[name].resize((days * self.day_rows,))
+            zarr.consolidate_metadata(self.path, zarr_format=2)
+            return zarr.open_group(self.path, mode="r+", zarr_format=2)
+
+    def write(self, day, df, offset=0):
+        """
+        Write the rows of day, a frame indexed by (tz naive, UTC) time, at offset rows into
+        its slot. Writing at offset 0 replaces the whole slot.
+        """
+        day = pd.Timestamp(day).normalize()
+        index = (day - self.origin).days
+        if index < 0:
+            raise ValueError(f"{day.strftime('%Y-%m-%d')} is before the origin {self.origin.strftime('%Y-%m-%d')} of {self.path}")
+        if offset + len(df) > self.day_rows:
+            raise ValueError(f"{offset + len(df)} rows on {day.strftime('%Y-%m-%d')} do not fit the day slots of {self.path}, "
+                             f"limited to {self.day_rows} rows per day when it was created (day_rows), a new store with larger slots is needed")
+
+        if self.group is None or self.group["time"].shape[0] < (index + 1) * self.day_rows:
+            self.group = self._open(list(df.columns), index + 1)
+
+        start = index * self.day_rows + offset
+        stop = start + len(df) if offset else (index + 1) * self.day_rows
+        time = np.full(stop - start, NAT, dtype=np.int64)
+        time[:len(df)] = (sage_netcdf.round_time(df.index, self.profile_name, self.time_units).as_unit("ns").asi8
+                          // sage_netcdf.TICKS_PER_NS[self.store_units])
+        self.group["time"][start:stop] = time
+        for column in df.columns:
+            values = np.full(stop - start, np.nan)
+            values[:len(df)] = df[column].to_numpy(dtype=float)
+            self.group[column][start:stop] = values
+
+    def close(self):
+        self.group = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read(path, start, end, variables=None):
+    """
+    Dataset of the days from start to end (exclusive) of a store, without the padding.
+    Only the chunks of those days are read.
+    """
+    import zarr
+    import xarray as xr
+
+    group = zarr.open_consolidated(path, mode="r", zarr_format=2)
+    origin, day_rows = pd.Timestamp(group.attrs["origin"]), group.attrs["day_rows"]
+    first = max((pd.Timestamp(start).normalize() - origin).days, 0) * day_rows
+    last = min(max((pd.Timestamp(end) - origin).days, 0) * day_rows, group["time"].shape[0])
+
+    time = group["time"][first:last]
+    keep = time != NAT
+    variables = variables or group.attrs["variables"]
+    data = {}
+    for name in variables:
+        attrs = {k: v for k, v in group[name].attrs.items() if k != "_ARRAY_DIMENSIONS"}
+        data[name] = ("time", group[name][first:last][keep], attrs)
+
+    unit = group["time"].attrs["units"].split()[0]
+    coords = {"time": pd.to_datetime(time[keep] * sage_netcdf.TICKS_PER_NS[unit], unit="ns")}
+    attrs = {k: v for k, v in group.attrs.items() if k not in LAYOUT_ATTRS}
+    return xr.Dataset(data, coords=coords, attrs=attrs)
@@ -1,146 +1,229 @@
 #!/usr/bin/env python3
 
 import os
-import sage_data_client
-import matplotlib.pyplot as plt
+import sage_query
+import sage_pivot
+import sage_thermo
+import sage_netcdf
+import sage_metrics
+import sage_nodes
+import sage_datastreams
 import pandas as pd
-import numpy as np
-import datetime
-import xarray as xr
+from contextlib import ExitStack
 from datetime import datetime, timedelta
-from PIL import Image
 from time import time
 from argparse import ArgumentParser
-from matplotlib.dates import DateFormatter
-from metpy.units import units
-from metpy.calc import dewpoint_from_relative_humidity, wet_bulb_temperature
-
-wxt_global_NEIU = {'conventions': "CF 1.10",
-                   'site_ID' : "NEIU",
-                  'CAMS_tag' : "CMS-WXT-002",
-                  'datastream' : "CMS_wxt536_NEIU_a1",
-                  'datalevel' : "a1",
-                  'latitude' : 41.9804526,
-                  'longitude' : -87.7196038}
-
-var_attrs_wxt = {'temperature': {'standard_name' : 'air_temperature',
-                       'units' : 'celsius'},
-                'humidity': {'standard_name' : 'relative_humidity',
-                       'units' : 'percent'},
-                'dewpoint': {'standard_name' : 'dew_point_temperature',
-                       'units' : 'celsius'},
-                'pressure': {'standard_name' : 'air_pressure',
-                       'units' : 'hPa'},
-                'wetbulb': {'standard_name' : 'wet_bulb_temperature',
-                       'units' : 'celsius'},
-                'wetbulb': {'standard_name' : 'wet_bulb_temperature',
-                       'units' : 'celsius'},
-                'wind_dir_10s': {'standard_name' : 'wet_bulb_temperature',
-                       'units' : 'celsius'}}
-
-def ingest_wxt(st):
-    hours = 24
-    start = st.strftime('%Y-%m-%dT%H:%M:%SZ')
-    end = (st + timedelta(hours=hours)).strftime('%Y-%m-%dT%H:%M:%SZ')
-    print(f"Data start date {start}")
-    print(f"Data end date {end}")
-    df_temp = sage_data_client.query(start=start,
-                                     end=end, 
-                                        filter={
-                                            "name" : 'wxt.env.temp|wxt.env.humidity|wxt.env.pressure|wxt.rain.accumulation',
-                                            "plugin" : "registry.sagecontinuum.org/jrobrien/waggle-wxt536:0.23.5.*",
-                                            "vsn" : "W08D",
-                                            "sensor" : "vaisala-wxt536"
-                                        }
-    )
-    winds = sage_data_client.query(start=start,
-                                     end=end, 
-                                        filter={
-                                            "name" : 'wxt.wind.speed|wxt.wind.direction',
-                                            "plugin" : "registry.sagecontinuum.org/jrobrien/waggle-wxt536:0.23.5.*",
-                                            "vsn" : "W08D",
-                                            "sensor" : "vaisala-wxt536"
-                                        }
-    )
-    
-    hums = df_temp[df_temp['name']=='wxt.env.humidity']
-    temps = df_temp[df_temp['name']=='wxt.env.temp']
-    pres = df_temp[df_temp['name']=='wxt.env.pressure']
-    rain = df_temp[df_temp['name']=='wxt.rain.accumulation']
-
-
-    npres = len(pres)
-    nhum = len(hums)
-    ntemps = len(temps)
-    nrains = len(rain)
-    print(npres, nhum, ntemps, nrains)
-    minsamps = min([nhum, ntemps, npres, nrains])
-
-    temps['time'] = pd.DatetimeIndex(temps['timestamp'].values)
-
-    vals = temps.set_index('time')[0:minsamps]
-    vals['temperature'] = vals.value.to_numpy()[0:minsamps]
-    vals['humidity'] = hums.value.to_numpy()[0:minsamps]
-    vals['pressure'] = pres.value.to_numpy()[0:minsamps]
-    vals['rainfall'] = rain.value.to_numpy()[0:minsamps]
-
-    direction = winds[winds['name']=='wxt.wind.direction']
-    speed = winds[winds['name']=='wxt.wind.speed']
-
-    nspeed = len(speed)
-    ndir = len(direction)
-    print(nspeed, ndir)
-    minsamps = min([nspeed, ndir])
-
-    speed['time'] = pd.DatetimeIndex(speed['timestamp'].values)
-    windy = speed.set_index('time')[0:minsamps]
-    windy['speed'] = windy.value.to_numpy()[0:minsamps]
-    windy['direction'] = direction.value.to_numpy()[0:minsamps]
-
-
-    winds10mean = windy.resample('10s').mean(numeric_only=True).ffill()
-    winds10max = windy.resample('10s').max(numeric_only=True).ffill()
-    dp = dewpoint_from_relative_humidity(vals.temperature.to_numpy() * units.degC, 
-                                         vals.humidity.to_numpy() * units.percent)
-
-    vals['dewpoint'] = dp
-    vals10 = vals.resample('10s').mean(numeric_only=True).ffill() #ffil gets rid of nans due to empty resample periods
-    wb = wet_bulb_temperature(vals10.pressure.to_numpy() * units.hPa,
-                              vals10.temperature.to_numpy() * units.degC,
-                              vals10.dewpoint.to_numpy() * units.degC)
-
-    vals10['wetbulb'] = wb
-    vals10['wind_dir_10s'] = winds10mean['direction']
-    vals10['wind_mean_10s'] = winds10mean['speed']
-    vals10['wind_max_10s'] = winds10max['speed']
-    _ = vals10.pop('value')
-
-    fname = st.strftime('crocus-neiu-wxt-a1-%Y%m%d-%H%M%S.nc')
+
+from crocus_datastreams import DATASTREAMS
+
+# metpy (--thermo metpy), xarray and netCDF4 are imported by the stages that use them,
+# so start-up only pays for what the job actually runs.
+
+# site metadata of the outputs is in crocus_sites.csv, see sage_nodes.py
+
+# variable attributes and names are declared once, in the datastream spec crocus-ingest.py builds
+var_attrs_wxt = DATASTREAMS["wxt"]["variables"]
+
+# the pivot only needs these and the node to split by, the other meta.* columns are not loaded
+QUERY_COLUMNS = ["timestamp", "name", "value", "meta.vsn"]
+
+# sage measurement name -> output variable
+wxt_names, wind_names = DATASTREAMS["wxt"]["groups"]
+
+def query_wxt(start, end, vsn="W08D"):
+    start = start.strftime('%Y-%m-%dT%H:%M:%SZ')
+    end = end.strftime('%Y-%m-%dT%H:%M:%SZ')
+    with sage_metrics.phase("query") as m:
+        df_temp = sage_query.query(start=start,
+                                         end=end, 
+                                            filter={
+                                                "name" : 'wxt.env.temp|wxt.env.humidity|wxt.env.pressure|wxt.rain.accumulation',
+                                                "plugin" : "registry.sagecontinuum.org/jrobrien/waggle-wxt536:0.23.5.*",
+                                                "vsn" : sage_nodes.vsn_filter(vsn),
+                                                "sensor" : "vaisala-wxt536"
+                                            },
+                                            columns=QUERY_COLUMNS
+        )
+        winds = sage_query.query(start=start,
+                                         end=end, 
+                                            filter={
+                                                "name" : 'wxt.wind.speed|wxt.wind.direction',
+                                                "plugin" : "registry.sagecontinuum.org/jrobrien/waggle-wxt536:0.23.5.*",
+                                                "vsn" : sage_nodes.vsn_filter(vsn),
+                                                "sensor" : "vaisala-wxt536"
+                                            },
+                                            columns=QUERY_COLUMNS
+        )
+        m["rows_out"] = len(df_temp) + len(winds)
+    return df_temp, winds
+
+
+def derive_wxt(df_temp, winds, tolerance=timedelta(seconds=1), thermo="normand"):
+    with sage_metrics.phase("pivot", rows_in=len(df_temp) + len(winds)) as m:
+        vals = sage_pivot.pivot(df_temp, wxt_names, tolerance=tolerance)
+        windy = sage_pivot.pivot(winds, wind_names, tolerance=tolerance)
+        m["rows_out"] = len(vals) + len(windy)
+
+    with sage_metrics.phase("thermo", rows_in=len(vals)) as m:
+        winds10mean = windy.resample('10s').mean(numeric_only=True).ffill()
+        winds10max = windy.resample('10s').max(numeric_only=True).ffill()
+        if thermo == "metpy":
+            from metpy.units import units
+            from metpy.calc import dewpoint_from_relative_humidity, wet_bulb_temperature
+
+            dp = dewpoint_from_relative_humidity(vals.temperature.to_numpy() * units.degC, 
+                                                 vals.humidity.to_numpy() * units.percent)
+
+            vals['dewpoint'] = dp.m_as(units.degC)
+            vals10 = vals.resample('10s').mean(numeric_only=True).ffill() #ffil gets rid of nans due to empty resample periods
+            wb = wet_bulb_temperature(vals10.pressure.to_numpy() * units.hPa,
+                                      vals10.temperature.to_numpy() * units.degC,
+                                      vals10.dewpoint.to_numpy() * units.degC)
+
+            vals10['wetbulb'] = wb.m_as(units.degC)
+        else:
+            vals['dewpoint'] = sage_thermo.dewpoint_from_relative_humidity(vals.temperature.to_numpy(),
+                                                                           vals.humidity.to_numpy())
+            vals10 = vals.resample('10s').mean(numeric_only=True).ffill() #ffil gets rid of nans due to empty resample periods
+            vals10['wetbulb'] = sage_thermo.wet_bulb_temperature(vals10.pressure.to_numpy(),
+                                                                 vals10.temperature.to_numpy(),
+                                                                 vals10.dewpoint.to_numpy(),
+                                                                 method=thermo)
+        vals10['wind_dir_10s'] = winds10mean['direction']
+        vals10['wind_mean_10s'] = winds10mean['speed']
+        vals10['wind_max_10s'] = winds10max['speed']
+        # the winds can end before the other channels
+        vals10 = vals10.ffill()
+        m["rows_out"] = len(vals10)
+    return vals10
+
+
+def split_wxt(df_temp, winds):
+    """
+    {vsn: (df_temp, winds)} of the nodes with env data, winds may be empty.
+    """
+    temps, windy = sage_nodes.split(df_temp), sage_nodes.split(winds)
+    return {node: (temp, windy.get(node, winds.iloc[:0].drop(columns="meta.vsn"))) for node, temp in temps.items()}
+
+
+def write_wxt(vsn, df_temp, winds, st, tolerance=timedelta(seconds=1), thermo="normand", encoding="zlib"):
+    """
+    Derive and write the a1 file of one node, returns its name.
+    """
+    import xarray as xr
+
+    vals10 = derive_wxt(df_temp, winds, tolerance, thermo)
+
+    fname = sage_nodes.output_name(vsn, "wxt", st)
     
     try:
         os.remove(fname)
     except OSError:
         pass
     
-    vals10xr = xr.Dataset.from_dataframe(vals10)
-    vals10xr = vals10xr.sortby('time')
+    with sage_metrics.phase("dataset", rows_in=len(vals10)) as m:
+        vals10xr = xr.Dataset.from_dataframe(vals10)
+        vals10xr = vals10xr.sortby('time')
+        vals10xr = vals10xr.assign_attrs(sage_nodes.global_attrs(vsn, "wxt"))
+
+        for varname in var_attrs_wxt.keys():
+            vals10xr[varname] = vals10xr[varname].assign_attrs(var_attrs_wxt[varname])
+        m["rows_out"] = vals10xr.sizes['time']
     
-    vals10xr.to_netcdf(fname)
+    with sage_metrics.phase("write", rows_in=vals10xr.sizes['time']) as m:
+        sage_netcdf.write(vals10xr, fname, encoding)
+        m["bytes_written"] = sage_metrics.file_size(fname)
+    return fname
+
+
+def ingest_wxt(st, vsn="W08D", tolerance=timedelta(seconds=1), thermo="normand", encoding="zlib", workers=0):
+    """
+    Query the nodes matching vsn for the day in one request, then derive and write one
+    file per node in a pool of workers processes (0 for all cores).
+    """
+    hours = 24
+    end = st + timedelta(hours=hours)
+    print(f"Data start date {st.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+    print(f"Data end date {end.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+
+    nodes = split_wxt(*query_wxt(st, end, vsn))
+    if not nodes:
+        print('not saving... no data')
+        return
+
+    written = sage_nodes.map_nodes(write_wxt, {node: (df_temp, winds, st, tolerance, thermo, encoding) for node, (df_temp, winds) in nodes.items()}, workers)
+    print(f"Wrote {', '.join(written.values())}")
+
+
+def ingest_wxt_stream(st, vsn="W08D", tolerance=timedelta(seconds=1), thermo="normand", chunk=timedelta(hours=1), encoding="zlib"):
+    """
+    Same output as ingest_wxt, but the day is pulled and written one chunk at a time.
+    Chunks should be a multiple of the 10s resampling period. Nodes are derived in this
+    process, one appender per node.
+    """
+    hours = 24
+    end = st + timedelta(hours=hours)
+    print(f"Data start date {st.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+    print(f"Data end date {end.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+
+    outputs = {}
+    joiners = {}
+    with ExitStack() as stack:
+        chunk_start = st
+        while chunk_start < end:
+            chunk_end = min(chunk_start + chunk, end)
+            nodes = split_wxt(*query_wxt(chunk_start, chunk_end, vsn))
+            chunk_start = chunk_end
+
+            for node, (df_temp, winds) in nodes.items():
+                if node not in outputs:
+                    out = sage_netcdf.NetCDFAppender(sage_nodes.output_name(node, "wxt", st), sage_nodes.global_attrs(node, "wxt"), var_attrs_wxt, profile=encoding)
+                    outputs[node] = stack.enter_context(out)
+                    joiners[node] = sage_datastreams.ChunkJoiner(DATASTREAMS["wxt"]["resample"])
+
+                # empty periods between the chunks and the forward fill carry over the boundary
+                vals10 = joiners[node].join(derive_wxt(df_temp, winds, tolerance, thermo))
+                with sage_metrics.phase("write", rows_in=len(vals10)):
+                    outputs[node].append(vals10)
+
+    for out in outputs.values():
+        sage_metrics.count("write", bytes_written=sage_metrics.file_size(out.fname))
+
 
 def main():
     parser = ArgumentParser(description="WXT Ingest")
     parser.add_argument("--date", metavar="STR", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), required=True, help="Date to pull data for (example: '2021-08-10')")
+    parser.add_argument("--days", metavar="INT", type=int, default=1, help="Number of consecutive days to process starting at --date (default: 1)")
+    parser.add_argument("--vsn", metavar="STR", type=str, nargs="+", default=["W08D"], help="Nodes queried together, VSNs or a regular expression, one output per node (default: W08D)")
+    parser.add_argument("--workers", metavar="INT", type=int, default=0, help="Processes deriving the nodes in parallel, 0 for all available cores (default: 0)")
+    parser.add_argument("--align-tolerance", metavar="FLOAT", type=float, default=1.0, help="Max time difference in seconds when aligning channels, 0 for exact timestamps (default: 1.0)")
+    parser.add_argument("--thermo", type=str, choices=sage_thermo.WETBULB_METHODS + ["metpy"], default="normand", help="Wet-bulb method of the vectorized dewpoint/wet-bulb, or metpy as the slower reference (default: normand)")
+    parser.add_argument("--stream", action="store_true", help="Pull and write the day in chunks to bound memory use")
+    parser.add_argument("--chunk-minutes", metavar="INT", type=int, default=60, help="Chunk length in minutes for --stream (default: 60)")
+    parser.add_argument("--encoding", type=str, choices=list(sage_netcdf.ENCODING_PROFILES), default="zlib", help="netCDF encoding profile of the output, see sage_netcdf.py (default: zlib)")
+    parser.add_argument("--metrics", metavar="STR", type=str, default=None, help="Append per-phase metrics records to this JSON lines file, see sage_metrics.py")
 
     args = parser.parse_args()
+    tolerance = timedelta(seconds=args.align_tolerance) if args.align_tolerance > 0 else None
+    sage_metrics.start("wxt-ingest", args.metrics)
     
-    try:
-        start_time = time()
-        ingest_wxt(args.date)
-        print("Success...")
-        end_time = time()
-        print(f"Time taken: {end_time - start_time}")
-    except Exception as e:
-        print(e)
+    # several days in one process share the imports and the query cache
+    for d in range(args.days):
+        day = args.date + timedelta(days=d)
+        sage_metrics.set_context(date=day.strftime('%Y-%m-%d'))
+        try:
+            start_time = time()
+            if args.stream:
+                ingest_wxt_stream(day, vsn=args.vsn, tolerance=tolerance, thermo=args.thermo, chunk=timedelta(minutes=args.chunk_minutes), encoding=args.encoding)
+            else:
+                ingest_wxt(day, vsn=args.vsn, tolerance=tolerance, thermo=args.thermo, encoding=args.encoding, workers=args.workers)
+            print("Success...")
+            end_time = time()
+            print(f"Time taken: {end_time - start_time}")
+        except Exception as e:
+            print(e)
+
+    sage_metrics.write()
 
 if __name__ == "__main__":
     main()
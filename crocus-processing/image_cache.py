@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""
+Pinned, pre-built container images for the CROCUS workflow.
+
+A docker:// reference is resolved to its manifest digest against the registry, and the
+pinned image is built into a Singularity/Apptainer SIF once per digest in an image store.
+The workflow registers the SIF as the container image, so workers reuse it instead of each
+pulling and converting the image. The last resolved digest of every reference is kept in
+the store, so the workflow can still be planned when the registry is unreachable.
+
+Registries on localhost (a local `registry:2` stand-in for offline use) are accessed over http.
+"""
+import os
+import re
+import json
+import shutil
+import subprocess
+
+import requests
+
+DOCKER_HUB = "registry-1.docker.io"
+
+MANIFEST_TYPES = ", ".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
+
+
+def parse_reference(image):
+    """
+    docker://[registry/]repository[:tag][@digest] -> (registry, repository, tag, digest)
+    """
+    ref = image[len("docker://"):] if image.startswith("docker://") else image
+    ref, _, digest = ref.partition("@")
+
+    registry, repository = DOCKER_HUB, ref
+    first, _, rest = ref.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        registry, repository = first, rest
+
+    tag = "latest"
+    if ":" in repository.rsplit("/", 1)[-1]:
+        repository, tag = repository.rsplit(":", 1)
+    if registry == DOCKER_HUB and "/" not in repository:
+        repository = "library/" + repository
+    return registry, repository, tag, digest or None
+
+
+def _insecure(registry):
+    return registry.split(":")[0] in ("localhost", "127.0.0.1")
+
+
+def resolve_digest(image, timeout=10):
+    """
+    Manifest digest the tag of image currently points to, anonymous token auth as Docker Hub needs.
+    """
+    registry, repository, tag, digest = parse_reference(image)
+    if digest:
+        return digest
+
+    url = f"{'http' if _insecure(registry) else 'https'}://{registry}/v2/{repository}/manifests/{tag}"
+    headers = {"Accept": MANIFEST_TYPES}
+    r = requests.head(url, headers=headers, timeout=timeout)
+
+    if r.status_code == 401 and r.headers.get("WWW-Authenticate", "").startswith("Bearer "):
+        challenge = dict(re.findall(r'(\w+)="([^"]*)"', r.headers["WWW-Authenticate"]))
+        token = requests.get(challenge["realm"], timeout=timeout,
+                             params={"service": challenge.get("service"), "scope": f"repository:{repository}:pull"}).json()
+        headers["Authorization"] = f"Bearer {token.get('token') or token.get('access_token')}"
+        r = requests.head(url, headers=headers, timeout=timeout)
+
+    r.raise_for_status()
+    return r.headers["Docker-Content-Digest"]
+
+
+class ImageCache():
+    index_name = "images.json"
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index_path = os.path.join(store_dir, self.index_name)
+
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def pin(self, image):
+        """
+        image pinned by digest (docker://registry/repository@sha256:...), falling back to the
+        digest resolved last time when the registry cannot be reached. None if neither works.
+        """
+        registry, repository, tag, digest = parse_reference(image)
+        try:
+            digest = resolve_digest(image)
+            self.index[image] = digest
+            self._save()
+        except (requests.RequestException, KeyError, ValueError) as e:
+            digest = self.index.get(image)
+            print(f"Could not resolve {image} ({e}), {'using ' + digest if digest else 'image stays unpinned'}")
+            if digest is None:
+                return None
+
+        prefix = "" if registry == DOCKER_HUB else registry + "/"
+        return f"docker://{prefix}{repository}@{digest}"
+
+    def sif(self, pinned):
+        """
+        Path of the SIF built from a pinned image, built on the first call. None when neither
+        apptainer nor singularity is available on this host.
+        """
+        digest = pinned.rsplit("@", 1)[1]
+        name = parse_reference(pinned)[1].replace("/", "_")
+        path = os.path.join(self.store_dir, f"{name}_{digest.replace(':', '-')}.sif")
+        if os.path.isfile(path):
+            return path
+
+        builder = shutil.which("apptainer") or shutil.which("singularity")
+        if builder is None:
+            print(f"No apptainer/singularity to build {pinned}, workers will pull it")
+            return None
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        cmd = [builder, "build"]
+        if _insecure(parse_reference(pinned)[0]):
+            cmd.append("--nohttps")
+        tmp = path + ".tmp"
+        subprocess.run(cmd + ["--force", tmp, pinned], check=True)
+        os.replace(tmp, path)
+        return path
+
+    def _save(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.index_path)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+Memoization index for the outputs the CROCUS workflow stages out to local storage.
+
+Every output is recorded with a key built from everything that determines its content
+(transformation script and helpers, container image, arguments, query window). When the
+workflow is planned again, outputs whose key did not change and whose file is the one
+produced under that key can be registered in the replica catalog, so Pegasus prunes the
+jobs that would recompute them. With force nothing is reused, the outputs are recorded as
+pending like in a first run.
+"""
+import os
+import json
+import hashlib
+from time import time
+
+
+class OutputMemo():
+    index_name = ".crocus-memo.json"
+
+    def __init__(self, storage_dir, force=False):
+        self.storage_dir = storage_dir
+        self.force = force
+        self.index_path = os.path.join(storage_dir, self.index_name)
+        self.planned = time()
+
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    @staticmethod
+    def file_hash(*paths):
+        h = hashlib.sha256()
+        for path in paths:
+            with open(path, "rb") as f:
+                h.update(f.read())
+        return h.hexdigest()
+
+    @staticmethod
+    def key(**parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def lookup(self, lfn, key):
+        """
+        Returns the path of lfn in local storage if it was produced under key, None otherwise.
+        On a miss the output is recorded as pending under key, also when it was confirmed
+        before and its file is gone or changed, and confirmed the next time the workflow is
+        planned if a newer file exists by then.
+        """
+        path = os.path.join(self.storage_dir, lfn)
+        entry = self.index.get(lfn)
+
+        if entry is not None and entry["key"] == key and not self.force and os.path.isfile(path):
+            st = os.stat(path)
+            if "mtime" not in entry and st.st_mtime >= entry["planned"]:
+                entry.update(size=st.st_size, mtime=st.st_mtime)
+            if entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime:
+                return path
+
+        self.index[lfn] = {"key": key, "planned": self.planned}
+        return None
+
+    def save(self):
+        os.makedirs(self.storage_dir, exist_ok=True)
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.index_path)
@@ -17,6 +17,14 @@ from datetime import timedelta
 # --- Import Pegasus API -----------------------------------------------------------
 from Pegasus.api import *
 
+from output_memo import OutputMemo
+from image_cache import ImageCache
+
+# output names, site metadata and datastreams are shared with the executables
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "executables"))
+import sage_nodes
+from crocus_datastreams import DATASTREAMS
+
 class CrocusWorkflow():
     wf = None
     sc = None
@@ -30,9 +38,53 @@ class CrocusWorkflow():
     local_storage_dir = None
     wf_name = "crocus"
 
+    container_image = "docker://papajim/crocus:latest"
+
+    # transformation -> executable
+    ingest_executables = {"crocus_ingest": "crocus-ingest.py", "ambient_ingest": "ambient-ingest.py"}
+
+    # python modules imported by the executables, staged next to them
+    helper_files = ["sage_query.py", "sage_pivot.py", "sage_netcdf.py", "sage_thermo.py", "sage_metrics.py", "sage_nodes.py", "crocus_sites.csv",
+                    "sage_datastreams.py", "crocus_datastreams.py", "sage_zarr.py"]
+
+    # ambient-ingest.py only needs the metrics
+    ambient_helper_files = ["sage_metrics.py"]
+
+    # Ambient Weather API endpoint passed on to the ambient jobs, the keys are never written into
+    # the catalogs: they stay in the credentials file, staged as an input of the ambient jobs
+    ambient_env = ["AMBIENT_ENDPOINT"]
+    ambient_creds_file = "ambient.creds"
+
     # --- Init ---------------------------------------------------------------------
-    def __init__(self, aqt_end_date, aqt_lag, wxt_end_date, wxt_lag, dagfile="workflow.yml"):
+    def __init__(self, aqt_end_date, aqt_lag, wxt_end_date, wxt_lag, dagfile="workflow.yml", cache_dir=None, stream=False, days_per_job=1, reuse=True, encoding="zlib",
+                 cluster=None, cluster_size=10, cluster_runtime=None, day_runtime=60, label_days=7,
+                 container_image=None, image_cache=True, image_store=None, metrics=True, vsns=("W08D",), ingest_cores=4,
+                 ambient_end_date=None, ambient_lag=1, ambient_stations=("atmos-g1", "atmos-g2"), ambient_creds=None, wxt_summaries=("1min", "5min", "1h"),
+                 zarr_store=None, zarr_origin="2024-01-01"):
         self.dagfile = dagfile
+        self.vsns = list(vsns)
+        self.ingest_cores = max(1, min(ingest_cores, len(self.vsns)))
+        # job names carry the site when the jobs cover one node
+        self.site_label = sage_nodes.site_id(self.vsns[0]).lower() if len(self.vsns) == 1 else "network"
+        self.metrics = metrics
+        self.cache_dir = cache_dir
+        self.zarr_store = zarr_store
+        self.zarr_origin = zarr_origin
+        self.stream = stream
+        self.days_per_job = days_per_job
+        self.encoding = encoding
+        self.cluster = cluster or []
+        self.cluster_size = cluster_size
+        self.cluster_runtime = cluster_runtime
+        self.day_runtime = day_runtime
+        self.label_days = label_days
+        self.image_cache = image_cache
+        self.image_store = image_store
+        if container_image:
+            self.container_image = container_image
+        self.image_ref = self.container_image
+        self.reuse = reuse
+        self.memo = None
 
         self.wf_dir = str(Path(__file__).parent.resolve())
         self.shared_scratch_dir = os.path.join(self.wf_dir, "scratch")
@@ -42,6 +94,12 @@ class CrocusWorkflow():
         self.aqt_lag = aqt_lag
         self.wxt_end_date = wxt_end_date
         self.wxt_lag = wxt_lag
+        # b1 summaries built along with the 10s wxt datastream
+        self.wxt_datastreams = ["wxt"] + [f"wxt-{period}" for period in wxt_summaries]
+        self.ambient_end_date = ambient_end_date
+        self.ambient_lag = ambient_lag
+        self.ambient_stations = list(ambient_stations)
+        self.ambient_creds = os.path.abspath(ambient_creds) if ambient_creds else None
 
 
     # --- Write files in directory -------------------------------------------------
@@ -56,6 +114,10 @@ class CrocusWorkflow():
     # --- Configuration (Pegasus Properties) ---------------------------------------
     def create_pegasus_properties(self):
         self.props = Properties()
+
+        # ambient jobs share the rate limit of the API key, so they run one at a time
+        if self.ambient_end_date:
+            self.props["dagman.ambient.maxjobs"] = "1"
         return
 
 
@@ -79,6 +141,11 @@ class CrocusWorkflow():
                         )
                     )
 
+        if self.cache_dir:
+            exec_site.add_env(SAGE_CACHE_DIR=self.cache_dir)
+
+        if self.ambient_end_date:
+            exec_site.add_env(**{k: os.environ[k] for k in self.ambient_env if os.environ.get(k)})
 
         self.sc.add_sites(local, exec_site)
         return 
@@ -88,60 +155,220 @@ class CrocusWorkflow():
     def create_transformation_catalog(self, exec_site_name="condorpool"):
         self.tc = TransformationCatalog()
 
+        image, image_site = self.container_image, "docker_hub"
+        if self.image_cache:
+            image, image_site = self.cached_image(exec_site_name)
+
         crocus_container = Container("crocus_container",
             container_type = Container.SINGULARITY,
-            image="docker://papajim/crocus:latest",
-            image_site="docker_hub"
+            image=image,
+            image_site=image_site,
+            mounts=[f"{d}:{d}" for d in (self.cache_dir, self.zarr_store) if d] or None
         )
 
-        # Add the crocus processing
-        aqt_ingest = Transformation("aqt_ingest", site=exec_site_name, pfn=os.path.join(self.wf_dir, "executables/aqt-ingest.py"), is_stageable=True, container=crocus_container)
-        wxt_ingest = Transformation("wxt_ingest", site=exec_site_name, pfn=os.path.join(self.wf_dir, "executables/wxt-ingest.py"), is_stageable=True, container=crocus_container)
+        # Add the crocus processing, all datastreams of a node from one query
+        crocus_ingest = Transformation("crocus_ingest", site=exec_site_name, pfn=os.path.join(self.wf_dir, "executables", self.ingest_executables["crocus_ingest"]), is_stageable=True, container=crocus_container)
 
+        # horizontal clustering: a fixed number of jobs per cluster, or as many as fit in cluster_runtime seconds
+        if self.cluster_runtime:
+            crocus_ingest.add_pegasus_profile(clusters_max_runtime=self.cluster_runtime)
+        else:
+            crocus_ingest.add_pegasus_profile(clusters_size=self.cluster_size)
 
         self.tc.add_containers(crocus_container)
-        self.tc.add_transformations(aqt_ingest, wxt_ingest)
+        self.tc.add_transformations(crocus_ingest)
+
+        if self.ambient_end_date:
+            ambient_ingest = Transformation("ambient_ingest", site=exec_site_name, pfn=os.path.join(self.wf_dir, "executables", self.ingest_executables["ambient_ingest"]), is_stageable=True, container=crocus_container)
+            self.tc.add_transformations(ambient_ingest)
         return
 
 
+    # --- Container image, pinned by digest and built once -------------------------
+    def cached_image(self, exec_site_name):
+        """
+        SIF built from the pinned image, either in image_store (a directory the workers see
+        at the same path) or in the shared scratch of the local site, from where it is staged.
+        """
+        store = self.image_store or os.path.join(self.shared_scratch_dir, "images")
+        cache = ImageCache(store)
+
+        pinned = cache.pin(self.container_image)
+        if pinned is None:
+            return self.container_image, "docker_hub"
+        self.image_ref = pinned
+
+        sif = cache.sif(pinned)
+        if sif is None:
+            return pinned, "docker_hub"
+        return "file://" + sif, exec_site_name if self.image_store else "local"
+
+
     # --- Replica Catalog ----------------------------------------------------------
     def create_replica_catalog(self):
         self.rc = ReplicaCatalog()
+
+        for helper in self.helper_files + self.ambient_helper_files:
+            self.rc.add_replica("local", helper, "file://" + os.path.join(self.wf_dir, "executables", helper))
+
+        # only the path of the credentials is in the catalog, the staged copies keep its mode
+        if self.ambient_end_date:
+            self.rc.add_replica("local", self.ambient_creds_file, "file://" + self.ambient_creds)
         return
 
 
     # --- Create Workflow ----------------------------------------------------------
     def create_workflow(self):
         self.wf = Workflow(self.wf_name, infer_dependencies=True)
+
+        # outputs already in local storage are registered so pegasus prunes their jobs, without
+        # reuse they are all recomputed and recorded again
+        self.memo = OutputMemo(self.local_storage_dir, force=not self.reuse)
         
-        #create aqt jobs
-        aqt_start_date = self.aqt_end_date - timedelta(days=self.aqt_lag)
-        for i in range(self.aqt_lag):
-            curr_aqt_date = aqt_start_date + timedelta(days=i)
-            date_time_str = curr_aqt_date.strftime("%Y-%m-%d")
-            output_file = curr_aqt_date.strftime('crocus-neiu-aqt-a1-%Y%m%d-%H%M%S.nc'), 
-            aqt_ingest_job = (
-                Job("aqt_ingest", _id=f"crocus-neiu-aqt-{date_time_str}", node_label=f"crocus-neiu-aqt-{date_time_str}")
-                    .add_args("--date", curr_aqt_date.strftime("%Y-%m-%d"))
-                    .add_outputs(curr_aqt_date.strftime('crocus-neiu-aqt-a1-%Y%m%d-%H%M%S.nc'), register_replica=True, stage_out=True)
+        # day -> datastreams built for it
+        days = {}
+        for datastreams, end_date, lag in ((["aqt"], self.aqt_end_date, self.aqt_lag), (self.wxt_datastreams, self.wxt_end_date, self.wxt_lag)):
+            for i in range(lag):
+                days.setdefault(end_date - timedelta(days=lag - i), []).extend(datastreams)
+
+        self.create_ingest_jobs(days)
+
+        #create ambient weather station jobs
+        if self.ambient_end_date:
+            self.create_ambient_jobs(self.ambient_end_date, self.ambient_lag)
+
+        if self.memo:
+            self.memo.save()
+
+
+    # --- Ingest jobs, days_per_job consecutive days of all nodes per job ----------
+    def create_ingest_jobs(self, days, transformation="crocus_ingest"):
+        # only ambient jobs when both lags are 0
+        if not days:
+            return
+
+        extra_args = ["--encoding", self.encoding]
+        if self.stream:
+            extra_args.append("--stream")
+        # the stores are shared by the jobs, each one writes the chunks of its days
+        if self.zarr_store:
+            extra_args += ["--zarr", self.zarr_store, "--zarr-origin", self.zarr_origin]
+
+        if self.memo:
+            scripts = [os.path.join(self.wf_dir, "executables", f) for f in [self.ingest_executables[transformation]] + self.helper_files]
+            script_hash = OutputMemo.file_hash(*scripts)
+
+        # a job covers consecutive days that need the same datastreams
+        runs = []
+        for day in sorted(days):
+            run = runs[-1] if runs else None
+            if run and len(run) < self.days_per_job and day - run[-1] == timedelta(days=1) and days[day] == days[run[-1]]:
+                run.append(day)
+            else:
+                runs.append([day])
+
+        first_date = min(days)
+        for run in runs:
+            curr_date, ndays, datastreams = run[0], len(run), days[run[0]]
+            date_time_str = curr_date.strftime("%Y-%m-%d")
+            job_id = f"crocus-{self.site_label}-{date_time_str}"
+            if ndays > 1:
+                job_id += run[-1].strftime("_%Y-%m-%d")
+
+            ingest_job = (Job(transformation, _id=job_id, node_label=job_id)
+                    .add_args("--date", date_time_str, "--datastreams", *datastreams)
+                    .add_inputs(*self.helper_files)
             )
+
+            if ndays > 1:
+                ingest_job.add_args("--days", ndays)
+
+            ingest_job.add_args(*extra_args)
+
+            # one query for all nodes, derived by ingest_cores worker processes
+            ingest_job.add_args("--vsn", *self.vsns, "--workers", self.ingest_cores)
+            if self.ingest_cores > 1:
+                ingest_job.add_pegasus_profile(cores=self.ingest_cores)
+
+            # expected runtime for runtime sized clusters, label clusters group label_days days
+            node_rounds = -(-len(self.vsns) // self.ingest_cores)
+            ingest_job.add_pegasus_profile(runtime=str(self.day_runtime * ndays * node_rounds))
+            if "label" in self.cluster:
+                block_start = first_date + timedelta(days=(curr_date - first_date).days // self.label_days * self.label_days)
+                ingest_job.add_pegasus_profile(label=f"crocus-{self.site_label}-{block_start.strftime('%Y-%m-%d')}")
+
+            # outputs are still declared per day, datastream and node
+            reused = 0
+            for day in run:
+                for datastream in datastreams:
+                    for vsn in self.vsns:
+                        spec = DATASTREAMS[datastream]
+                        output_file = sage_nodes.output_name(vsn, spec["instrument"], day, spec.get("product"), spec.get("datalevel", "a1"))
+                        ingest_job.add_outputs(output_file, register_replica=True, stage_out=True)
+
+                        if self.memo:
+                            key = OutputMemo.key(script=script_hash, image=self.image_ref, args=extra_args,
+                                                 window=[day.isoformat(), (day + timedelta(days=1)).isoformat()])
+                            path = self.memo.lookup(output_file, key)
+                            if path:
+                                self.rc.add_replica("local", output_file, "file://" + path)
+                                reused += 1
+
+            # per-phase metrics (executables/sage_metrics.py), left out when every output is reused
+            # so pegasus can still prune the job
+            if self.metrics and reused < ndays * len(datastreams) * len(self.vsns):
+                metrics_file = f"{job_id}.metrics.jsonl"
+                ingest_job.add_args("--metrics", metrics_file)
+                ingest_job.add_outputs(metrics_file, register_replica=False, stage_out=True)
         
-            self.wf.add_jobs(aqt_ingest_job)
+            self.wf.add_jobs(ingest_job)
+
+    # --- Ambient weather station jobs, days_per_job days of all stations per job ----
+    def create_ambient_jobs(self, end_date, lag, transformation="ambient_ingest"):
+        if self.memo:
+            scripts = [os.path.join(self.wf_dir, "executables", f) for f in [self.ingest_executables[transformation]] + self.ambient_helper_files]
+            script_hash = OutputMemo.file_hash(*scripts)
+
+        start_date = end_date - timedelta(days=lag)
+        for i in range(0, lag, self.days_per_job):
+            curr_date = start_date + timedelta(days=i)
+            ndays = min(self.days_per_job, lag - i)
+            date_time_str = curr_date.strftime("%Y-%m-%d")
+            job_id = f"ambient-{date_time_str}"
+            if ndays > 1:
+                job_id += (curr_date + timedelta(days=ndays - 1)).strftime("_%Y-%m-%d")
+
+            ambient_job = (Job(transformation, _id=job_id, node_label=job_id)
+                    .add_args("--date", date_time_str, "--stations", *self.ambient_stations, "--creds", self.ambient_creds_file)
+                    .add_inputs(*self.ambient_helper_files, self.ambient_creds_file)
+                    .add_dagman_profile(category="ambient")
+            )
 
+            if ndays > 1:
+                ambient_job.add_args("--days", ndays)
 
+            # outputs are declared per day and station
+            reused = 0
+            for d in range(ndays):
+                day = curr_date + timedelta(days=d)
+                for station in self.ambient_stations:
+                    output_file = day.strftime(f"{station}.a1.%Y%m%d.000000.nc")
+                    ambient_job.add_outputs(output_file, register_replica=True, stage_out=True)
 
-        #create wxt jobs
-        wxt_start_date = self.wxt_end_date - timedelta(days=self.wxt_lag)
-        for i in range(self.wxt_lag):
-            curr_wxt_date = wxt_start_date + timedelta(days=i)
-            date_time_str = curr_wxt_date.strftime("%Y-%m-%d")
-            output_file = curr_wxt_date.strftime('crocus-neiu-wxt-a1-%Y%m%d-%H%M%S.nc')
-            wxt_ingest_job = (Job("wxt_ingest", _id=f"crocus-neiu-wxt-{date_time_str}", node_label=f"crocus-neiu-wxt-{date_time_str}")
-                    .add_args("--date", date_time_str)
-                    .add_outputs(output_file, register_replica=True, stage_out=True)
-            )
-        
-            self.wf.add_jobs(wxt_ingest_job)
+                    if self.memo:
+                        key = OutputMemo.key(script=script_hash, image=self.image_ref,
+                                             window=[day.isoformat(), (day + timedelta(days=1)).isoformat()])
+                        path = self.memo.lookup(output_file, key)
+                        if path:
+                            self.rc.add_replica("local", output_file, "file://" + path)
+                            reused += 1
+
+            if self.metrics and reused < ndays * len(self.ambient_stations):
+                metrics_file = f"{job_id}.metrics.jsonl"
+                ambient_job.add_args("--metrics", metrics_file)
+                ambient_job.add_outputs(metrics_file, register_replica=False, stage_out=True)
+
+            self.wf.add_jobs(ambient_job)
 
     def submit(self):
         self.write()
@@ -150,6 +377,7 @@ class CrocusWorkflow():
             self.wf.plan(
                 output_sites=["local"],
                 dir="./submit",
+                cluster=self.cluster or None,
                 submit=True
             )
         #.wait().analyze()
@@ -167,15 +395,74 @@ if __name__ == '__main__':
     parser.add_argument("--aqt-lag", metavar="INT", type=int, default=1, required=False, help="AQT days lag (default: 1)")
     parser.add_argument("--wxt-end-date", metavar="STR", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), required=True, help="WXT end date (example: '2024-01-01')")
     parser.add_argument("--wxt-lag", metavar="INT", type=int, default=1, required=False, help="WXT days lag (default: 1)")
+    parser.add_argument("--wxt-summaries", type=str, nargs="*", choices=["1min", "5min", "1h"], default=["1min", "5min", "1h"], required=False, help="b1 WXT summaries built in the same pass as the 10s a1 datastream, none for only a1 (default: 1min 5min 1h)")
+    parser.add_argument("--ambient-end-date", metavar="STR", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), default=None, required=False, help="Ambient weather stations end date, no ambient jobs without it (example: '2024-01-01')")
+    parser.add_argument("--ambient-lag", metavar="INT", type=int, default=1, required=False, help="Ambient weather stations days lag (default: 1)")
+    parser.add_argument("--ambient-stations", metavar="STR", type=str, nargs="+", default=["atmos-g1", "atmos-g2"], required=False, help="Ambient weather stations ingested (default: atmos-g1 atmos-g2)")
+    parser.add_argument("--ambient-creds", metavar="STR", type=str, default=None, required=False, help="File with the AMBIENT_API_KEY=... and AMBIENT_APPLICATION_KEY=... lines, readable only by you (chmod 600), staged to the ambient jobs, required with --ambient-end-date")
+    parser.add_argument("--vsn", metavar="STR", type=str, nargs="+", default=["W08D"], required=False, help="CROCUS nodes ingested, one query and one output per node and day, site metadata from executables/crocus_sites.csv (default: W08D)")
+    parser.add_argument("--ingest-cores", metavar="INT", type=int, default=4, required=False, help="Cores requested by an ingest job to derive its nodes in parallel, at most one per node (default: 4)")
+    parser.add_argument("--cache-dir", metavar="STR", type=str, default=None, required=False, help="Shared directory for the Sage query cache on the workers (default: per user cache)")
+    parser.add_argument("--zarr-store", metavar="STR", type=str, default=None, required=False, help="Directory shared with the workers where the ingest jobs also append every day to a Zarr store per datastream and node (default: none)")
+    parser.add_argument("--zarr-origin", metavar="STR", type=str, default="2024-01-01", required=False, help="First day of newly created Zarr stores, earlier days are rejected (default: 2024-01-01)")
+    parser.add_argument("--stream", action="store_true", help="Run the ingest jobs in bounded memory streaming mode")
+    parser.add_argument("--force", action="store_true", help="Recompute days that already have up to date outputs in local storage")
+    parser.add_argument("--days-per-job", metavar="INT", type=int, default=1, required=False, help="Days processed by each ingest job (default: 1)")
+    parser.add_argument("--encoding", type=str, choices=["none", "zlib", "compact", "archive"], default="zlib", help="netCDF encoding profile of the outputs, see executables/sage_netcdf.py (default: zlib)")
+    parser.add_argument("--no-metrics", action="store_true", help="Do not collect the per-phase metrics of the ingest jobs in the output directory")
+
+    parser.add_argument("--cluster", type=str, choices=["horizontal", "label"], nargs="+", default=None, help="Pegasus job clustering, horizontal per transformation and/or label (default: none)")
+    parser.add_argument("--cluster-size", metavar="INT", type=int, default=10, required=False, help="Jobs per horizontal cluster (default: 10)")
+    parser.add_argument("--cluster-runtime", metavar="INT", type=int, default=None, required=False, help="Size horizontal clusters to this many seconds of expected runtime instead of --cluster-size")
+    parser.add_argument("--day-runtime", metavar="INT", type=int, default=60, required=False, help="Expected runtime in seconds of one ingest day of one node, all datastreams, used with --cluster-runtime (default: 60)")
+    parser.add_argument("--label-days", metavar="INT", type=int, default=7, required=False, help="Consecutive days grouped by label clustering (default: 7)")
+
+    parser.add_argument("--container-image", metavar="STR", type=str, default=CrocusWorkflow.container_image, required=False, help=f"Container image of the ingest jobs (default: {CrocusWorkflow.container_image})")
+    parser.add_argument("--image-store", metavar="STR", type=str, default=None, required=False, help="Directory shared with the workers for the pre-built image (default: staged from the local shared scratch)")
+    parser.add_argument("--no-image-cache", action="store_true", help="Let every worker pull the image tag itself")
 
     args = parser.parse_args()
+    if min(args.aqt_lag, args.wxt_lag, args.ambient_lag) < 0:
+        parser.error("--aqt-lag, --wxt-lag and --ambient-lag cannot be negative")
+    if args.aqt_lag == 0 and args.wxt_lag == 0 and not args.ambient_end_date:
+        parser.error("--aqt-lag and --wxt-lag are both 0 and there is no --ambient-end-date, there are no days to ingest")
+    if args.ambient_end_date:
+        if not args.ambient_creds:
+            parser.error("--ambient-end-date needs --ambient-creds")
+        if not os.path.isfile(args.ambient_creds):
+            parser.error(f"--ambient-creds {args.ambient_creds} is not a file")
+        if os.stat(args.ambient_creds).st_mode & 0o077:
+            parser.error(f"{args.ambient_creds} can be read by other users, chmod 600 it")
 
     workflow = CrocusWorkflow(
                     aqt_end_date = args.aqt_end_date,
                     aqt_lag = args.aqt_lag,
                     wxt_end_date = args.wxt_end_date,
                     wxt_lag = args.wxt_lag,
-                    dagfile = args.output)
+                    wxt_summaries = args.wxt_summaries,
+                    ambient_end_date = args.ambient_end_date,
+                    ambient_lag = args.ambient_lag,
+                    ambient_stations = args.ambient_stations,
+                    ambient_creds = args.ambient_creds,
+                    dagfile = args.output,
+                    cache_dir = args.cache_dir,
+                    zarr_store = args.zarr_store,
+                    zarr_origin = args.zarr_origin,
+                    stream = args.stream,
+                    days_per_job = args.days_per_job,
+                    encoding = args.encoding,
+                    cluster = args.cluster,
+                    cluster_size = args.cluster_size,
+                    cluster_runtime = args.cluster_runtime,
+                    day_runtime = args.day_runtime,
+                    label_days = args.label_days,
+                    container_image = args.container_image,
+                    image_cache = not args.no_image_cache,
+                    image_store = args.image_store,
+                    metrics = not args.no_metrics,
+                    vsns = args.vsn,
+                    ingest_cores = args.ingest_cores,
+                    reuse = not args.force)
 
     print("Creating execution sites...")
     workflow.create_sites_catalog()
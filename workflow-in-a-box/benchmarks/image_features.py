@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""
+Histogram-based feature extraction of edge_image.py (image_features) against computing
+each statistic with its own full-array NumPy/OpenCV reduction, on Waggle camera sized frames.
+
+The naive results are also the reference the histogram-based ones are checked against, as
+is the whole frame record of a 3x3 tiling, derived from its tiles. The script exits with an
+error when they disagree.
+"""
+import sys
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+
+import numpy as np
+import cv2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "workflow" / "executables"))
+import edge_image
+
+EXAMPLE = Path(__file__).resolve().parent.parent / "workflow" / "inputs" / "example.jpg"
+
+# width x height of Waggle camera frames
+SIZES = {"720p": (1280, 720), "1080p": (1920, 1080), "5MP": (2592, 1944), "4K": (3840, 2160)}
+
+
+def naive_features(image, bins=16):
+    record = {
+        "mean": np.mean(image, (0, 1)).tolist(),
+        "std": np.std(image, (0, 1)).tolist(),
+        "min": image.min((0, 1)).tolist(),
+        "max": image.max((0, 1)).tolist(),
+        "histogram": [np.histogram(image[..., c], bins, (0, 256))[0].tolist() for c in range(image.shape[2])],
+    }
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    record["brightness"] = float(np.mean(image.astype(float) @ edge_image.LUMA))
+    record["sharpness"] = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    return record
+
+
+def check(record, naive, label="histogram"):
+    ok = True
+    for name, value in naive.items():
+        if not np.allclose(record[name], value, rtol=1e-6, atol=1e-6):
+            print(f"    {name}: {label} {record[name]} != naive {value}")
+            ok = False
+    return ok
+
+
+def best(f, repeat):
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        f()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = ArgumentParser(description="Histogram-based image features against per-metric reductions")
+    parser.add_argument("--image", metavar="STR", type=str, default=str(EXAMPLE), help="Image resized to each frame size (default: the example image)")
+    parser.add_argument("--sizes", type=str, choices=list(SIZES), nargs="+", default=list(SIZES), help="Frame sizes (default: all)")
+    parser.add_argument("--repeat", metavar="INT", type=int, default=5, help="Runs per variant, the best one is reported (default: 5)")
+    parser.add_argument("--threads", metavar="INT", type=int, default=1, help="OpenCV worker threads, edge nodes run with 1 (default: 1)")
+
+    args = parser.parse_args()
+    cv2.setNumThreads(args.threads)
+
+    source = cv2.imread(args.image)
+    ok = True
+    for size in args.sizes:
+        image = cv2.resize(source, SIZES[size], interpolation=cv2.INTER_AREA)
+
+        naive = naive_features(image)
+        ok &= check(edge_image.image_features(image), naive)
+        ok &= check(edge_image.image_features(image, tiles=(3, 3)), naive, "3x3 tiles")
+
+        t_naive = best(lambda: naive_features(image), args.repeat)
+        t_hist = best(lambda: edge_image.image_features(image), args.repeat)
+        t_tiles = best(lambda: edge_image.image_features(image, tiles=(3, 3)), args.repeat)
+        t_mean = best(lambda: np.mean(image, (0, 1)), args.repeat)
+        print(f"{size:>6} {SIZES[size][0]}x{SIZES[size][1]}  naive {t_naive * 1000:7.1f} ms  histogram {t_hist * 1000:6.1f} ms "
+              f"({t_naive / t_hist:4.1f}x)  3x3 tiles {t_tiles * 1000:6.1f} ms  np.mean alone {t_mean * 1000:6.1f} ms")
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
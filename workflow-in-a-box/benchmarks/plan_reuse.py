@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Per-cycle overhead of periodic workflow runs, planning every cycle (workflow.py) against
+planning once and resubmitting the cached plan (workflow.py --reuse-plan).
+
+Each mode runs --cycles cycles in its own copy of the workflow directory. A cycle is split
+into prepare (build the workflow, then plan and submit, or hash and resubmit) and run (until
+the DAG finished). Needs Pegasus and a running HTCondor pool, as on the node.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import statistics
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+
+WORKFLOW_DIR = Path(__file__).resolve().parent.parent / "workflow"
+sys.path.insert(0, str(WORKFLOW_DIR))
+import workflow
+
+
+def cycles(mode, n, tmp):
+    run_dir = os.path.join(tmp, mode)
+    shutil.copytree(WORKFLOW_DIR, run_dir, ignore=shutil.ignore_patterns("submit", "outputs", "*.db"))
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    timings = []
+    try:
+        for _ in range(n):
+            start = perf_counter()
+            wf = workflow.SageWorkflow()
+            if mode == "reuse":
+                wf.submit_planned()
+            else:
+                wf.submit()
+            wf.timings["total"] = perf_counter() - start
+            timings.append(wf.timings)
+    finally:
+        os.chdir(cwd)
+    return timings
+
+
+def report(mode, timings):
+    print(f"{mode:>6}: {len(timings)} cycles")
+    for i, t in enumerate(timings):
+        print(f"    cycle {i + 1:>3} {t.get('mode', 'planned'):>8}  prepare {t['prepare']:6.2f}s  run {t['run']:6.2f}s  total {t['total']:6.2f}s")
+    # the first cycle of the reuse mode plans, the steady state is what a periodic run pays
+    steady = timings[1:] or timings
+    prepare = statistics.median(t["prepare"] for t in steady)
+    total = statistics.median(t["total"] for t in steady)
+    print(f"    steady state median  prepare {prepare:6.2f}s  total {total:6.2f}s")
+    return prepare, total
+
+
+def main():
+    parser = ArgumentParser(description="Per-cycle overhead with and without planned DAG reuse")
+    parser.add_argument("--cycles", metavar="INT", type=int, default=5, help="Cycles per mode (default: 5)")
+    parser.add_argument("--hash-repeat", metavar="INT", type=int, default=100, help="Repetitions of the definition hash timing (default: 100)")
+
+    args = parser.parse_args()
+
+    os.chdir(WORKFLOW_DIR)
+    start = perf_counter()
+    for _ in range(args.hash_repeat):
+        workflow.SageWorkflow().definition_hash()
+    print(f"build and hash the definition: {(perf_counter() - start) / args.hash_repeat * 1000:.2f} ms")
+
+    if not shutil.which("pegasus-plan") or not shutil.which("condor_q"):
+        print("pegasus-plan and condor_q are needed for the cycle timings")
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        plan_prepare, plan_total = report("plan", cycles("plan", args.cycles, tmp))
+        reuse_prepare, reuse_total = report("reuse", cycles("reuse", args.cycles, tmp))
+
+    print(f"per-cycle prepare {plan_prepare:.2f}s -> {reuse_prepare:.2f}s, total {plan_total:.2f}s -> {reuse_total:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
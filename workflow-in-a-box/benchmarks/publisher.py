@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""
+Delivery check and throughput of result_publisher.py against a local HTTP stand-in for
+the Beehive uplink.
+
+The stand-in fails a share of the requests and can go down completely. Records are
+published across a simulated outage and a restart of the publisher (a new publisher on
+the same queue file); the script exits with an error if any record is lost. It also
+compares the time and bytes of batched, compressed publishing with one request per record.
+"""
+import os
+import sys
+import gzip
+import json
+import random
+import tempfile
+import threading
+from time import perf_counter
+from pathlib import Path
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "workflow" / "executables"))
+import result_publisher
+
+
+class StandIn(ThreadingHTTPServer):
+    """
+    Beehive stand-in that keeps the records of every batch id once, fails requests with
+    probability failure_rate, and answers nothing but 503 while down.
+    """
+    def __init__(self, failure_rate=0.0, latency=0.0):
+        super().__init__(("localhost", 0), StandInHandler)
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.down = False
+        self.batches = {}
+        self.requests = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.rng = random.Random(0)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://localhost:{self.server_port}/ingest"
+
+    def records(self):
+        return [r for batch in self.batches.values() for r in batch]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        threading.Event().wait(server.latency)
+        with server.lock:
+            server.requests += 1
+            server.bytes += len(body)
+            failed = server.down or server.rng.random() < server.failure_rate
+            if not failed:
+                lines = gzip.decompress(body).decode().splitlines()
+                server.batches.setdefault(self.headers["X-Batch-Id"], [json.loads(line) for line in lines])
+
+        self.send_response(503 if failed else 200)
+        self.end_headers()
+
+
+def record(i):
+    return {"timestamp": 1.7e9 + i, "frame": f"frame-{i:06d}", "mean": [86.8 + i % 7, 139.8, 142.7]}
+
+
+def delivery(n, batch_size, failure_rate, tmp):
+    """
+    Publish n records across an outage and a publisher restart, True if all arrived.
+    """
+    server = StandIn(failure_rate)
+    queue = os.path.join(tmp, "delivery.db")
+
+    out = result_publisher.ResultPublisher(queue, result_publisher.http_sender(server.url), batch_size=batch_size,
+                                           max_delay=0.2, max_backoff=0.5).start()
+    for i in range(n // 2):
+        out.put(record(i))
+
+    # uplink drops, the publisher is restarted while records are still queued
+    server.down = True
+    for i in range(n // 2, 3 * n // 4):
+        out.put(record(i))
+    queued = out.pending()[0]
+    out.close(timeout=0.5)
+
+    server.down = False
+    out = result_publisher.ResultPublisher(queue, result_publisher.http_sender(server.url), batch_size=batch_size,
+                                           max_delay=0.2, max_backoff=0.5).start()
+    for i in range(3 * n // 4, n):
+        out.put(record(i))
+    out.close(timeout=30)
+
+    frames = [r["frame"] for r in server.records()]
+    lost = n - len(set(frames))
+    print(f"delivery: {n} records, {queued} queued during the outage, {server.requests} requests "
+          f"({failure_rate:.0%} failing), lost {lost}, duplicates {len(frames) - len(set(frames))}")
+    server.shutdown()
+    return lost == 0
+
+
+def throughput(n, batch_sizes, latency, tmp):
+    print(f"throughput: {n} records, {latency * 1000:.0f} ms uplink latency")
+    for batch_size in batch_sizes:
+        server = StandIn(latency=latency)
+        queue = os.path.join(tmp, f"throughput-{batch_size}.db")
+        out = result_publisher.ResultPublisher(queue, result_publisher.http_sender(server.url), batch_size=batch_size, max_delay=0.1)
+        start = perf_counter()
+        for i in range(n):
+            out.put(record(i))
+            out.flush()
+        out.close()
+        wall = perf_counter() - start
+        print(f"    batch {batch_size:>5}  {n / wall:9.0f} records/s  {server.requests:>6} requests  {server.bytes / 1024:8.1f} KiB sent")
+        server.shutdown()
+
+
+def main():
+    parser = ArgumentParser(description="Result publisher against a local Beehive stand-in")
+    parser.add_argument("--records", metavar="INT", type=int, default=2000, help="Records per run (default: 2000)")
+    parser.add_argument("--failure-rate", metavar="FLOAT", type=float, default=0.2, help="Share of failing requests in the delivery check (default: 0.2)")
+    parser.add_argument("--batch-sizes", metavar="INT", type=int, nargs="+", default=[1, 10, 100, 500], help="Batch sizes of the throughput runs")
+    parser.add_argument("--latency", metavar="FLOAT", type=float, default=0.02, help="Seconds the stand-in takes per request (default: 0.02)")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ok = delivery(args.records, 50, args.failure_rate, tmp)
+        throughput(args.records, args.batch_sizes, args.latency, tmp)
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
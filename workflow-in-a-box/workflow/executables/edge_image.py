@@ -1,17 +1,333 @@
 #!/usr/bin/env python3
 
+"""
+Mean color of the example image, or of a continuous stream of camera frames.
+
+With --stream the app keeps running over a camera (device index, video file or stream URL)
+or a directory frames are written to. Frames are sampled at --sample-rate and decoded at
+reduced resolution, frames that barely differ from the last processed one are skipped,
+and a bounded buffer between reading and processing drops the oldest frames when the
+node cannot keep up. One JSON record is printed per processed frame.
+
+image_features computes a configurable set of per-channel statistics in one record,
+optionally per tile or on a region of interest. It reads the frame once per channel to
+build 256 bin histograms, and derives mean, std, min, max, binned histograms and brightness
+from them; only sharpness (variance of the Laplacian) needs its own pass.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+from argparse import ArgumentParser
+
 import numpy as np
 import cv2
 
+# decode scale -> imread flag, JPEGs are decoded directly at the reduced size
+REDUCED_READ = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+# size of the grayscale thumbnails compared by the near-duplicate check
+THUMBNAIL = (32, 24)
+
+FEATURES = ["mean", "std", "min", "max", "histogram", "brightness", "sharpness"]
+
+# BT.601 luma weights of the B, G, R channels
+LUMA = np.array([0.114, 0.587, 0.299])
+
+
+def _channel_histograms(image):
+    channels = image.shape[2] if image.ndim == 3 else 1
+    return np.stack([cv2.calcHist([image], [c], None, [256], [0, 256]).ravel() for c in range(channels)]).astype(np.int64)
+
+
+def _from_histograms(hist, features, bins):
+    values = np.arange(256)
+    n = hist.sum(axis=1)
+    mean = hist @ values / n
+
+    record = {}
+    if "mean" in features:
+        record["mean"] = mean.tolist()
+    if "std" in features:
+        record["std"] = np.sqrt(np.maximum(hist @ values ** 2 / n - mean ** 2, 0)).tolist()
+    if "min" in features:
+        record["min"] = np.argmax(hist > 0, axis=1).tolist()
+    if "max" in features:
+        record["max"] = (255 - np.argmax(hist[:, ::-1] > 0, axis=1)).tolist()
+    if "histogram" in features:
+        record["histogram"] = hist.reshape(len(hist), bins, -1).sum(axis=2).tolist()
+    if "brightness" in features:
+        record["brightness"] = float(mean @ LUMA if len(mean) == 3 else mean[0])
+    return record
+
+
+def _laplacian_moments(laplacian):
+    mean, std = cv2.meanStdDev(laplacian)
+    return np.array([laplacian.size, mean[0, 0], std[0, 0] ** 2])
+
+
+def _sharpness(moments):
+    """
+    Variance of the Laplacian from the (count, mean, variance) rows of its tiles.
+    """
+    n, mean, var = np.atleast_2d(moments).T
+    total_mean = n @ mean / n.sum()
+    return float(n @ (var + mean ** 2) / n.sum() - total_mean ** 2)
+
 
 def compute_mean_color(image):
-    return np.mean(image, (0, 1)).astype(float)
+    return np.array(image_features(image, ["mean"])["mean"])
+
+
+def image_features(image, features=FEATURES, bins=16, tiles=None, roi=None):
+    """
+    Statistics of an 8 bit BGR (or gray) image as one record. bins must divide 256, tiles is
+    (rows, cols) and adds a record per tile, roi is (x, y, width, height).
+    """
+    if roi:
+        x, y, w, h = roi
+        image = image[y:y + h, x:x + w]
+
+    laplacian = None
+    if "sharpness" in features:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        laplacian = cv2.Laplacian(gray, cv2.CV_16S)
+
+    # the whole image statistics are derived from the tile histograms and Laplacian moments,
+    # every pixel is read once per channel whatever the tiling
+    rows, cols = tiles or (1, 1)
+    row_edges = np.linspace(0, image.shape[0], rows + 1).astype(int)
+    col_edges = np.linspace(0, image.shape[1], cols + 1).astype(int)
+    total = 0
+    moments = []
+    tile_records = []
+    for r in range(rows):
+        for c in range(cols):
+            window = (slice(row_edges[r], row_edges[r + 1]), slice(col_edges[c], col_edges[c + 1]))
+            hist = _channel_histograms(image[window])
+            total = total + hist
+            if laplacian is not None:
+                moments.append(_laplacian_moments(laplacian[window]))
+            if tiles:
+                tile_record = {"tile": [r, c], **_from_histograms(hist, features, bins)}
+                if laplacian is not None:
+                    tile_record["sharpness"] = _sharpness(moments[-1])
+                tile_records.append(tile_record)
+
+    record = _from_histograms(total, features, bins)
+    if laplacian is not None:
+        record["sharpness"] = _sharpness(moments)
+    if tiles:
+        record["tiles"] = tile_records
+    return record
+
+
+class FrameBuffer():
+    """
+    Bounded buffer between the frame reader and the processing loop. When it is full, live
+    sources drop the oldest frame, recorded ones (files, a finished directory) wait.
+    """
+    def __init__(self, size, live=True):
+        self.frames = deque(maxlen=size)
+        self.live = live
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, frame):
+        with self.cond:
+            while not self.live and len(self.frames) == self.frames.maxlen and not self.closed:
+                self.cond.wait()
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(frame)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Next frame, None on timeout or once the buffer is closed and empty.
+        """
+        with self.cond:
+            if not self.frames and not self.closed:
+                self.cond.wait(timeout)
+            if not self.frames:
+                return None
+            self.cond.notify_all()
+            return self.frames.popleft()
+
+    def done(self):
+        with self.cond:
+            return self.closed and not self.frames
+
+
+def read_directory(path, buffer, interval, scale, follow, stop):
+    """
+    Frames of a directory in name order, sampled by modification time. With follow the
+    directory is polled for new frames until stop is set.
+    """
+    seen = set()
+    next_time = 0
+    while not stop.is_set():
+        names = sorted(n for n in os.listdir(path) if n.lower().endswith(IMAGE_EXTENSIONS) and n not in seen)
+        for name in names:
+            seen.add(name)
+            full = os.path.join(path, name)
+            mtime = os.path.getmtime(full)
+            if mtime < next_time:
+                continue
+
+            image = cv2.imread(full, REDUCED_READ[scale])
+            if image is None:
+                continue
+            next_time = mtime + interval
+            buffer.put((mtime, name, image))
+
+        if not follow:
+            break
+        stop.wait(min(interval, 1.0) if interval else 1.0)
+    buffer.close()
+
+
+def read_capture(source, buffer, interval, scale, stop):
+    """
+    Frames of a camera or video. Every frame is grabbed to keep the stream current, but
+    only sampled frames are decoded.
+    """
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    recorded = os.path.isfile(source)
+    next_time = 0
+    n = 0
+    while not stop.is_set() and capture.grab():
+        n += 1
+        # media time for video files, the clock for live sources
+        now = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000 if recorded else time.monotonic()
+        if now < next_time:
+            continue
+
+        ok, frame = capture.retrieve()
+        if not ok:
+            continue
+        next_time = now + interval
+        if scale > 1:
+            frame = cv2.resize(frame, None, fx=1 / scale, fy=1 / scale, interpolation=cv2.INTER_AREA)
+        buffer.put((time.time(), f"{source}#{n}", frame))
+
+    capture.release()
+    buffer.close()
+
+
+def thumbnail(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMBNAIL, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def stream(source, sample_rate=1.0, scale=4, buffer_size=8, diff_threshold=2.0, max_frames=None, duration=None, follow=False,
+           features=["mean"], tiles=None, roi=None, publish=None):
+    interval = 1.0 / sample_rate if sample_rate > 0 else 0
+    buffer = FrameBuffer(buffer_size, live=follow if os.path.isdir(source) else not os.path.isfile(source))
+    stop = threading.Event()
+
+    if os.path.isdir(source):
+        reader = threading.Thread(target=read_directory, args=(source, buffer, interval, scale, follow, stop), daemon=True)
+    else:
+        reader = threading.Thread(target=read_capture, args=(source, buffer, interval, scale, stop), daemon=True)
+    reader.start()
+
+    start, cpu_start = time.monotonic(), time.process_time()
+    processed = skipped = 0
+    last = None
+    try:
+        while not buffer.done():
+            if duration and time.monotonic() - start >= duration:
+                break
+            frame = buffer.get(timeout=1.0)
+            if frame is None:
+                continue
+
+            timestamp, name, image = frame
+            # cheap near-duplicate check: mean abs difference of small grayscale thumbnails
+            thumb = thumbnail(image)
+            if last is not None and np.mean(np.abs(thumb - last)) < diff_threshold:
+                skipped += 1
+                continue
+            last = thumb
+
+            record = {"timestamp": timestamp, "frame": name, **image_features(image, features, tiles=tiles, roi=roi)}
+            print(json.dumps(record), flush=True)
+            if publish:
+                publish.put(record)
+
+            processed += 1
+            if max_frames and processed >= max_frames:
+                break
+    finally:
+        stop.set()
+        buffer.close()
+        # let the reader release the capture before the interpreter exits
+        reader.join(timeout=5)
+    wall, cpu = time.monotonic() - start, time.process_time() - cpu_start
+    print(f"processed {processed}, skipped {skipped} near-duplicates, dropped {buffer.dropped}, "
+          f"{processed / wall if wall else 0:.2f} frames/s, cpu {cpu:.2f}s of {wall:.2f}s", file=sys.stderr)
 
 
 def main():
+    parser = ArgumentParser(description="Mean color of an image or a stream of frames")
+    parser.add_argument("--stream", metavar="STR", type=str, default=None, help="Camera index, video file/URL or directory of frames to process continuously")
+    parser.add_argument("--sample-rate", metavar="FLOAT", type=float, default=1.0, help="Frames per second to process, 0 for all (default: 1.0)")
+    parser.add_argument("--scale", type=int, choices=list(REDUCED_READ), default=4, help="Decode frames at 1/scale resolution (default: 4)")
+    parser.add_argument("--buffer", metavar="INT", type=int, default=8, help="Frames buffered between reading and processing (default: 8)")
+    parser.add_argument("--diff-threshold", metavar="FLOAT", type=float, default=2.0, help="Skip frames whose mean gray level difference to the last processed frame is below this, 0 disables (default: 2.0)")
+    parser.add_argument("--max-frames", metavar="INT", type=int, default=None, help="Stop after this many processed frames")
+    parser.add_argument("--duration", metavar="FLOAT", type=float, default=None, help="Stop after this many seconds")
+    parser.add_argument("--follow", action="store_true", help="Keep polling a frame directory for new frames")
+    parser.add_argument("--features", metavar="STR", type=lambda s: s.split(","), default=None, help=f"Comma separated statistics to compute, of {','.join(FEATURES)} (default: mean color)")
+    parser.add_argument("--tiles", metavar="STR", type=lambda s: tuple(int(v) for v in s.split("x")), default=None, help="Also compute the statistics per tile of a ROWSxCOLS grid (example: 2x3)")
+    parser.add_argument("--roi", metavar="STR", type=lambda s: tuple(int(v) for v in s.split(",")), default=None, help="Only use the region X,Y,WIDTH,HEIGHT of the (decoded) frame")
+    parser.add_argument("--publish", metavar="STR", type=str, default=None, help="Also publish the stream records in batches to this HTTP endpoint, or waggle (see result_publisher.py)")
+    parser.add_argument("--queue", metavar="STR", type=str, default="results.db", help="Durable queue of the records to publish (default: results.db)")
+    parser.add_argument("--threads", metavar="INT", type=int, default=1, help="OpenCV worker threads (default: 1)")
+
+    args = parser.parse_args()
+    cv2.setNumThreads(args.threads)
+
+    unknown = set(args.features or []) - set(FEATURES)
+    if unknown:
+        parser.error(f"unknown features: {', '.join(sorted(unknown))}")
+
+    if args.stream and args.publish:
+        import result_publisher
+
+        with result_publisher.publisher(args.queue, args.publish) as out:
+            stream(args.stream, args.sample_rate, args.scale, args.buffer, args.diff_threshold,
+                   args.max_frames, args.duration, args.follow, args.features or ["mean"], args.tiles, args.roi, out)
+        return
+
+    if args.stream:
+        stream(args.stream, args.sample_rate, args.scale, args.buffer, args.diff_threshold,
+               args.max_frames, args.duration, args.follow, args.features or ["mean"], args.tiles, args.roi)
+        return
+
     # read example image from file
     image = cv2.imread("example.jpg")
 
+    if args.features:
+        print(json.dumps(image_features(image, args.features, tiles=args.tiles, roi=args.roi)))
+        return
+
     # compute mean color
     mean_color = compute_mean_color(image)
 
@@ -21,5 +337,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
-
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""
+Durable, batched publishing of on-node results.
+
+Records are appended to a SQLite queue on local disk first, and sent in batches once
+--batch-size records are pending or the oldest one has waited --max-delay seconds. A batch
+is only removed from the queue after the uplink accepted it, failed sends back off and
+are retried, and records queued before a restart are sent by the next run.
+
+Batches go to an HTTP endpoint as gzip compressed newline delimited JSON, with an
+X-Batch-Id header (first-last queue id) so the receiver can drop batches it already has,
+or to Beehive through pywaggle (--url waggle), one message per batch holding the same
+compressed payload. Delivery is at least once.
+
+As a command, lines of JSON records from files (or stdin) are queued and flushed:
+
+    edge_image.py --stream 0 | result_publisher.py --queue results.db --url http://host/ingest
+"""
+import sys
+import gzip
+import base64
+import json
+import time
+import sqlite3
+import threading
+import urllib.request
+from contextlib import ExitStack
+from argparse import ArgumentParser
+
+
+def http_sender(url, timeout=30):
+    def send(records, batch_id):
+        body = gzip.compress("\n".join(json.dumps(r) for r in records).encode())
+        request = urllib.request.Request(url, data=body, method="POST", headers={
+            "Content-Type": "application/x-ndjson",
+            "Content-Encoding": "gzip",
+            "X-Batch-Id": batch_id,
+        })
+        with urllib.request.urlopen(request, timeout=timeout):
+            pass
+    return send
+
+
+class WaggleSender():
+    """
+    Publishes each batch as one message through pywaggle: the gzip compressed newline delimited
+    JSON of the HTTP path, base64 encoded, with the batch id and record count in the meta. The
+    plugin is entered as a context manager and exited by close().
+    """
+    def __init__(self, name="edge.image"):
+        from waggle.plugin import Plugin
+
+        self.name = name
+        self.stack = ExitStack()
+        self.plugin = self.stack.enter_context(Plugin())
+
+    def __call__(self, records, batch_id):
+        body = gzip.compress("\n".join(json.dumps(r) for r in records).encode())
+        timestamp = records[0].get("timestamp")
+        self.plugin.publish(self.name, base64.b64encode(body).decode(),
+                            meta={"encoding": "ndjson+gzip+base64", "batch_id": batch_id, "records": str(len(records))},
+                            timestamp=int(timestamp * 1e9) if timestamp else None)
+
+    def close(self):
+        self.stack.close()
+
+
+class ResultPublisher():
+    def __init__(self, queue_path, send, batch_size=100, max_delay=30.0, max_queue=100000, max_backoff=300.0):
+        self.send = send
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.max_backoff = max_backoff
+
+        self.db = sqlite3.connect(queue_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, record TEXT)")
+        self.db.commit()
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.failures = 0
+        self.retry_at = 0
+        self.sent = 0
+
+    def put(self, record):
+        with self.lock:
+            self.db.execute("INSERT INTO queue (created, record) VALUES (?, ?)", (time.time(), json.dumps(record)))
+            # bound the disk use during long outages, the oldest records go first
+            if self.max_queue:
+                self.db.execute("DELETE FROM queue WHERE id <= (SELECT MAX(id) FROM queue) - ?", (self.max_queue,))
+            self.db.commit()
+        self.wake.set()
+
+    def pending(self):
+        with self.lock:
+            count, oldest = self.db.execute("SELECT COUNT(*), MIN(created) FROM queue").fetchone()
+        return count, oldest
+
+    def due(self):
+        count, oldest = self.pending()
+        if count == 0 or time.time() < self.retry_at:
+            return False
+        return count >= self.batch_size or time.time() - oldest >= self.max_delay
+
+    def flush(self, force=False):
+        """
+        Send due batches (all pending records with force), returns False when a send failed.
+        """
+        while force or self.due():
+            with self.lock:
+                rows = self.db.execute("SELECT id, record FROM queue ORDER BY id LIMIT ?", (self.batch_size,)).fetchall()
+            if not rows:
+                return True
+
+            try:
+                self.send([json.loads(record) for _, record in rows], f"{rows[0][0]}-{rows[-1][0]}")
+            except Exception as e:
+                self.failures += 1
+                backoff = min(2 ** self.failures, self.max_backoff)
+                self.retry_at = time.time() + backoff
+                print(f"Publishing {len(rows)} records failed ({e}), retrying in {backoff:.1f}s", file=sys.stderr)
+                return False
+
+            with self.lock:
+                self.db.execute("DELETE FROM queue WHERE id <= ?", (rows[-1][0],))
+                self.db.commit()
+            self.failures = 0
+            self.retry_at = 0
+            self.sent += len(rows)
+        return True
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.flush()
+            self.wake.wait(min(self.max_delay, 1.0))
+            self.wake.clear()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self, timeout=10.0):
+        """
+        Stop the background flusher and try to send what is left, anything unsent stays queued.
+        """
+        self.stopped.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+        deadline = time.time() + timeout
+        self.retry_at = 0
+        while self.pending()[0] and time.time() < deadline and self.flush(force=True) is False:
+            time.sleep(min(max(self.retry_at - time.time(), 0), max(deadline - time.time(), 0)))
+        self.db.close()
+        if hasattr(self.send, "close"):
+            self.send.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def publisher(queue, url, batch_size=100, max_delay=30.0):
+    send = WaggleSender() if url == "waggle" else http_sender(url)
+    return ResultPublisher(queue, send, batch_size=batch_size, max_delay=max_delay)
+
+
+def main():
+    parser = ArgumentParser(description="Queue JSON line records and publish them in batches")
+    parser.add_argument("files", metavar="STR", type=str, nargs="*", help="Files of JSON line records (default: stdin)")
+    parser.add_argument("--queue", metavar="STR", type=str, default="results.db", help="SQLite queue file (default: results.db)")
+    parser.add_argument("--url", metavar="STR", type=str, required=True, help="HTTP endpoint the batches are POSTed to, or waggle to publish through pywaggle")
+    parser.add_argument("--batch-size", metavar="INT", type=int, default=100, help="Records per batch (default: 100)")
+    parser.add_argument("--max-delay", metavar="FLOAT", type=float, default=30.0, help="Seconds a record waits at most for its batch to fill (default: 30.0)")
+    parser.add_argument("--close-timeout", metavar="FLOAT", type=float, default=10.0, help="Seconds spent sending the rest of the queue at the end (default: 10.0)")
+
+    args = parser.parse_args()
+
+    out = publisher(args.queue, args.url, args.batch_size, args.max_delay).start()
+    try:
+        for f in [open(path) for path in args.files] or [sys.stdin]:
+            with f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith("{"):
+                        out.put(json.loads(line))
+    finally:
+        out.close(args.close_timeout)
+
+    print(f"published {out.sent} records", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,51 @@
 #!/usr/bin/env python3
+import io
 import os
 import sys
+import json
+import time
+import shutil
+import hashlib
+import subprocess
 from pathlib import Path
 import datetime
+from argparse import ArgumentParser
 
 # --- Import Pegasus API -----------------------------------------------------------
 from Pegasus.api import *
 
+# submit directory of the cached plan, below --submit-dir
+PLANNED_DIR = "planned"
+HASH_FILE = ".definition-hash"
+# definition hash whose resubmitted plan did not run again, below --submit-dir
+NO_REUSE_FILE = ".no-reuse"
+
+# seconds a resubmitted DAG gets to show up as running before its old state is trusted
+RESUBMIT_GRACE = 60
+
+
+def read_hash(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
 class SageWorkflow():
     wf = None
+    plan_options = {
+        "input_dirs": ["./inputs"],
+        "output_dir": "./outputs",
+        "transformations_dir": "./executables",
+        "env.PEGASUS_HOME": "/usr",
+    }
 
     # --- Init ---------------------------------------------------------------------
-    def __init__(self):
+    def __init__(self, stream=None, duration=None, sample_rate=1.0, publish=None):
         self.wf_name = "SageWorkflow" 
+        self.timings = {}
+        # files staged out to the output directory, a cycle has to rewrite them
+        self.outputs = []
     
         ts = datetime.datetime.now()
         self.wf = Workflow(self.wf_name, infer_dependencies=True)
@@ -21,26 +54,167 @@ class SageWorkflow():
         a = File("example.jpg")
         b = File("color.out")
         edge_image_job = Job("edge_image.py")\
-                            .add_inputs(a)\
                             .set_stdout(b, stage_out=True, register_replica=False)
+        self.outputs.append(b.lfn)
+
+        # in streaming mode a single job keeps processing camera frames for the given duration
+        if stream:
+            edge_image_job.add_args("--stream", stream, "--sample-rate", sample_rate)
+            if duration:
+                edge_image_job.add_args("--duration", duration)
+
+            # the publish queue lives next to the workflow, so it survives across runs
+            if publish:
+                wf_dir = str(Path(__file__).parent.resolve())
+                rc = ReplicaCatalog()
+                rc.add_replica("local", "result_publisher.py", os.path.join(wf_dir, "executables", "result_publisher.py"))
+                self.wf.add_replica_catalog(rc)
+                edge_image_job.add_args("--publish", publish, "--queue", os.path.join(wf_dir, "results.db"))\
+                              .add_inputs("result_publisher.py")
+        else:
+            edge_image_job.add_inputs(a)
 
         self.wf.add_jobs(edge_image_job)
 
     def submit(self):
         try:
-            properties = {"env.PEGASUS_HOME": "/usr"}
-            self.wf.plan(
-                input_dirs=["./inputs"], 
-                output_dir="./outputs", 
-                transformations_dir="./executables",
-                submit=True,
-                **properties
-            ).wait().analyze()
+            start = time.perf_counter()
+            self.wf.plan(submit=True, **self.plan_options)
+            self.timings["prepare"] = time.perf_counter() - start
+            self.wf.wait().analyze()
+            self.timings["run"] = time.perf_counter() - start - self.timings["prepare"]
         except Exception as e:
             print(e)
             exit(-1)
 
+    # --- Planned DAG reuse --------------------------------------------------------
+    def definition_hash(self):
+        """
+        Hash of what the planned DAG depends on: the abstract workflow without its creation
+        stamp, the plan options and the file names the planner finds in the input and
+        executable directories. File contents are staged when the DAG runs, not at planning.
+        """
+        buf = io.StringIO()
+        self.wf.write(buf, _format="json")
+        definition = json.loads(buf.getvalue())
+        definition.pop("x-pegasus", None)
+
+        dirs = self.plan_options["input_dirs"] + [self.plan_options["transformations_dir"]]
+        listing = {str(Path(d).resolve()): sorted(os.listdir(d)) for d in dirs}
+        key = json.dumps([definition, self.plan_options, os.getcwd(), listing], sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def outputs_written(self, since):
+        """
+        Whether every output in the output directory was written after since (epoch seconds).
+        """
+        paths = [Path(self.plan_options["output_dir"]) / lfn for lfn in self.outputs]
+        return all(p.is_file() and p.stat().st_mtime >= since for p in paths)
+
+    def resubmit(self, planned):
+        """
+        Run an already planned submit directory again with pegasus-run and wait for it.
+        Nothing is replanned, the DAG runs as it was planned; submit_planned checks that it
+        wrote the outputs.
+        """
+        # DAGMan would pick up a rescue DAG left by a failed cycle and skip the nodes that
+        # succeeded in it, every cycle has to run all of them
+        for rescue in Path(planned).glob("*.dag.rescue*"):
+            rescue.unlink()
+
+        started = time.time()
+        subprocess.run(["pegasus-run", planned], check=True)
+
+        # right after pegasus-run the status can still be the one of the last cycle
+        running = False
+        while True:
+            time.sleep(5)
+            status = subprocess.run(["pegasus-status", "--jsonrv", planned], check=True, capture_output=True, text=True)
+            state = json.loads(status.stdout)["dags"]["root"]["state"]
+            running |= state == "Running"
+            if state == "Failure" or (state == "Success" and (running or self.outputs_written(started)
+                                                                or time.time() - started > RESUBMIT_GRACE)):
+                break
+        if state == "Failure":
+            subprocess.run(["pegasus-analyzer", planned])
+
+    def plan_cached(self, submit_dir, digest):
+        """
+        Plan and submit into the cached plan directory of submit_dir, recording the hash.
+        """
+        planned = os.path.join(submit_dir, PLANNED_DIR)
+        shutil.rmtree(planned, ignore_errors=True)
+        self.wf.plan(dir=submit_dir, relative_dir=PLANNED_DIR, submit=True, **self.plan_options)
+        with open(os.path.join(planned, HASH_FILE), "w") as f:
+            f.write(digest)
+
+    def submit_planned(self, submit_dir="./submit"):
+        """
+        Plan once into submit_dir and resubmit that plan on later calls, replanning when the
+        definition hash changed or the cached plan cannot be submitted. When a resubmitted run
+        did not write the outputs, the cycle is planned and run again, and later cycles of the
+        same definition plan every time instead of resubmitting.
+        """
+        planned = os.path.join(submit_dir, PLANNED_DIR)
+        hash_path = os.path.join(planned, HASH_FILE)
+        no_reuse_path = os.path.join(submit_dir, NO_REUSE_FILE)
+        try:
+            start = time.perf_counter()
+            started = time.time()
+            digest = self.definition_hash()
+
+            resubmitted = False
+            if read_hash(hash_path) == digest and read_hash(no_reuse_path) != digest:
+                try:
+                    self.resubmit(planned)
+                    resubmitted = True
+                    self.timings["mode"] = "reused"
+                except Exception as e:
+                    print(f"Resubmitting {planned} failed ({e}), replanning")
+
+            if not resubmitted:
+                self.plan_cached(submit_dir, digest)
+                self.timings["mode"] = "planned"
+            self.timings["prepare"] = time.perf_counter() - start
+
+            if not resubmitted:
+                self.wf.wait().analyze()
+            # a finished DAG is not guaranteed to run again, only trust the plan when it did
+            elif not self.outputs_written(started):
+                print(f"Resubmitting {planned} did not write {', '.join(self.outputs)}, replanning this and later cycles")
+                with open(no_reuse_path, "w") as f:
+                    f.write(digest)
+                self.plan_cached(submit_dir, digest)
+                self.timings["mode"] = "replanned"
+                self.wf.wait().analyze()
+            self.timings["run"] = time.perf_counter() - start - self.timings["prepare"]
+        except Exception as e:
+            print(e)
+            exit(-1)
 
 if __name__ == '__main__':
-    workflow = SageWorkflow()
-    workflow.submit()
+    parser = ArgumentParser(description="Pegasus Sage Edge Workflow")
+    parser.add_argument("--stream", metavar="STR", type=str, default=None, help="Camera index, stream URL or frame directory the edge job processes continuously (default: example.jpg once)")
+    parser.add_argument("--duration", metavar="FLOAT", type=float, default=None, help="Seconds the streaming job runs (default: until the stream ends)")
+    parser.add_argument("--sample-rate", metavar="FLOAT", type=float, default=1.0, help="Frames per second the streaming job processes (default: 1.0)")
+    parser.add_argument("--publish", metavar="STR", type=str, default=None, help="HTTP endpoint, or waggle, the streaming job publishes its records to in batches")
+    parser.add_argument("--reuse-plan", action="store_true", help="Experimental, off by default: plan once and resubmit the cached plan while the workflow definition is unchanged, falls back to planning every cycle when a resubmitted run does not write its outputs")
+    parser.add_argument("--submit-dir", metavar="STR", type=str, default="./submit", help="Directory the cached plan is kept in (default: ./submit)")
+    parser.add_argument("--cycles", metavar="INT", type=int, default=1, help="Number of periodic runs (default: 1)")
+    parser.add_argument("--interval", metavar="FLOAT", type=float, default=0.0, help="Seconds between the starts of periodic runs (default: 0.0)")
+
+    args = parser.parse_args()
+
+    for cycle in range(args.cycles):
+        started = time.time()
+        workflow = SageWorkflow(stream=args.stream, duration=args.duration, sample_rate=args.sample_rate, publish=args.publish)
+        if args.reuse_plan:
+            workflow.submit_planned(args.submit_dir)
+        else:
+            workflow.submit()
+
+        timings = workflow.timings
+        print(f"cycle {cycle + 1}/{args.cycles}: {timings.get('mode', 'planned')}, "
+              f"prepare {timings['prepare']:.1f}s, run {timings['run']:.1f}s")
+        if cycle + 1 < args.cycles:
+            time.sleep(max(0, started + args.interval - time.time()))